@@ -4,17 +4,24 @@ from __future__ import print_function
 
 import sys
 import os
+import json
+import time
+import hashlib
 import glob
 import itertools
 import argparse
+import multiprocessing
+from collections import defaultdict, namedtuple
 
 from flask import Flask
 import openpyxl
-import requests
+from sqlalchemy import func
 
 from server.app import app
 from server.models import *
-from server.api import get_categories
+from server.categories import categories_by_name
+from server.wikipedia import wikipedia
+from server import data_version
 
 # Expected spreadsheet headers
 HEADERS = [('A', 'Concept'),
@@ -38,150 +45,636 @@ def normalize_custom_title(title):
     """ Applies WP-like normalization to a custom topics title """
     return title.replace('_', ' ')
 
-def normalize_wp_title(title):
-    """ Applies WP normalization to a title, so we get it's canonical form"""
-    params = {
-        'action': 'query',
-        'titles': title,
-        'format': 'json',
-        'indexpageids': True
-    }
+def normalize_titles(titles):
+    """ Applies correct type of normalization to each title depending on topic
+    type. WP titles are looked up in batches. Returns a dict """
+    wp_titles = wikipedia.normalize_titles([t for t in titles if not is_custom(t)])
 
-    r = requests.get('http://en.wikipedia.org/w/api.php', params=params)
-    responce = r.json()
+    normalized = {}
 
-    pageid = responce['query']['pageids'][0]
+    for title in titles:
+        if is_custom(title):
+            normalized[title] = normalize_custom_title(title[4:])
+        else:
+            normalized[title] = wp_titles[title] # None if not found
 
-    assert pageid != '-1', 'Title not found'
+    return normalized
 
-    return responce['query']['pages'][pageid]['title']
+def context_titles(context):
+    # FIXME: Remove sections for now
+    return list(itertools.ifilterfalse(is_section, context.split()))
 
-def normalize_title(title):
-    """ Applies correct type of normalization depending on topic type """
-    if is_custom(title):
-        return normalize_custom_title(title[4:])
+def file_checksum(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def row_checksum(values):
+    return hashlib.sha1(json.dumps(values, default=unicode)).hexdigest()
+
+class RowError(object):
+    def __init__(self, workbook, row, message):
+        self.workbook = workbook
+        self.row = row
+        self.message = message
+
+    def __unicode__(self):
+        if self.row is None:
+            return u'%s: %s' % (self.workbook, self.message)
+
+        return u'%s, row %d: %s' % (self.workbook, self.row, self.message)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+def parse_workbook(workbook):
+    """ Reads rows of the workbook as plain records, streaming the sheet.
+    Returns a tuple of the workbook, records and errors """
+    sheet = openpyxl.load_workbook(workbook, read_only=True).active
+
+    records = []
+    errors = []
+
+    # Column letters to positions within a row
+    columns = [(ord(letter) - ord('A'), field) for letter, field in HEADERS]
+
+    for row_number, row in enumerate(sheet.iter_rows(), 1):
+        values = [cell.value for cell in row]
+        values.extend([None] * (len(HEADERS) - len(values)))
+
+        if row_number == 1:
+            for i, field in columns:
+                if values[i] != field:
+                    errors.append(RowError(workbook, 1,
+                        'Invalid header cell %s%d' % (chr(ord('A') + i), row_number)))
+
+            if errors:
+                break
+
+            continue
+
+        record = dict((field, values[i]) for i, field in columns)
+        record['Checksum'] = row_checksum([values[i] for i, _ in columns])
+
+        if not record['Concept']:
+            continue
+        
+        # FIXME: Skipping sections for now
+        if is_section(record['Concept']):
+            continue
+
+        if not record['Unit Code']:
+            errors.append(RowError(workbook, row_number, 'No unit code'))
+            continue
+
+        record['Row'] = row_number
+        records.append(record)
+
+    return workbook, records, errors
+
+def load_concepts(workbook, records, errors):
+    """ Normalizes titles of parsed records. Records with titles which are not
+    found are dropped """
+    # Normalise all titles of the workbook at once
+    titles = set()
+    for record in records:
+        titles.add(record['Concept'])
+
+        if record['Context']:
+            titles.update(context_titles(record['Context']))
+
+    normalized_titles = normalize_titles(titles)
+
+    concepts = []
+
+    for concept in records:
+        if normalized_titles[concept['Concept']] is None:
+            errors.append(RowError(workbook, concept['Row'],
+                'Title not found: %s' % concept['Concept']))
+            continue
+
+        # Before topic title is normalized - determine if it's custom
+        concept['Is Custom'] = is_custom(concept['Concept'])
+
+        # Name might be just a duplicated identifier - we don't need it then
+        if concept['Name'] == concept['Concept']:
+            concept['Name'] = None 
+
+        concept['Concept'] = normalized_titles[concept['Concept']]
+
+        # Name might also be a normalized identifier - we don't need it either
+        if concept['Name'] == concept['Concept']:
+            concept['Name'] = None
+
+        concept['Contexts'] = []
+
+        if concept['Context']:
+            for context in context_titles(concept['Context']):
+                if normalized_titles[context] is None:
+                    errors.append(RowError(workbook, concept['Row'],
+                        'Context title not found: %s' % context))
+                else:
+                    concept['Contexts'].append(normalized_titles[context])
+
+        concepts.append(concept)
+
+    return concepts
+
+def get_or_add_topic(concept, new_wp_topics):
+    """ Topic of the concept, added if it doesn't exist yet. New Wikipedia
+    topics are appended to new_wp_topics """
+    if concept['Is Custom']:
+        topic = db.session.query(CustomTopic).filter_by(name=concept['Concept']).first()
+
+        if not topic:
+            topic = CustomTopic(concept['Concept'])
+            topic.description = 'Added from spreadsheets'
+            db.session.add(topic)
+            db.session.flush()
     else:
-        return normalize_wp_title(title)
+        topic = db.session.query(Topic).filter_by(name=concept['Concept']).first()
 
-def process_workbook(workbook):
-    sheet = openpyxl.load_workbook(workbook).get_active_sheet()
+        if not topic:
+            topic = Topic(concept['Concept'])
+            db.session.add(topic)
+            db.session.flush()
+            new_wp_topics.append(topic)
 
-    for header in HEADERS:
-        if sheet.cell('%s1' % header[0]).value != header[1]:
-            print("Error : Invalid cell in spreadsheet header cell %s" % header[0])
-            sys.exit(1)
+    return topic
+
+def add_topic_categories(new_wp_topics):
+    """ Fetches categories of new topics at once """
+    fetched_categories = wikipedia.categories_batch([t.name for t in new_wp_topics])
+
+    for topic in new_wp_topics:
+        category_names = [c['title'] for c in fetched_categories[topic.name] or []]
+        topic.categories = categories_by_name(category_names)
+
+def set_unit_topic_fields(unit_topic, concept):
+    unit_topic.alias = concept['Name']
+    unit_topic.is_taught = to_bool(concept['Taught'])
+    unit_topic.is_assessed = to_bool(concept['Assessed'])
+    unit_topic.is_applied = to_bool(concept['Applied'])
+
+def process_workbook(workbook, concepts, errors):
+    """ Adds workbook rows through the ORM. Returns the number of rows added """
+    num_rows = 0
 
     # We couldn't add contexts straight away, as corresponding topics might not
     # yet be added. So we parse and save them here, and add after the topics are
     # added
     topic_contexts = [] 
 
-    for row in range(2,sheet.get_highest_row()+1):
-        if (sheet.cell('A%d' % row).value):
-            concept = dict()
+    # Categories of new topics are also fetched at once, in the end
+    new_wp_topics = []
 
-            for field in HEADERS:
-                concept[field[1]] = sheet.cell('%s%d' % (field[0], row)).value
-            
-            # FIXME: Skipping sections for now
-            if is_section(concept['Concept']):
-                continue
-            
-            # Before topic title is normalized - determine if it's custom
-            is_custom_concept = is_custom(concept['Concept'])
+    for concept in concepts:
+        unit = db.session.query(Unit).filter_by(code=concept['Unit Code']).first()
 
-            # Name might be just a duplicated identifier - we don't need it then
-            if concept['Name'] == concept['Concept']:
-                concept['Name'] = None 
+        if unit is None:
+            errors.append(RowError(workbook, concept['Row'],
+                'Unknown unit code: %s' % concept['Unit Code']))
+            continue
 
-            concept['Concept'] = normalize_title(concept['Concept'])
+        topic = get_or_add_topic(concept, new_wp_topics)
 
-            # Name might also be a normalized identifier - we don't need it either
-            if concept['Name'] == concept['Concept']:
-                concept['Name'] = None
+        unit_topic = UnitTopic(unit.id, topic.id)
+        set_unit_topic_fields(unit_topic, concept)
 
-            topic, is_topic_new = None, None
+        db.session.add(unit_topic)
+        db.session.commit()
+        num_rows += 1
 
-            if is_custom_concept:
-                topic = db.session.query(CustomTopic).filter_by(name=concept['Concept']).first()
+        concept['Unit Topic'] = unit_topic.id
 
-                is_topic_new = not topic
+        if concept['Contexts']:
+            topic_contexts.append((unit_topic.id, concept['Contexts']))
 
-                if is_topic_new:
-                    topic = CustomTopic(concept['Concept'])
-                    topic.description = 'Added from spreadsheets'
-            else:
-                topic = db.session.query(Topic).filter_by(name=concept['Concept']).first()
+    add_topic_categories(new_wp_topics)
 
-                is_topic_new = not topic
+    for unit_topic_id, contexts in topic_contexts:
+        unit_topic = db.session.query(UnitTopic).filter_by(id=unit_topic_id).one()
+        unit_topic.contexts = db.session.query(Topic).filter(Topic.name.in_(contexts)).all()
 
-                if is_topic_new:
-                    topic = Topic(concept['Concept'])
-                    topic.categories = get_categories(topic)
+    return num_rows
 
-            if is_topic_new:
-                db.session.add(topic)
-                db.session.flush()
+class BulkWriter(object):
+    """ Accumulates rows in memory and writes them with one multi-row insert
+    per table.
 
-            unit = db.session.query(Unit).filter_by(code=concept['Unit Code']).one()
+    Existing unit, topic and category ids are loaded once. Ids of new rows
+    are allocated up front, so that rows referring to each other can be
+    written without reading anything back. This assumes nothing else writes
+    to the database during the import. """
 
-            unit_topic = UnitTopic(unit.id, topic.id)
-            unit_topic.alias = concept['Name']
-            unit_topic.is_taught = to_bool(concept['Taught'])
-            unit_topic.is_assessed = to_bool(concept['Assessed'])
-            unit_topic.is_applied = to_bool(concept['Applied'])
+    def __init__(self):
+        self.unit_ids = dict(db.session.query(Unit.code, Unit.id))
+        self.topic_ids = dict(db.session.query(Topic.name, Topic.id))
+        self.category_ids = dict(db.session.query(Category.name, Category.id))
 
-            db.session.add(unit_topic)
-            db.session.commit()
+        self.next_ids = {}
+        for model in (Topic, Category, UnitTopic):
+            self.next_ids[model] = (db.session.query(func.max(model.id)).scalar() or 0) + 1
+
+        self.rows = dict((table, []) for table in (Topic.__table__, CustomTopic.__table__,
+            Category.__table__, topic_category, UnitTopic.__table__, unit_topic_context))
+
+    def _allocate_id(self, model):
+        model_id = self.next_ids[model]
+        self.next_ids[model] += 1
+        return model_id
+
+    def topic_id(self, name, is_custom):
+        """ Id of the topic with given name, adding it if needed. Returns a
+        tuple of the id and whether the topic is new """
+        if name in self.topic_ids:
+            return self.topic_ids[name], False
+
+        topic_id = self._allocate_id(Topic)
+        self.topic_ids[name] = topic_id
+
+        if is_custom:
+            self.rows[Topic.__table__].append(
+                {'id': topic_id, 'name': name, 'type': 'custom_topic'})
+            self.rows[CustomTopic.__table__].append(
+                {'id': topic_id, 'description': 'Added from spreadsheets'})
+        else:
+            self.rows[Topic.__table__].append({'id': topic_id, 'name': name, 'type': 'topic'})
+
+        return topic_id, True
+
+    def add_topic_categories(self, topic_id, category_names):
+        for name in category_names:
+            if name not in self.category_ids:
+                self.category_ids[name] = self._allocate_id(Category)
+                self.rows[Category.__table__].append({'id': self.category_ids[name], 'name': name})
+
+            self.rows[topic_category].append(
+                {'topic_id': topic_id, 'category_id': self.category_ids[name]})
+
+    def add_unit_topic(self, unit_id, topic_id, alias, is_taught, is_assessed, is_applied):
+        unit_topic_id = self._allocate_id(UnitTopic)
+
+        self.rows[UnitTopic.__table__].append({'id': unit_topic_id,
+            'unit_id': unit_id, 'topic_id': topic_id, 'alias': alias,
+            'is_taught': is_taught, 'is_assessed': is_assessed, 'is_applied': is_applied})
+
+        return unit_topic_id
+
+    def add_contexts(self, unit_topic_id, topic_ids):
+        for topic_id in topic_ids:
+            self.rows[unit_topic_context].append(
+                {'unit_topic_id': unit_topic_id, 'topic_id': topic_id})
+
+    def flush(self):
+        """ Writes accumulated rows, in the order of foreign keys """
+        for table in (Topic.__table__, CustomTopic.__table__, Category.__table__,
+                topic_category, UnitTopic.__table__, unit_topic_context):
+            if self.rows[table]:
+                db.session.execute(table.insert(), self.rows[table])
+                self.rows[table] = []
+
+def bulk_process_workbook(workbook, concepts, errors, writer):
+    """ Adds workbook rows through the bulk writer. Returns the number of rows added """
+    new_wp_topics = [] # (id, name)
+    topic_contexts = []
+    num_rows = 0
 
-            if concept['Context']:
-                contexts = concept['Context'].split()
+    for concept in concepts:
+        if concept['Unit Code'] not in writer.unit_ids:
+            errors.append(RowError(workbook, concept['Row'],
+                'Unknown unit code: %s' % concept['Unit Code']))
+            continue
 
-                # FIXME: Remove sections for now
-                contexts = itertools.ifilterfalse(is_section, contexts)
+        topic_id, is_topic_new = writer.topic_id(concept['Concept'], concept['Is Custom'])
 
-                # Normalise titles
-                contexts = map(normalize_title, contexts)
+        if is_topic_new and not concept['Is Custom']:
+            new_wp_topics.append((topic_id, concept['Concept']))
 
-                topic_contexts.append((unit_topic.id, contexts))
+        unit_topic_id = writer.add_unit_topic(writer.unit_ids[concept['Unit Code']], topic_id,
+            concept['Name'], to_bool(concept['Taught']), to_bool(concept['Assessed']),
+            to_bool(concept['Applied']))
 
-            # Some lazy progress reporting
-            sys.stdout.write('.')
-            sys.stdout.flush()
+        concept['Unit Topic'] = unit_topic_id
 
+        if concept['Contexts']:
+            topic_contexts.append((unit_topic_id, concept['Contexts']))
+
+        num_rows += 1
+
+    fetched_categories = wikipedia.categories_batch([name for _, name in new_wp_topics])
+
+    for topic_id, name in new_wp_topics:
+        writer.add_topic_categories(topic_id, [c['title'] for c in fetched_categories[name] or []])
+
+    # Same as in process_workbook, contexts which are not topics are dropped
     for unit_topic_id, contexts in topic_contexts:
-        unit_topic = db.session.query(UnitTopic).filter_by(id=unit_topic_id).one()
-        unit_topic.contexts = db.session.query(Topic).filter(Topic.name.in_(contexts)).all()
+        context_ids = set(writer.topic_ids[c] for c in contexts if c in writer.topic_ids)
+        writer.add_contexts(unit_topic_id, sorted(context_ids))
+
+    writer.flush()
+
+    return num_rows
+
+def record_workbook(workbook, checksum, concepts):
+    """ Saves checksums of an imported workbook and its rows, for
+    sync_workbook """
+    imported = ImportedWorkbook(os.path.basename(workbook), checksum)
+    db.session.add(imported)
+    db.session.flush()
+
+    rows = [{'workbook_id': imported.id, 'checksum': concept['Checksum'],
+        'unit_topic_id': concept['Unit Topic']}
+        for concept in concepts if 'Unit Topic' in concept]
+
+    if rows:
+        db.session.execute(ImportedRow.__table__.insert(), rows)
+
+Change = namedtuple('Change', ['type', 'workbook', 'row', 'unit_code', 'topic_name'])
+
+def _describe(unit_topic):
+    return unit_topic.unit.code, unit_topic.topic.name
+
+def _remove_unit_topic(unit_topic):
+    # Same as removing it through the app, the topic is removed as well if no
+    # other unit uses it
+    topic = unit_topic.topic
+
+    unit_topic.contexts = []
+    db.session.delete(unit_topic)
+    db.session.flush()
+
+    db.session.expire(topic, ['unit_topics'])
+    if not topic.unit_topics:
+        db.session.delete(topic)
+
+def sync_workbook(workbook, checksum, records, errors):
+    """ Applies changes of a workbook since it was last imported. Rows are
+    matched by their checksum, and only rows that changed are normalized.
+    Those are matched with unit topics of removed rows, or with unit topics
+    not imported from any workbook, by unit and topic. Returns a list of
+    changes """
+    name = os.path.basename(workbook)
+    imported = db.session.query(ImportedWorkbook).filter_by(name=name).first()
+
+    if imported is None:
+        imported = ImportedWorkbook(name, checksum)
+        db.session.add(imported)
+
+    imported.checksum = checksum
+
+    # Rows imported before, by checksum. Whatever remains once the current
+    # rows are matched was changed or removed
+    previous_rows = defaultdict(list)
+    for row in imported.rows:
+        previous_rows[row.checksum].append(row)
+
+    changed_records = []
+    for record in records:
+        if previous_rows[record['Checksum']]:
+            previous_rows[record['Checksum']].pop()
+        else:
+            changed_records.append(record)
+
+    stale_rows = {} # (unit id, topic id) -> [imported row]
+    for row in itertools.chain.from_iterable(previous_rows.itervalues()):
+        unit_topic = db.session.query(UnitTopic).get(row.unit_topic_id) \
+            if row.unit_topic_id is not None else None
+
+        if unit_topic is None:
+            imported.rows.remove(row)
+        else:
+            stale_rows.setdefault((unit_topic.unit_id, unit_topic.topic_id), []).append(row)
+
+    tracked_ids = db.session.query(ImportedRow.unit_topic_id).\
+        filter(ImportedRow.unit_topic_id != None)
+
+    changes = []
+    synced = [] # (unit topic, concept, is new)
+    new_wp_topics = []
+
+    for concept in load_concepts(workbook, changed_records, errors):
+        unit = db.session.query(Unit).filter_by(code=concept['Unit Code']).first()
+
+        if unit is None:
+            errors.append(RowError(workbook, concept['Row'],
+                'Unknown unit code: %s' % concept['Unit Code']))
+            continue
+
+        topic = get_or_add_topic(concept, new_wp_topics)
+
+        if stale_rows.get((unit.id, topic.id)):
+            row = stale_rows[(unit.id, topic.id)].pop()
+            row.checksum = concept['Checksum']
+
+            unit_topic = db.session.query(UnitTopic).get(row.unit_topic_id)
+            is_new = False
+        else:
+            unit_topic = db.session.query(UnitTopic).\
+                filter_by(unit_id=unit.id, topic_id=topic.id).\
+                filter(~UnitTopic.id.in_(tracked_ids)).first()
+            is_new = unit_topic is None
+
+            if is_new:
+                unit_topic = UnitTopic(unit.id, topic.id)
+                db.session.add(unit_topic)
+                db.session.flush()
+
+            imported.rows.append(ImportedRow(concept['Checksum'], unit_topic.id))
+            db.session.flush()
+
+        synced.append((unit_topic, concept, is_new))
+
+    add_topic_categories(new_wp_topics)
+
+    # Contexts are set once every new topic of the workbook is added
+    for unit_topic, concept, is_new in synced:
+        before = (unit_topic.alias, unit_topic.is_taught, unit_topic.is_assessed,
+            unit_topic.is_applied, set(t.id for t in unit_topic.contexts))
+
+        set_unit_topic_fields(unit_topic, concept)
+        unit_topic.contexts = db.session.query(Topic).\
+            filter(Topic.name.in_(concept['Contexts'] or [None])).all()
+
+        after = (unit_topic.alias, bool(unit_topic.is_taught), bool(unit_topic.is_assessed),
+            bool(unit_topic.is_applied), set(t.id for t in unit_topic.contexts))
+
+        if is_new or before != after:
+            changes.append(Change('added' if is_new else 'updated', name, concept['Row'],
+                *_describe(unit_topic)))
+
+    for row in itertools.chain.from_iterable(stale_rows.itervalues()):
+        unit_topic = db.session.query(UnitTopic).get(row.unit_topic_id)
+        changes.append(Change('removed', name, None, *_describe(unit_topic)))
 
-    print('Done')
+        imported.rows.remove(row)
+        _remove_unit_topic(unit_topic)
+
+    db.session.flush()
+
+    return changes
 
 def insert_units(units_filename):
     with open(units_filename) as f:
         for unit_line in f:
             code, name = map(str.strip, unit_line.split(',', 1))
-            unit = Unit(code,name) 
-            db.session.add(unit)
+            unit, _ = get_or_create(db.session, Unit, code=code, defaults={'name': name})
+            unit.name = name
+
+def parse_workbooks(spreadsheets, jobs):
+    """ Parses workbooks in `jobs` processes, yielding them in order """
+    # Processes only parse spreadsheets, all database writes are made by the
+    # caller in workbook order, so that ids don't depend on the number of
+    # processes
+    if jobs <= 1:
+        for parsed_workbook in itertools.imap(parse_workbook, spreadsheets):
+            yield parsed_workbook
+
+        return
+
+    pool = multiprocessing.Pool(jobs)
+
+    try:
+        for parsed_workbook in pool.imap(parse_workbook, spreadsheets):
+            yield parsed_workbook
+    finally:
+        pool.terminate()
+
+def import_data(data_dir, bulk=None, jobs=1):
+    """ Imports every workbook in data_dir. Workbooks are parsed in `jobs`
+    processes, and written one by one as they are parsed. Returns a tuple of
+    the number of rows added and the errors """
+    spreadsheets = sorted(glob.glob(os.path.join(data_dir, '*.xlsx')))
+
+    num_rows = 0
+    errors = []
+
+    writer = BulkWriter() if bulk else None
+
+    for workbook, records, workbook_errors in parse_workbooks(spreadsheets, jobs):
+        print('Processing ' + workbook)
+
+        errors.extend(workbook_errors)
+        concepts = load_concepts(workbook, records, errors)
+
+        if writer:
+            num_rows += bulk_process_workbook(workbook, concepts, errors, writer)
+
+            # Bulk inserts aren't seen by flush events
+            data_version.bump()
+        else:
+            num_rows += process_workbook(workbook, concepts, errors)
+
+        if not workbook_errors:
+            record_workbook(workbook, file_checksum(workbook), concepts)
+
+        if bulk != 'run':
+            db.session.commit()
+
+    db.session.commit()
+
+    return num_rows, errors
+
+def sync_data(data_dir, jobs=1):
+    """ Applies changes of workbooks in data_dir since they were last imported.
+    Unchanged workbooks are skipped, and rows of workbooks no longer in
+    data_dir are removed. Returns a tuple of the number of skipped workbooks,
+    the changes and the errors """
+    spreadsheets = sorted(glob.glob(os.path.join(data_dir, '*.xlsx')))
+
+    checksums = dict((os.path.basename(workbook), file_checksum(workbook))
+        for workbook in spreadsheets)
+    imported = dict(db.session.query(ImportedWorkbook.name, ImportedWorkbook.checksum))
+
+    changed_spreadsheets = [workbook for workbook in spreadsheets
+        if imported.get(os.path.basename(workbook)) != checksums[os.path.basename(workbook)]]
+
+    changes = []
+    errors = []
+
+    for workbook, records, workbook_errors in parse_workbooks(changed_spreadsheets, jobs):
+        print('Processing ' + workbook)
+
+        errors.extend(workbook_errors)
+
+        # A workbook that couldn't be read is left as it was
+        if workbook_errors:
+            continue
+
+        changes.extend(sync_workbook(workbook,
+            checksums[os.path.basename(workbook)], records, errors))
+        db.session.commit()
+
+    for name in sorted(set(imported) - set(checksums)):
+        print('Removing ' + name)
+
+        changes.extend(sync_workbook(name, None, [], errors))
+        db.session.query(ImportedWorkbook).filter_by(name=name).delete()
+        db.session.commit()
+
+    return len(spreadsheets) - len(changed_spreadsheets), changes, errors
+
+def print_errors(errors):
+    print('%d errors:' % len(errors))
+
+    for error in sorted(errors, key=lambda e: (e.workbook, e.row)):
+        print(error)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Insert initial data from spreadsheets')
 
     parser.add_argument('db_uri', help='Database URI to insert to (e.g. sqlite:///test.db)')
     parser.add_argument('data_dir', help='Directory with initial data')
+    parser.add_argument('--bulk', choices=['workbook', 'run'],
+        help='Write rows with bulk inserts, in one transaction per workbook or per run')
+    parser.add_argument('--incremental', action='store_true',
+        help='Apply only changes of spreadsheets since they were last imported, '
+            'instead of recreating the database')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help='Number of processes parsing spreadsheets (default: %(default)s)')
+    parser.add_argument('--wp-cache', default='wikipedia_cache.db',
+        help='SQLite file caching Wikipedia lookups between runs (default: %(default)s)')
     args = parser.parse_args()
 
+    if args.incremental and args.bulk:
+        parser.error('--incremental can\'t be used with --bulk')
+
     app.config['SQLALCHEMY_DATABASE_URI'] = args.db_uri 
+    app.config['WIKIPEDIA_CACHE_PATH'] = args.wp_cache
+    wikipedia.init_app(app)
 
     with app.app_context():
-        db.drop_all()
+        if not args.incremental:
+            db.drop_all()
+
         db.create_all()
 
         units_filename = os.path.join(args.data_dir, 'units.txt')
         insert_units(units_filename)
         db.session.commit()
 
-        spreadsheets = glob.glob(os.path.join(args.data_dir, '*.xlsx')) 
-        for workbook in spreadsheets:
-            print('Processing ' + workbook)
-            process_workbook(workbook)
-            db.session.commit()
+        start_time = time.time()
+
+        if args.incremental:
+            num_skipped, changes, errors = sync_data(args.data_dir, args.jobs)
+
+            for change in changes:
+                print((u'%-8s %s%s: %s %s' % (change.type, change.workbook,
+                    ', row %d' % change.row if change.row else '',
+                    change.unit_code, change.topic_name)).encode('utf-8'))
+
+            counts = dict((t, sum(1 for c in changes if c.type == t))
+                for t in ('added', 'updated', 'removed'))
+            print('Synced in %.1fs: %d unchanged workbooks skipped, '
+                '%d rows added, %d updated, %d removed' % (time.time() - start_time,
+                    num_skipped, counts['added'], counts['updated'], counts['removed']))
+        else:
+            num_rows, errors = import_data(args.data_dir, args.bulk, args.jobs)
+            elapsed = time.time() - start_time
 
+            print('Imported %d rows in %.1fs (%.1f rows/s)' % (num_rows, elapsed, num_rows / elapsed))
+
+        print('Wikipedia lookups: {hits} cached, {misses} fetched'.format(**wikipedia.stats()))
+
+        if errors:
+            print_errors(errors)
+            sys.exit(1)
@@ -0,0 +1,68 @@
+#!/usr/bin/python
+""" Compares rendering graphs as SVG with returning their layout as JSON
+(`format=json`): time to render, and size of the response, as is and gzipped.
+
+Usage: python -m benchmarks.graph_format_benchmark server.cfg """
+
+from __future__ import print_function
+
+import argparse
+import gzip
+import json
+import timeit
+from StringIO import StringIO
+
+from server.app import app
+from server.init_app import init_app
+from server.models import *
+from server.graph import SyllabusGraph
+from server.api import build_units_graph, build_unit_graph
+
+def gzipped_size(data):
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+
+    out = StringIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+        f.write(data)
+
+    return len(out.getvalue())
+
+def render_svg(build):
+    return build(SyllabusGraph(app.config['GRAPH_STYLE_PATH'])).render_svg()
+
+def render_json(build):
+    g = build(SyllabusGraph(app.config['GRAPH_STYLE_PATH'], True))
+    return json.dumps(g.render_layout(), separators=(',', ':'))
+
+def run(render, build, repeat):
+    times = []
+
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        body = render(build)
+        times.append(timeit.default_timer() - start)
+
+    times.sort()
+    return times[len(times) // 2], len(body), gzipped_size(body)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark SVG and JSON graph output')
+    parser.add_argument('config', help='Server config file (e.g. server.cfg)')
+    parser.add_argument('-n', '--repeat', type=int, default=5, help='Renders per format')
+    args = parser.parse_args()
+
+    init_app(app, args.config)
+
+    with app.app_context():
+        unit_code = db.session.query(Unit.code).order_by(Unit.code).first()[0]
+
+        graphs = [('units', build_units_graph),
+            ('unit ' + unit_code, lambda g: build_unit_graph(g, unit_code))]
+
+        print('%-16s %-5s %12s %12s %12s' % ('graph', 'fmt', 'median (s)', 'bytes', 'gzipped'))
+
+        for name, build in graphs:
+            for fmt, render in (('svg', render_svg), ('json', render_json)):
+                median, size, compressed = run(render, build, args.repeat)
+                print('%-16s %-5s %12.3f %12d %12d' % (name, fmt, median, size, compressed))
@@ -0,0 +1,166 @@
+#!/usr/bin/python
+""" Times parsing of generated spreadsheets in one or several processes, and
+writing them through the ORM or with bulk inserts.
+
+A `--wikipedia` share of generated topics are Wikipedia pages, looked up in
+a local MediaWiki stub, starting with an empty cache; the rest are custom
+topics. Each stage is run --repeat times, and its median time shown.
+Results can be written as JSON with --json.
+
+Usage: python -m benchmarks.import_benchmark [-w WORKBOOKS] [-r ROWS] [-j JOBS]
+    [-n REPEAT] [--wikipedia RATIO] [--json FILE] """
+
+from __future__ import print_function
+
+import os
+import random
+import shutil
+import argparse
+import tempfile
+import itertools
+import multiprocessing
+import timeit
+
+import openpyxl
+
+from server.app import app
+from server.models import *
+from server.wikipedia import wikipedia, MemoryCache
+from server.tests.mediawiki_stub import MediaWikiStub
+from benchmarks import results
+import add_initial_data
+
+def topic_title(i, wikipedia_ratio):
+    """ Title of the i-th generated topic, the first `wikipedia_ratio` of
+    every hundred being Wikipedia pages """
+    if i % 100 < wikipedia_ratio * 100:
+        return 'Benchmark_topic_%d' % i
+
+    return 'UOM:Benchmark_topic_%d' % i
+
+def wikipedia_pages(num_workbooks, num_rows, wikipedia_ratio):
+    """ Pages of the generated Wikipedia topics, with one or two categories
+    each """
+    num_topics = num_workbooks * num_rows // 4
+
+    return dict((MediaWikiStub.normalize(topic_title(i, wikipedia_ratio)),
+            ['Category:Benchmark category %d' % c for c in sorted(set([i % 50, i % 7]))])
+        for i in range(num_topics) if not add_initial_data.is_custom(topic_title(i, wikipedia_ratio)))
+
+def generate(data_dir, num_workbooks, num_rows, wikipedia_ratio=0, seed=0):
+    """ Writes units.txt and workbooks of num_rows rows each """
+    rand = random.Random(seed)
+    num_topics = num_workbooks * num_rows // 4
+
+    with open(os.path.join(data_dir, 'units.txt'), 'w') as f:
+        for i in range(num_workbooks):
+            f.write('BENCH%04d, Benchmark unit %d\n' % (i, i))
+
+    for i in range(num_workbooks):
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append([field for _, field in add_initial_data.HEADERS])
+
+        for _ in range(num_rows):
+            topic = topic_title(rand.randrange(num_topics), wikipedia_ratio)
+            contexts = ' '.join(topic_title(rand.randrange(num_topics), wikipedia_ratio)
+                for _ in range(rand.randrange(3)))
+
+            sheet.append([topic, None, 'BENCH%04d' % i,
+                rand.choice('yn'), rand.choice('yn'), rand.choice('yn'), contexts])
+
+        workbook.save(os.path.join(data_dir, 'bench%04d.xlsx' % i))
+
+def time_parsing(data_dir, jobs):
+    spreadsheets = sorted(os.path.join(data_dir, f)
+        for f in os.listdir(data_dir) if f.endswith('.xlsx'))
+
+    start = timeit.default_timer()
+
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        list(pool.imap(add_initial_data.parse_workbook, spreadsheets))
+        pool.terminate()
+    else:
+        list(itertools.imap(add_initial_data.parse_workbook, spreadsheets))
+
+    return timeit.default_timer() - start
+
+def time_import(data_dir, db_path, bulk, jobs):
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + db_path
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        add_initial_data.insert_units(os.path.join(data_dir, 'units.txt'))
+        db.session.commit()
+
+        # Every import looks pages up again
+        wikipedia.cache = MemoryCache()
+
+        start = timeit.default_timer()
+        num_rows, errors = add_initial_data.import_data(data_dir, bulk, jobs)
+        elapsed = timeit.default_timer() - start
+
+        db.session.remove()
+
+    assert not errors, errors
+
+    return num_rows, elapsed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark spreadsheet import')
+    parser.add_argument('-w', '--workbooks', type=int, default=16, help='Number of workbooks')
+    parser.add_argument('-r', '--rows', type=int, default=2000, help='Rows per workbook')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+        help='Number of parsing processes to compare with a single one')
+    parser.add_argument('-n', '--repeat', type=int, default=3, help='Runs of each stage')
+    parser.add_argument('--skip-orm', action='store_true',
+        help="Don't time writes through the ORM, which are slow for many rows")
+    parser.add_argument('--wikipedia', type=float, default=0.8,
+        help='Share of topics that are Wikipedia pages rather than custom topics')
+    parser.add_argument('--json', help='File to write results to')
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp()
+    stub = MediaWikiStub(wikipedia_pages(args.workbooks, args.rows, args.wikipedia)).start()
+    wikipedia.api_url = stub.url
+    report = {}
+
+    def show(name, times, num_rows):
+        # Only timings are kept, as results are compared by lower being
+        # better, and rows per second are the other way round
+        result = report[name] = dict(results.summarize(times), rows=num_rows)
+        print('%-22s %10.2f %10.2f %10.0f' % (name, result['median'], result['p90'],
+            num_rows / result['median']))
+
+    try:
+        generate(data_dir, args.workbooks, args.rows, args.wikipedia)
+        print('Workbooks: %d, rows: %d' % (args.workbooks, args.workbooks * args.rows))
+
+        print('%-22s %10s %10s %10s' % ('stage', 'median (s)', 'p90 (s)', 'rows/s'))
+
+        for jobs in sorted(set([1, args.jobs])):
+            show('parse, %d jobs' % jobs, [time_parsing(data_dir, jobs)
+                for _ in range(args.repeat)], args.workbooks * args.rows)
+
+        for bulk in ('run',) if args.skip_orm else (None, 'run'):
+            for jobs in sorted(set([1, args.jobs])):
+                times = []
+
+                for _ in range(args.repeat):
+                    del stub.requests[:]
+
+                    num_rows, elapsed = time_import(data_dir,
+                        os.path.join(data_dir, 'bench.db'), bulk, jobs)
+                    times.append(elapsed)
+
+                show('%s, %d jobs' % (bulk and 'bulk' or 'orm', jobs), times, num_rows)
+
+        print('MediaWiki requests per import: %d' % len(stub.requests))
+    finally:
+        stub.stop()
+        shutil.rmtree(data_dir)
+
+    if args.json:
+        results.write(args.json, 'import', vars(args), report)
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+""" Compares cold neato layouts of the whole-catalogue graph with layouts
+seeded from the previous render, after a single topic has been added.
+
+Usage: python -m benchmarks.layout_benchmark server.cfg """
+
+from __future__ import print_function
+
+import argparse
+import math
+import timeit
+
+from server.app import app
+from server.init_app import init_app
+from server.models import *
+from server.graph import SyllabusGraph
+from server.api import build_units_graph
+
+def build_graph(extra_topic=None):
+    g = build_units_graph(SyllabusGraph(app.config['GRAPH_STYLE_PATH']))
+
+    if extra_topic:
+        unit = db.session.query(Unit).first()
+        g.add_edge(g.add_unit_node(unit), g.add_topic_node(extra_topic))
+
+    return g
+
+def displacement(before, after):
+    """ Mean distance (in inches) that nodes present in both layouts moved """
+    common = set(before) & set(after)
+
+    if not common:
+        return 0.0
+
+    return sum(math.hypot(after[n][0] - before[n][0], after[n][1] - before[n][1])
+        for n in common) / len(common)
+
+def run(mode, previous, extra_topic, repeat):
+    times = []
+    moved = 0.0
+
+    for _ in range(repeat):
+        g = build_graph(extra_topic)
+
+        if mode != 'cold':
+            g.seed_positions(previous, pin=(mode == 'pin'))
+
+        start = timeit.default_timer()
+        g.layout(prog='neato')
+        times.append(timeit.default_timer() - start)
+
+        moved = displacement(previous, g.positions())
+
+    times.sort()
+    return times[len(times) // 2], moved
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark incremental graph layout')
+    parser.add_argument('config', help='Server config file (e.g. server.cfg)')
+    parser.add_argument('-n', '--repeat', type=int, default=5, help='Layouts per mode')
+    args = parser.parse_args()
+
+    init_app(app, args.config)
+
+    with app.app_context():
+        # A topic that is not in the database yet, as if just added
+        extra_topic = Topic('Layout benchmark topic')
+        extra_topic.id = 0
+
+        g = build_graph()
+        g.layout(prog='neato')
+        previous = g.positions()
+
+        print('Nodes: %d, edges: %d' % (g.number_of_nodes(), g.number_of_edges()))
+        print('%-6s %12s %16s' % ('mode', 'median (s)', 'mean shift (in)'))
+
+        for mode in ('cold', 'seed', 'pin'):
+            median, moved = run(mode, previous, extra_topic, args.repeat)
+            print('%-6s %12.3f %16.3f' % (mode, median, moved))
@@ -0,0 +1,99 @@
+#!/usr/bin/python
+""" Times the whole-catalogue graph in full (neato) and as a units overview
+(GRAPH_LOD_PROG, sfdp by default) on the current data scaled 10, 100 and
+1000 times. Full graphs above --max-full-nodes are skipped, as neato would
+take hours on them.
+
+Removing overlaps of large layouts needs Graphviz built with GTS (see the
+README). Without it, --overlap can set another method, such as scale, which
+Graphviz uses instead of the graph's overlap=false.
+
+Usage: python -m benchmarks.lod_benchmark server.cfg [-f FACTOR ...] [--overlap METHOD] """
+
+from __future__ import print_function
+
+import argparse
+import random
+import timeit
+
+from server.app import app
+from server.init_app import init_app
+from server.models import *
+from server.graph import SyllabusGraph
+from server.graph_data import GraphData, UnitRow, TopicRow, whole_graph
+from server.api import build_units_graph, build_units_overview
+
+def scale(data, factor, rng):
+    """ `factor` copies of every unit and topic. Each copy of a unit links to
+    a random copy of each of its topics, so topics stay shared between units
+    about as much as in the original data """
+    # Ids of copies are offset by the largest id, so they can't collide
+    unit_span = max(data.units) + 1
+    topic_span = max(data.topics) + 1
+
+    copies = GraphData()
+
+    for copy in range(factor):
+        for topic in data.topics.itervalues():
+            new_id = copy * topic_span + topic.id
+            copies.topics[new_id] = TopicRow(new_id, u'%s (%d)' % (topic.name, copy))
+
+    for copy in range(factor):
+        for unit in data.units.itervalues():
+            new_id = copy * unit_span + unit.id
+            copies.units[new_id] = UnitRow(new_id, '%s-%d' % (unit.code, copy), unit.name)
+
+    for copy in range(factor):
+        for unit_id, topic_id in data.edges:
+            copies.edges.append((copy * unit_span + unit_id,
+                rng.randrange(factor) * topic_span + topic_id))
+
+    return copies
+
+def time_layout(build, overlap=None):
+    start = timeit.default_timer()
+    g = build(SyllabusGraph(app.config['GRAPH_STYLE_PATH'], True))
+    built = timeit.default_timer()
+
+    if overlap is not None:
+        g.graph_attr['overlap'] = overlap
+
+    g.layout(prog=g.prog)
+    laid_out = timeit.default_timer()
+
+    return g.number_of_nodes(), g.number_of_edges(), built - start, laid_out - built
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the units overview graph')
+    parser.add_argument('config', help='Server config file (e.g. server.cfg)')
+    parser.add_argument('-f', '--factors', type=int, nargs='+', default=[1, 10, 100, 1000],
+        help='Sizes to try, as multiples of the current data')
+    parser.add_argument('--max-full-nodes', type=int, default=5000,
+        help='Largest full graph to lay out')
+    parser.add_argument('--overlap', help='Overlap removal to use instead of the graph\'s')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    init_app(app, args.config)
+    prog = app.config.get('GRAPH_LOD_PROG', 'sfdp')
+    max_edges = app.config.get('GRAPH_LOD_MAX_EDGES', 2000)
+
+    with app.app_context():
+        data = whole_graph()
+
+    print('%-7s %-9s %9s %9s %10s %11s' % ('factor', 'mode', 'nodes', 'edges', 'build (s)', 'layout (s)'))
+
+    for factor in args.factors:
+        scaled = scale(data, factor, random.Random(args.seed))
+
+        modes = [('overview', lambda g: build_units_overview(g, scaled, prog, max_edges))]
+
+        if len(scaled.units) + len(scaled.topics) <= args.max_full_nodes:
+            modes.insert(0, ('full', lambda g: build_units_graph(g, scaled)))
+        else:
+            print('%-7d %-9s %9d %9d %10s %11s' % (factor, 'full',
+                len(scaled.units) + len(scaled.topics), len(scaled.edges), '-', 'skipped'))
+
+        for mode, build in modes:
+            print('%-7d %-9s %9d %9d %10.3f %11.3f' % ((factor, mode) +
+                time_layout(build, args.overlap)))
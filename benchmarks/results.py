@@ -0,0 +1,87 @@
+""" Machine-readable benchmark results, to compare between commits.
+
+Results are written as JSON, with the commit they were measured at:
+
+    {"benchmark": "routes", "commit": "...", "time": ..., "params": {...},
+     "results": {"<name>": {"median": ..., ...}, ...}}
+
+`python -m benchmarks.results OLD.json NEW.json` compares two of them. """
+
+from __future__ import print_function
+
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+
+def current_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def summarize(times):
+    """ Statistics of a list of timings, in seconds """
+    times = sorted(times)
+
+    return {'runs': len(times), 'min': times[0], 'median': times[len(times) // 2],
+        'p90': times[min(len(times) - 1, len(times) * 9 // 10)], 'max': times[-1]}
+
+def write(path, benchmark, params, results):
+    report = {'benchmark': benchmark, 'commit': current_commit(), 'time': time.time(),
+        'python': platform.python_version(), 'params': params, 'results': results}
+
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+def compare(old, new, key='median'):
+    """ Rows of (name, old, new, new / old) for results in both reports.
+    Raises ValueError if no result of both has the statistic, as there
+    would be nothing to compare """
+    rows = []
+
+    for name in sorted(set(old['results']) & set(new['results'])):
+        before = old['results'][name].get(key)
+        after = new['results'][name].get(key)
+
+        if before is not None and after is not None:
+            rows.append((name, before, after, after / before if before else float('inf')))
+
+    if not rows:
+        raise ValueError('No results of both reports have %r' % key)
+
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare two benchmark results')
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('-k', '--key', default='median',
+        help='Statistic to compare, one that is lower when faster')
+    parser.add_argument('-t', '--threshold', type=float, default=1.1,
+        help='Ratio above which a result counts as a regression')
+    args = parser.parse_args()
+
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    try:
+        rows = compare(old, new, args.key)
+    except ValueError as e:
+        parser.error(str(e))
+
+    print('%s: %s -> %s' % (new['benchmark'], (old['commit'] or '?')[:10], (new['commit'] or '?')[:10]))
+    print('%-40s %12s %12s %8s' % ('result', 'old', 'new', 'ratio'))
+
+    regressions = 0
+    for name, before, after, ratio in rows:
+        flag = ' !' if ratio > args.threshold else ''
+        regressions += bool(flag)
+        print('%-40s %12.4f %12.4f %8.2f%s' % (name, before, after, ratio, flag))
+
+    sys.exit(1 if regressions else 0)
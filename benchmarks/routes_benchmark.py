@@ -0,0 +1,217 @@
+#!/usr/bin/python
+""" Times every API route through the Flask test client, on a synthetic
+syllabus (see benchmarks/synthetic.py), including each graph scope.
+
+Graphs aren't cached, so every request renders them. Results can be
+written as JSON with --json, and compared with `python -m benchmarks.results`.
+
+Usage: python -m benchmarks.routes_benchmark [-u UNITS] [-t TOPICS] [-c CATEGORIES]
+    [-b BATCH] [--db FILE] [--json FILE] """
+
+from __future__ import print_function
+
+import os
+import json
+import argparse
+import timeit
+
+from sqlalchemy import event, func
+
+from server.app import app
+from server.models import *
+from server.api import api
+from benchmarks import synthetic, results
+
+STYLE_PATH = os.path.join(os.path.dirname(__file__), '..', 'server', 'graph_style.initial.json')
+
+def sample():
+    """ Units, a topic and a category to request, the most connected ones """
+    unit_code, other_code = [code for code, in db.session.query(Unit.code).join(UnitTopic).\
+        group_by(Unit.id).order_by(func.count(UnitTopic.id).desc(), Unit.id).limit(2)]
+    topic_id, = db.session.query(UnitTopic.topic_id).group_by(UnitTopic.topic_id).\
+        order_by(func.count(UnitTopic.id).desc(), UnitTopic.topic_id).first()
+    category_id, = db.session.query(topic_category.c.category_id).\
+        group_by(topic_category.c.category_id).\
+        order_by(func.count().desc(), topic_category.c.category_id).first()
+    unit_topic_id, = db.session.query(UnitTopic.id).order_by(UnitTopic.id).first()
+
+    return unit_code, other_code, topic_id, category_id, unit_topic_id
+
+def routes(unit_code, other_code, topic_id, category_id, unit_topic_id):
+    """ (name, endpoint, method, url, JSON body) of the requests to time """
+    update = {'id': unit_topic_id, 'alias': None, 'is_assessed': True,
+        'is_taught': True, 'is_applied': False, 'contexts': [{'id': topic_id}]}
+
+    return [
+        ('units', 'units', 'GET', '/api/units', None),
+        ('units, page', 'units', 'GET', '/api/units?limit=100', None),
+        ('units, stream', 'units', 'GET', '/api/units?stream', None),
+        ('unit', 'unit', 'GET', '/api/unit/' + unit_code, None),
+        ('unit_topics', 'unit_topics', 'GET', '/api/unit_topics', None),
+        ('unit_topics, embedded', 'unit_topics', 'GET',
+            '/api/unit_topics?embed=unit,topic,contexts', None),
+        ('unit_topics, page', 'unit_topics', 'GET',
+            '/api/unit_topics?embed=unit,topic,contexts&limit=100', None),
+        ('unit_topics, stream', 'unit_topics', 'GET',
+            '/api/unit_topics?embed=unit,topic,contexts&stream', None),
+        ('unit_topics, of unit', 'unit_topics', 'GET',
+            '/api/unit_topics?embed=topic&unit_code=' + unit_code, None),
+        ('topic', 'topic', 'GET', '/api/topic/%d' % topic_id, None),
+        ('enrichment', 'enrichment', 'GET', '/api/enrichment', None),
+        ('graph', 'units_graph', 'GET', '/api/graph', None),
+        ('graph, overview', 'units_graph', 'GET', '/api/graph?detail=overview', None),
+        ('graph, json', 'units_graph', 'GET', '/api/graph?format=json', None),
+        ('graph of unit', 'unit_graph', 'GET', '/api/graph/unit/' + unit_code, None),
+        ('graph of unit, json', 'unit_graph', 'GET',
+            '/api/graph/unit/%s?format=json' % unit_code, None),
+        ('graph of topic', 'topic_graph', 'GET', '/api/graph/topic/%d' % topic_id, None),
+        ('graph of category', 'category_graph', 'GET',
+            '/api/graph/category/%d' % category_id, None),
+        ('path', 'unit_path', 'GET', '/api/path/%s/%s' % (unit_code, other_code), None),
+        ('overlap', 'units_overlap', 'GET',
+            '/api/overlap?unit_code=%s|%s' % (unit_code, other_code), None),
+        ('graph of path', 'path_graph', 'GET',
+            '/api/graph/path/%s/%s' % (unit_code, other_code), None),
+        ('graph of overlap', 'overlap_graph', 'GET',
+            '/api/graph/overlap?unit_code=%s|%s' % (unit_code, other_code), None),
+        ('update unit topic', 'update_unit_topic', 'POST', '/api/unit_topics/update', update),
+    ]
+
+def request(client, method, url, body):
+    if body is None:
+        response = client.open(url, method=method)
+    else:
+        response = client.open(url, method=method, data=json.dumps(body),
+            content_type='application/json')
+
+    assert response.status_code == 200, (url, response.status_code)
+
+    return len(response.data)
+
+def time_request(client, method, url, body, repeat):
+    statements = []
+    count = lambda *args: statements.append(None)
+
+    times = []
+    for _ in range(repeat):
+        del statements[:]
+        event.listen(db.engine, 'before_cursor_execute', count)
+
+        start = timeit.default_timer()
+        size = request(client, method, url, body)
+        times.append(timeit.default_timer() - start)
+
+        event.remove(db.engine, 'before_cursor_execute', count)
+
+    result = results.summarize(times)
+    result.update({'bytes': size, 'queries': len(statements)})
+
+    return result
+
+def time_add_remove(client, unit_code, repeat):
+    """ Adding a custom topic to a unit, and removing it """
+    add_times = []
+    remove_times = []
+
+    for i in range(repeat):
+        start = timeit.default_timer()
+        request(client, 'POST', '/api/unit_topics/add', {'unit_code': unit_code,
+            'topic_name': 'Benchmark topic %d' % i, 'topic_description': 'Benchmark'})
+        add_times.append(timeit.default_timer() - start)
+
+        unit_topic_id, = db.session.query(UnitTopic.id).join(Topic).\
+            filter(Topic.name == 'Benchmark topic %d' % i).one()
+        db.session.remove()
+
+        start = timeit.default_timer()
+        request(client, 'POST', '/api/unit_topics/remove', {'unit_topic_id': unit_topic_id})
+        remove_times.append(timeit.default_timer() - start)
+
+    return results.summarize(add_times), results.summarize(remove_times)
+
+def time_batch(client, unit_code, size, repeat):
+    """ Adding `size` custom topics to a unit with one batch, and removing
+    them with another """
+    add_times = []
+    remove_times = []
+
+    for i in range(repeat):
+        operations = [{'op': 'add', 'unit_code': unit_code, 'topic_description': 'Benchmark',
+            'topic_name': 'Benchmark batch topic %d.%d' % (i, j)} for j in range(size)]
+
+        start = timeit.default_timer()
+        response = client.post('/api/unit_topics/batch', data=json.dumps({'operations': operations}),
+            content_type='application/json')
+        add_times.append(timeit.default_timer() - start)
+
+        assert response.status_code == 200, response.data
+        operations = [{'op': 'remove', 'unit_topic_id': result['unit_topic_id']}
+            for result in json.loads(response.data)['results']]
+
+        start = timeit.default_timer()
+        request(client, 'POST', '/api/unit_topics/batch', {'operations': operations})
+        remove_times.append(timeit.default_timer() - start)
+
+    return results.summarize(add_times), results.summarize(remove_times)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark API routes')
+    parser.add_argument('-u', '--units', type=int, default=50)
+    parser.add_argument('-t', '--topics', type=int, default=500)
+    parser.add_argument('-c', '--categories', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-n', '--repeat', type=int, default=5, help='Requests per route')
+    parser.add_argument('-b', '--batch', type=int, default=20, help='Operations per batch')
+    parser.add_argument('--db', help='SQLite file to generate the data into (in memory by default)')
+    parser.add_argument('--style', default=STYLE_PATH, help='Graph style file')
+    parser.add_argument('--json', help='File to write results to')
+    args = parser.parse_args()
+
+    if args.db and os.path.exists(args.db):
+        os.remove(args.db)
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + args.db if args.db else 'sqlite://'
+    app.config['GRAPH_STYLE_PATH'] = args.style
+    app.register_blueprint(api, url_prefix='/api')
+
+    client = app.test_client()
+    report = {}
+
+    with app.app_context():
+        db.create_all()
+        counts = synthetic.generate(args.units, args.topics, args.categories, args.seed)
+        print(', '.join('%s: %d' % item for item in sorted(counts.iteritems())))
+
+        unit_code, other_code, topic_id, category_id, unit_topic_id = sample()
+
+        print('%-26s %10s %10s %8s %10s' % ('route', 'median (s)', 'p90 (s)', 'queries', 'bytes'))
+
+        def show(name, result):
+            report[name] = result
+            print('%-26s %10.4f %10.4f %8s %10s' % (name, result['median'], result['p90'],
+                result.get('queries', '-'), result.get('bytes', '-')))
+
+        timed = set(['add_unit_topic', 'remove_syllabus_item', 'unit_topics_batch'])
+
+        for name, endpoint, method, url, body in routes(unit_code, other_code, topic_id,
+                category_id, unit_topic_id):
+            show(name, time_request(client, method, url, body, args.repeat))
+            timed.add(endpoint)
+
+        add, remove = time_add_remove(client, unit_code, args.repeat)
+        show('add unit topic', add)
+        show('remove unit topic', remove)
+
+        add, remove = time_batch(client, unit_code, args.batch, args.repeat)
+        show('batch add %d topics' % args.batch, add)
+        show('batch remove %d topics' % args.batch, remove)
+
+    # Topic enrichment statuses only exist for topics added in this process
+    untimed = sorted(rule.endpoint.split('.', 1)[1] for rule in app.url_map.iter_rules()
+        if rule.endpoint.startswith(api.name + '.') and
+            rule.endpoint.split('.', 1)[1] not in timed | set(['topic_enrichment']))
+    if untimed:
+        print('Not timed: ' + ', '.join(untimed))
+
+    if args.json:
+        results.write(args.json, 'routes', vars(args), report)
@@ -0,0 +1,122 @@
+#!/usr/bin/python
+""" Times topic searches of the search index, on a synthetic syllabus (see
+benchmarks/synthetic.py) of 5000 topics by default.
+
+Synthetic topics are all named "Synthetic topic N", so that any query
+matches all of them or hardly any. Here they are renamed with one to four
+words drawn from a vocabulary with Zipf-like frequencies, as words of
+Wikipedia titles are. Searches are timed for every one and two letter
+prefix, which match the most topics, and for every prefix of sampled
+names as they would be typed.
+
+Usage: python -m benchmarks.search_benchmark [-t TOPICS] [--json FILE] """
+
+from __future__ import print_function
+
+import random
+import argparse
+import timeit
+from bisect import bisect
+
+from server.app import app
+from server.models import *
+from server.search_index import search_index
+from benchmarks import synthetic, results
+
+SYLLABLES = ['al', 'ba', 'co', 'de', 'en', 'fi', 'gra', 'hy', 'in', 'lo', 'ma', 'ne',
+    'or', 'pa', 'qu', 'ri', 'sta', 'te', 'un', 'vi', 'wa', 'xe', 'yo', 'zi']
+
+def vocabulary(rand, size):
+    words = set()
+
+    while len(words) < size:
+        words.add(''.join(rand.choice(SYLLABLES) for _ in range(rand.randint(2, 4))))
+
+    return sorted(words)
+
+def rename_topics(rand, words):
+    """ Gives every topic a name of words of the vocabulary, the nth most
+    frequent word being n times less likely than the first """
+    cumulative = [0]
+    for n in range(1, len(words) + 1):
+        cumulative.append(cumulative[-1] + 1.0 / n)
+
+    def word():
+        return words[bisect(cumulative, rand.random() * cumulative[-1]) - 1]
+
+    names = set()
+
+    for topic_id, in db.session.query(Topic.id).order_by(Topic.id):
+        name = None
+
+        while name is None or name in names:
+            name = ' '.join(word() for _ in range(rand.randint(1, 4))).capitalize()
+
+        names.add(name)
+        db.session.execute(Topic.__table__.update().where(Topic.id == topic_id).
+            values(name=name))
+
+    db.session.commit()
+
+    return sorted(names)
+
+def typed(name):
+    """ Prefixes of the name, one more letter at a time """
+    return [name[:n] for n in range(1, len(name) + 1) if name[n - 1] != ' ']
+
+def time_searches(queries, limit, repeat):
+    times = []
+
+    for query in queries:
+        times.append(min(timeit.repeat(lambda: search_index.search(query, limit),
+            repeat=repeat, number=1)))
+
+    return results.summarize(times)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark topic searches')
+    parser.add_argument('-u', '--units', type=int, default=400)
+    parser.add_argument('-t', '--topics', type=int, default=5000)
+    parser.add_argument('-c', '--categories', type=int, default=500)
+    parser.add_argument('-w', '--words', type=int, default=2000, help='Size of the vocabulary')
+    parser.add_argument('-s', '--sample', type=int, default=100, help='Names to type')
+    parser.add_argument('-l', '--limit', type=int, default=10, help='Results per search')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-n', '--repeat', type=int, default=5, help='Runs of each search')
+    parser.add_argument('--json', help='File to write results to')
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    rand = random.Random(args.seed)
+
+    with app.app_context():
+        db.create_all()
+        counts = synthetic.generate(args.units, args.topics, args.categories, args.seed)
+        print(', '.join('%s: %d' % item for item in sorted(counts.iteritems())))
+
+        names = rename_topics(rand, vocabulary(rand, args.words))
+
+        start = timeit.default_timer()
+        search_index.build()
+        print('Index built in %.2f s' % (timeit.default_timer() - start))
+
+    letters = sorted(set(c for word in search_index.postings for c in word[:1]))
+    sampled = rand.sample(names, min(args.sample, len(names)))
+
+    cases = [
+        ('one letter', letters),
+        ('two letters', sorted(set(word[:2] for word in search_index.postings if len(word) > 1))),
+        ('typed names', sorted(set(query for name in sampled for query in typed(name)))),
+    ]
+
+    report = {}
+
+    print('%-14s %8s %10s %10s %10s' % ('queries', 'number', 'median (ms)', 'p90 (ms)', 'max (ms)'))
+
+    for name, queries in cases:
+        result = report[name] = time_searches(queries, args.limit, args.repeat)
+        print('%-14s %8d %10.3f %10.3f %10.3f' % (name, result['runs'],
+            result['median'] * 1000, result['p90'] * 1000, result['max'] * 1000))
+
+    if args.json:
+        results.write(args.json, 'search', vars(args), report)
@@ -0,0 +1,83 @@
+#!/usr/bin/python
+""" Compares building a unit topic schema on every request with the
+memoized one, and dumping unit topics with the schema with dumping them
+straight from rows. Both include loading unit topics, in two queries.
+
+Usage: python -m benchmarks.serializer_benchmark [-u UNITS] [-n N] """
+
+from __future__ import print_function
+
+import argparse
+import timeit
+
+from sqlalchemy.orm import contains_eager, subqueryload
+
+from server.app import app
+from server.models import *
+from server.schemas import SchemaFactory, serializers, unit_topic_fields
+from server.api import dump_unit_topics
+
+EMBED = ('unit', 'topic', 'contexts')
+
+def populate(num_units, topics_per_unit=30):
+    """ Units with their own topics, each unit topic with two contexts """
+    for i in range(num_units):
+        unit = Unit('BENCH%04d' % i, 'Benchmark unit %d' % i)
+        topics = [Topic('Benchmark topic %d.%d' % (i, j)) for j in range(topics_per_unit)]
+
+        db.session.add(unit)
+        db.session.add_all(topics)
+        db.session.flush()
+
+        for j, topic in enumerate(topics):
+            unit_topic = UnitTopic(unit.id, topic.id)
+            unit_topic.is_taught = True
+            unit_topic.contexts = [topics[j - 1], topics[j - 2]]
+            db.session.add(unit_topic)
+
+    db.session.commit()
+
+def query():
+    return db.session.query(UnitTopic).join(Unit).join(Topic).order_by(Topic.name)
+
+def schema_dump():
+    unit_topics = query().options(contains_eager(UnitTopic.unit),
+        contains_eager(UnitTopic.topic), subqueryload(UnitTopic.contexts)).all()
+
+    return serializers.schema(UnitTopic, EMBED)(many=True).dump(unit_topics).data
+
+def row_dump():
+    return dump_unit_topics(query(), EMBED)
+
+def best(function, repeat, number=1):
+    def run():
+        try:
+            return function()
+        finally:
+            db.session.expunge_all()
+
+    return min(timeit.repeat(run, repeat=repeat, number=number)) / number
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark unit topic serialization')
+    parser.add_argument('-u', '--units', type=int, default=50, help='Number of units')
+    parser.add_argument('-n', '--repeat', type=int, default=5, help='Runs of each case')
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+
+    with app.app_context():
+        db.create_all()
+        populate(args.units)
+
+        assert schema_dump() == row_dump()
+
+        print('Unit topics: %d' % UnitTopic.query.count())
+        print('%-22s %12s' % ('case', 'time (ms)'))
+
+        for name, function, number in [
+                ('schema class, built', lambda: SchemaFactory(UnitTopic, unit_topic_fields(EMBED)), 100),
+                ('schema class, cached', lambda: serializers.schema(UnitTopic, EMBED), 100),
+                ('schema dump', schema_dump, 1),
+                ('row dump', row_dump, 1)]:
+            print('%-22s %12.3f' % (name, best(function, args.repeat, number) * 1000))
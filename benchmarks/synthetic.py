@@ -0,0 +1,89 @@
+""" Seeded generator of synthetic syllabuses, for benchmarks.
+
+Default densities follow the imported University of Manchester data: about
+12 topics per unit, a sixth of topics used by more than one unit, a third
+of a context per unit topic, two categories per topic and a few custom
+topics. The same arguments always generate the same data. """
+
+import random
+
+from server.models import *
+
+def popular(rand, n, skew=1.2):
+    """ Index in range(n), low indices being more likely, roughly following
+    Zipf's law like topic and category popularity does """
+    return min(int(rand.paretovariate(skew)) - 1, n - 1)
+
+def generate(num_units, num_topics, num_categories, seed=0, topics_per_unit=12,
+        contexts_per_unit_topic=0.33, categories_per_topic=2, custom_ratio=0.03):
+    """ Inserts units, topics, categories, unit topics and their contexts
+    into the app's database, with bulk inserts. The database should be
+    empty. Returns the numbers of rows inserted per table """
+    rand = random.Random(seed)
+
+    units = [{'id': i + 1, 'code': 'SYN%05d' % i, 'name': 'Synthetic unit %d' % i}
+        for i in range(num_units)]
+
+    # Shuffled, so that popular topics aren't the first ones by id or name
+    topic_ids = range(1, num_topics + 1)
+    rand.shuffle(topic_ids)
+
+    topics = []
+    custom_topics = []
+    for i in range(num_topics):
+        is_custom = rand.random() < custom_ratio
+
+        topics.append({'id': i + 1, 'name': ('Synthetic custom topic %d' if is_custom else
+            'Synthetic topic %d') % i, 'type': 'custom_topic' if is_custom else 'topic'})
+
+        if is_custom:
+            custom_topics.append({'id': i + 1, 'description': 'Synthetic description %d' % i})
+
+    categories = [{'id': i + 1, 'name': 'Category:Synthetic category %d' % i}
+        for i in range(num_categories)]
+
+    topic_categories = set()
+    for topic in topics:
+        for _ in range(rand.randint(1, 2 * categories_per_topic - 1)):
+            topic_categories.add((topic['id'], popular(rand, num_categories) + 1))
+
+    # Every unit gets topics of its own, and some popular topics it shares
+    unit_topics = []
+    contexts = []
+    next_own_topic = 0
+
+    for unit in units:
+        unit_topic_ids = set()
+
+        for _ in range(rand.randint(topics_per_unit // 2, topics_per_unit * 3 // 2)):
+            if rand.random() < 0.2:
+                topic_id = topic_ids[popular(rand, num_topics)]
+            else:
+                topic_id = topic_ids[next_own_topic % num_topics]
+                next_own_topic += 1
+
+            unit_topic_ids.add(topic_id)
+
+        for topic_id in sorted(unit_topic_ids):
+            unit_topic_id = len(unit_topics) + 1
+
+            unit_topics.append({'id': unit_topic_id, 'unit_id': unit['id'],
+                'topic_id': topic_id, 'alias': None, 'is_taught': rand.random() < 0.8,
+                'is_assessed': rand.random() < 0.5, 'is_applied': rand.random() < 0.3})
+
+            for _ in range(int(contexts_per_unit_topic + rand.random())):
+                contexts.append({'unit_topic_id': unit_topic_id,
+                    'topic_id': rand.choice(topic_ids)})
+
+    tables = [(Unit.__table__, units), (Topic.__table__, topics),
+        (CustomTopic.__table__, custom_topics), (Category.__table__, categories),
+        (topic_category, [{'topic_id': t, 'category_id': c} for t, c in sorted(topic_categories)]),
+        (UnitTopic.__table__, unit_topics), (unit_topic_context, contexts)]
+
+    for table, rows in tables:
+        if rows:
+            db.session.execute(table.insert(), rows)
+
+    db.session.commit()
+
+    return dict((table.name, len(rows)) for table, rows in tables)
@@ -135,6 +135,11 @@ app.factory('api', ($http, $stateParams, $sce) => // FIXME: don't use stateParam
                 unit_topic_id: id
             }),
 
+        searchTopics: query =>
+            $http.get('api/search', {
+                params: {q: query}
+            }).then(response => response.data.results.map(topic => topic.name)),
+
         fetchUnit: unitCode => $http.get(`api/unit/${unitCode}`),
 
         fetchUnitTopics: unitCode =>
@@ -222,7 +227,11 @@ app.controller('custom_topic', ($scope, $stateParams, $state, api, Notification)
 });
 
 app.controller('topic_search', ($scope, wp, api, Notification) => {
-    $scope.wpSuggestions = wp.suggestions;
+    // Topics already in the syllabus, or Wikipedia's when there are none
+    $scope.wpSuggestions = search =>
+        api.searchTopics(search).then(
+            names => names.length ? names : wp.suggestions(search),
+            () => wp.suggestions(search));
 
     $scope.wpSearch = () => {
         wp.search($scope.query).then(response => {
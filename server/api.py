@@ -4,38 +4,544 @@ from flask import *
 from models import *
 from schemas import *
 
-from graph import SyllabusGraph
+from categories import fetch_categories, get_categories
+from enrichment import category_enricher
+from graph import SyllabusGraph, postprocess_svg
+import graph_data
+from graph_index import graph_index, GraphIndex
+from search_index import search_index
+from similarity import unit_similarity
+from render_cache import graph_cache
+from layout_store import layout_store
+from instrumentation import metrics
+from render_pool import render_pool, client_disconnected, \
+    RenderError, RenderPoolFull, RenderCancelled
+import data_version
+
+from sqlalchemy import func, and_, or_
+from sqlalchemy.orm import subqueryload
+from sqlalchemy.orm.exc import NoResultFound
 
 import json
-import urllib
-from collections import Counter
+import base64
+import hashlib
+import itertools
+from collections import Counter, OrderedDict
 
 def svg_response(svg):
     return Response(svg, mimetype='image/svg+xml')
 
-def addCategoryNodes(g, topics):
-    category_topics = {}
+def graph_response(g):
+    """ Renders the graph, unless an identical one has been rendered before,
+    which is told by the X-Graph-Cache header. With `format=json`, responds
+    with its layout rather than SVG """
+    layout_mode = request.args.get('layout')
+    if layout_mode is not None and layout_mode not in layout_store.MODES:
+        abort(400)
 
-    for topic in topics:
-        for category in topic.categories:
-            category_topics.setdefault(category, set()).add(topic)
+    output_format = request.args.get('format', 'svg')
+    if output_format not in ('svg', 'json'):
+        abort(400)
 
-    for category in category_topics:
-        if len(category_topics[category]) > 1:
-            category_node = g.add_category_node(category, len(category_topics[category]))
+    minify = current_app.config.get('GRAPH_SVG_MINIFY', False)
 
-            for topic in category_topics[category]:
-                g.add_category_edge(category_node, SyllabusGraph.topic_node_name(topic))
+    if output_format == 'json':
+        flavour = 'json'
+    else:
+        flavour = 'svg' if g.is_embedded else 'html'
+        flavour += '-min' if minify else ''
+
+    with metrics.timer('graph_key'):
+        key = graph_cache.key(g, flavour)
+
+    body = graph_cache.get(key)
+    is_cached = body is not None
+
+    if not is_cached:
+        # Positions are only meaningful within the same graph
+        layout_scope = (request.path, g.is_embedded)
+
+        layout_store.seed(g, layout_scope, layout_mode)
+
+        if render_pool.enabled:
+            body = pooled_render(g, output_format, minify)
+        elif output_format == 'json':
+            data = g.render_layout()
+
+            with metrics.timer('serialize'):
+                body = json.dumps(data, separators=(',', ':'))
+        else:
+            body = g.render_svg(minify)
+
+        layout_store.record(g, layout_scope)
+
+        graph_cache.set(key, body, g.nodes())
+
+    if output_format == 'json':
+        response = Response(body, mimetype='application/json')
+    else:
+        response = svg_response(body)
+
+    response.headers['X-Graph-Cache'] = 'hit' if is_cached else 'miss'
+
+    return response
+
+def pooled_render(g, output_format, minify):
+    """ Same as rendering the graph in graph_response, with Graphviz run by
+    the render pool """
+    is_cancelled = client_disconnected()
+
+    with metrics.timer('layout'):
+        render_pool.layout(g, is_cancelled, g.prog)
+
+    if output_format == 'json':
+        data = g.layout_data()
+
+        with metrics.timer('serialize'):
+            return json.dumps(data, separators=(',', ':'))
+
+    with metrics.timer('draw'):
+        svg = render_pool.draw(g, 'svg', is_cancelled)
+
+    with metrics.timer('postprocess'):
+        return postprocess_svg(svg, minify)
+
+def invalidate_graphs(unit_topic):
+    """ Drops cached graphs which show the given unit topic """
+    topic = unit_topic.topic
+
+    tags = [SyllabusGraph.unit_node_name(unit_topic.unit),
+        SyllabusGraph.topic_node_name(topic)]
+    tags.extend(map(SyllabusGraph.category_node_name, topic.categories))
+
+    graph_cache.invalidate(tags)
+
+def graph_tags(unit_ids, topic_ids):
+    """ Tags of cached graphs which show any of the units or topics, looking
+    up categories of all the topics with one query """
+    category_ids = [category_id for category_id, in
+        db.session.query(topic_category.c.category_id).distinct().\
+            filter(topic_category.c.topic_id.in_(topic_ids))] if topic_ids else []
+
+    tags = [SyllabusGraph.node_name('unit', unit_id) for unit_id in unit_ids]
+    tags.extend(SyllabusGraph.node_name('topic', topic_id) for topic_id in topic_ids)
+    tags.extend(SyllabusGraph.node_name('category', category_id) for category_id in category_ids)
+
+    return tags
+
+def delete_orphan_topics(topic_ids):
+    """ Deletes those of the topics which no unit topic refers to any more,
+    with one statement per table rather than per topic. Meant to be called
+    once removed unit topics are flushed, which has already bumped the data
+    version. Returns ids of the deleted topics """
+    if not topic_ids:
+        return []
+
+    orphan_ids = [topic_id for topic_id, in db.session.query(Topic.id).\
+        filter(Topic.id.in_(topic_ids), ~Topic.unit_topics.any())]
+
+    if orphan_ids:
+        # Rows referring to the topics first, then the topics themselves
+        for column in [topic_category.c.topic_id, unit_topic_context.c.topic_id,
+                custom_topic_keyword.c.custom_topic_id, CustomTopic.__table__.c.id,
+                Topic.__table__.c.id]:
+            db.session.execute(column.table.delete().where(column.in_(orphan_ids)))
+
+        graph_index.record_deleted_topics(db.session, orphan_ids)
+        search_index.record_deleted_topics(db.session, orphan_ids)
+
+    return orphan_ids
+
+def addCategoryNodes(g, data, topic_ids):
+    """ Adds categories shared by more than one of the given topics """
+    category_topics = OrderedDict()
+
+    for topic_id in topic_ids:
+        for category_id in data.topic_categories.get(topic_id, ()):
+            category_topics.setdefault(category_id, set()).add(topic_id)
+
+    for category_id in category_topics:
+        if len(category_topics[category_id]) > 1:
+            category = data.categories[category_id]
+            category_node = g.add_category_node(category, len(category_topics[category_id]))
+
+            for topic_id in category_topics[category_id]:
+                g.add_category_edge(category_node,
+                    SyllabusGraph.topic_node_name(data.topics[topic_id]))
+
+def add_unit_topic_edges(g, data):
+    for unit_id, topic_id in data.edges:
+        g.add_edge(SyllabusGraph.unit_node_name(data.units[unit_id]),
+            SyllabusGraph.topic_node_name(data.topics[topic_id]))
+
+def graph_source():
+    """ In-memory index when it's enabled, the database otherwise """
+    if graph_index.enabled:
+        graph_index.check_if_due()
+        return graph_index
+
+    return graph_data
+
+@metrics.timed('graph_build')
+def build_units_graph(g, data=None):
+    if data is None:
+        data = graph_source().whole_graph()
+
+    for topic in data.topics.itervalues():
+        g.add_topic_node(topic)
+
+    for unit in data.units.itervalues():
+        g.add_unit_node(unit)
+
+    add_unit_topic_edges(g, data)
+
+    return g
+
+@metrics.timed('graph_build')
+def build_units_overview(g, data, prog='sfdp', max_edges=None):
+    """ Units of the whole graph without their topics, linked by edges
+    standing for the topics they share (the `max_edges` strongest ones).
+    Clicking a unit drills down to its own graph. Laid out with `prog`,
+    which should scale better than neato """
+    g.prog = prog
+
+    units_by_topic = {}
+    for unit_id, topic_id in data.edges:
+        units_by_topic.setdefault(topic_id, set()).add(unit_id)
+
+    shared = Counter()
+    for unit_ids in units_by_topic.itervalues():
+        unit_ids = sorted(unit_ids)
+
+        for i, unit_id in enumerate(unit_ids):
+            for other_id in unit_ids[i + 1:]:
+                shared[(unit_id, other_id)] += 1
+
+    for unit in data.units.itervalues():
+        g.add_unit_node(unit)
+
+    edges = shared.most_common(max_edges)
+
+    # Sorted, so that the same data always gives the same DOT
+    for (unit_id, other_id), num_topics in sorted(edges):
+        g.add_shared_topics_edge(SyllabusGraph.unit_node_name(data.units[unit_id]),
+            SyllabusGraph.unit_node_name(data.units[other_id]), num_topics)
+
+    return g
+
+def wants_overview(data):
+    """ Whether the whole graph should be shown as a units overview: when
+    asked to with `detail=overview`, or when it has more nodes or edges than
+    GRAPH_LOD_MAX_NODES or GRAPH_LOD_MAX_EDGES, unless `detail=full` """
+    detail = request.args.get('detail')
+    if detail is not None and detail not in ('full', 'overview'):
+        abort(400)
+
+    if detail is not None:
+        return detail == 'overview'
+
+    return len(data.units) + len(data.topics) > current_app.config.get('GRAPH_LOD_MAX_NODES', 1000) or \
+        len(data.edges) > current_app.config.get('GRAPH_LOD_MAX_EDGES', 2000)
+
+@metrics.timed('graph_build')
+def build_unit_graph(g, unit_code):
+    data = graph_source().unit_neighbourhood(unit_code)
+
+    # Central unit and its topics first, then related units
+    for unit in data.units.itervalues():
+        g.add_unit_node(unit, unit is data.central)
+
+    for topic in data.topics.itervalues():
+        g.add_topic_node(topic)
+
+    add_unit_topic_edges(g, data)
+
+    addCategoryNodes(g, data, data.unit_topic_ids(data.central.id))
+
+    return g
+
+@metrics.timed('graph_build')
+def build_topic_graph(g, topic_id):
+    data = graph_source().topic_neighbourhood(topic_id)
+
+    for topic in data.topics.itervalues():
+        g.add_topic_node(topic, topic is data.central)
+
+    for unit in data.units.itervalues():
+        g.add_unit_node(unit)
+
+    add_unit_topic_edges(g, data)
+
+    # Categories are grouped within each unit separately
+    for unit_id, topic_id in data.edges:
+        if topic_id == data.central.id:
+            addCategoryNodes(g, data, data.unit_topic_ids(unit_id))
+
+    return g
+
+@metrics.timed('graph_build')
+def build_category_graph(g, category_id):
+    data = graph_source().category_neighbourhood(category_id)
+    category = data.central
+
+    category_node = g.add_category_node(category, len(data.topics))
+
+    for topic in data.topics.itervalues():
+        topic_node = g.add_topic_node(topic)
+        g.add_category_edge(category_node, topic_node)
+
+    for unit in data.units.itervalues():
+        g.add_unit_node(unit)
+
+    add_unit_topic_edges(g, data)
+
+    return g
+
+@metrics.timed('graph_build')
+def build_path_graph(g, path):
+    """ Nodes of the path alone, its end units as central ones """
+    nodes = []
+
+    for i, (kind, row) in enumerate(path):
+        if kind == 'unit':
+            node = g.add_unit_node(row, i in (0, len(path) - 1))
+        elif kind == 'topic':
+            node = g.add_topic_node(row)
+        else:
+            node = g.add_category_node(row, 1)
+
+        nodes.append((kind, node))
+
+    for (kind, node), (next_kind, next_node) in zip(nodes, nodes[1:]):
+        # Edges go from units and categories to topics, as in other graphs
+        source, target = (node, next_node) if next_kind == 'topic' else (next_node, node)
+
+        if 'category' in (kind, next_kind):
+            g.add_category_edge(source, target)
+        else:
+            g.add_edge(source, target)
+
+    return g
+
+@metrics.timed('graph_build')
+def build_overlap_graph(g, data):
+    for unit in data.units.itervalues():
+        g.add_unit_node(unit, True)
+
+    for topic in data.topics.itervalues():
+        g.add_topic_node(topic)
+
+    add_unit_topic_edges(g, data)
+
+    addCategoryNodes(g, data, data.topics.keys())
+
+    return g
 
 api = Blueprint('syl_vis_api', __name__)
 
+# Timings of the request, registered first so that they cover other hooks
+
+@api.before_request
+def start_timing():
+    metrics.start_request()
+
+@api.after_request
+def add_server_timing(response):
+    metrics.finish_request(request.endpoint, response)
+    return response
+
+@api.errorhandler(RenderError)
+def render_failed(e):
+    """ Busy or failed render pool. Full queues ask clients to come back """
+    if isinstance(e, RenderPoolFull):
+        response = Response(str(e), status=503, mimetype='text/plain')
+        response.headers['Retry-After'] = str(render_pool.retry_after)
+        return response
+
+    # Nobody is listening for cancelled renders
+    if isinstance(e, RenderCancelled):
+        return Response(status=503)
+
+    current_app.logger.error('Graph render failed: %s', e)
+
+    return Response(str(e), status=503, mimetype='text/plain')
+
+# Responses to GET requests are identified by the data version and the URL.
+# Clients and proxies revalidate them with If-None-Match, which is answered
+# before the view runs
+
+def unversioned(view):
+    """ Marks a view whose responses change without the data version changing """
+    view.is_unversioned = True
+    return view
+
+def request_etag():
+    """ Strong ETag of the response to the request, None if it has none """
+    if request.method not in ('GET', 'HEAD'):
+        return None
+
+    view = current_app.view_functions.get(request.endpoint)
+    if view is None or getattr(view, 'is_unversioned', False):
+        return None
+
+    key = u'%d %s' % (data_version.current(), request.full_path)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+@api.before_request
+def check_etag():
+    g.etag = request_etag()
+
+    if g.etag is not None and g.etag in request.if_none_match:
+        return Response(status=304)
+
+@api.after_request
+def add_cache_headers(response):
+    etag = getattr(g, 'etag', None)
+
+    if etag is not None and response.status_code in (200, 304):
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config.get('API_CACHE_MAX_AGE', 0)
+        response.cache_control.must_revalidate = True
+
+    return response
+
+# Listings can be paged with `limit`, continuing `after` the cursor returned
+# as `next` with the previous page, and streamed with `stream`
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values))
+
+def decode_cursor(cursor, num_values):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError, UnicodeError):
+        abort(400)
+
+    if not isinstance(values, list) or len(values) != num_values:
+        abort(400)
+
+    return values
+
+def keyset_filter(columns, values):
+    """ Rows ordered by the columns after the row with the given values """
+    clauses = []
+
+    for i, column in enumerate(columns):
+        equal = [c == v for c, v in zip(columns[:i], values[:i])]
+        clauses.append(and_(*(equal + [column > values[i]])))
+
+    return or_(*clauses)
+
+def batches(rows, size):
+    rows = iter(rows)
+
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+
+        yield batch
+
+def listing_response(name, query, order_columns, dump_rows, load_related=None):
+    """ Responds with dumped rows of the query, a page of them if `limit` is
+    given. Rows of a page are ordered by order_columns, which have to make the
+    order unique. dump_rows is given lists of rows, with values of
+    order_columns appended to each. If load_related is given, it is called
+    with the same lists first, to query whatever else is dumped with them,
+    and dump_rows is also given its result """
+    limit = request.args.get('limit', type=int)
+    if 'limit' in request.args and (limit is None or limit < 1):
+        abort(400)
+
+    query = query.add_columns(*order_columns)
+    num_order_values = len(order_columns)
+
+    if limit is not None:
+        query = query.order_by(*order_columns)
+
+        if 'after' in request.args:
+            values = decode_cursor(request.args['after'], num_order_values)
+            query = query.filter(keyset_filter(order_columns, values))
+
+        # One more row tells whether there is a next page
+        query = query.limit(limit + 1)
+
+    def next_cursor(rows):
+        if limit is not None and len(rows) > limit:
+            return encode_cursor(list(rows[limit - 1][-num_order_values:]))
+
+        return None
+
+    def loader(rows):
+        """ Function dumping the rows, once what they need is loaded """
+        if load_related is None:
+            return lambda: dump_rows(rows)
+
+        related = load_related(rows)
+        return lambda: dump_rows(rows, related)
+
+    if 'stream' not in request.args:
+        # Queries are made before serialising is timed
+        rows = query.all()
+        dump = loader(rows[:limit])
+
+        with metrics.timer('serialize'):
+            data = {name: dump()}
+
+            if limit is not None:
+                data['next'] = next_cursor(rows)
+
+            return jsonify(data)
+
+    batch_size = current_app.config.get('API_STREAM_BATCH_SIZE', 500)
+
+    def generate():
+        # Only a batch of rows is held at once
+        rows = query.execution_options(stream_results=True).yield_per(batch_size)
+        num_rows = 0
+        last_row = None
+        has_next = False
+
+        yield '{"%s": [' % name
+
+        for batch in batches(rows, batch_size):
+            if limit is not None and num_rows + len(batch) > limit:
+                has_next = True
+                batch = batch[:limit - num_rows]
+
+            for item in loader(batch)():
+                yield (', ' if num_rows else '') + json.dumps(item, sort_keys=True)
+                num_rows += 1
+
+            if batch:
+                last_row = batch[-1]
+
+        yield ']'
+
+        if limit is not None:
+            cursor = encode_cursor(list(last_row[-num_order_values:])) if has_next else None
+            yield ', "next": %s' % json.dumps(cursor)
+
+        yield '}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
 @api.route("/units")
 def units():
-    units = Unit.query.all()
+    topic_counts = db.session.query(UnitTopic.unit_id,
+            func.count(UnitTopic.id).label('num_topics')).\
+        group_by(UnitTopic.unit_id).subquery()
 
-    unit_schema = UnitSchemaWithCount(many=True)
+    query = db.session.query(Unit.id, Unit.code, Unit.name,
+            func.coalesce(topic_counts.c.num_topics, 0)).\
+        outerjoin(topic_counts, topic_counts.c.unit_id == Unit.id).\
+        order_by(Unit.id)
 
-    return jsonify({'units': unit_schema.dump(units).data})
+    dumper = serializers.row_dumper(UnitSchemaWithCount, ['id', 'code', 'name', 'num_topics'])
+
+    return listing_response('units', query, [Unit.id],
+        lambda rows: [dumper.dump(row) for row in rows])
 
 
 @api.route("/unit/<string:unit_code>", methods=['GET'])
@@ -46,40 +552,127 @@ def unit(unit_code):
 
     return jsonify({'unit': unit_schema.dump(unit).data})
 
+@api.route("/unit/<string:unit_code>/similar")
+def similar_units(unit_code):
+    """ Units with the most similar topics, see similarity.UnitSimilarity """
+    if not unit_similarity.enabled:
+        abort(404)
+
+    limit = request.args.get('limit', 10, type=int)
+    if limit < 1:
+        abort(400)
+
+    unit = db.session.query(Unit.id).filter_by(code=unit_code).first()
+    if unit is None:
+        abort(404)
+
+    unit_similarity.check_if_due()
+    similar = unit_similarity.similar(unit.id, limit)
+
+    units = dict((unit.id, unit) for unit in
+        Unit.query.filter(Unit.id.in_([row[0] for row in similar]))) if similar else {}
+
+    unit_schema = UnitSchema()
+
+    return jsonify({'similar_units': [{'unit': unit_schema.dump(units[other_id]).data,
+            'score': round(score, 4), 'shared_topics': num_shared}
+        for other_id, score, num_shared in similar if other_id in units]})
+
 @api.route("/unit_topics", methods=['GET'])
 def unit_topics():
     query = db.session.query(UnitTopic).join(Unit).join(Topic)
+    order_columns = []
 
     # TODO: find by unit_id, topic_id
 
     if 'unit_code' in request.args:
         unit_code = request.args['unit_code'].split('|')
         query = query.filter(Unit.code.in_(unit_code)).order_by(Topic.name)
+        order_columns.append(Topic.name)
 
     if 'topic_name' in request.args:
         topic_name = request.args['topic_name'].split('|')
         query = query.filter(Topic.name.in_(topic_name)).order_by(Unit.name)
+        order_columns.append(Unit.name)
+
+    embed = request.args['embed'].split(',') if 'embed' in request.args else []
+
+    if 'limit' not in request.args and 'stream' not in request.args:
+        rows, contexts = load_unit_topics(query, embed)
+
+        with metrics.timer('serialize'):
+            return jsonify({'unit_topics': dump_unit_topic_rows(rows, contexts, embed)})
+
+    columns, entities = unit_topic_columns(embed)
+
+    return listing_response('unit_topics', query.with_entities(*entities),
+        order_columns + [UnitTopic.id],
+        lambda rows, contexts: dump_unit_topic_rows(rows, contexts, embed),
+        lambda rows: load_contexts([row[0] for row in rows], embed) if rows else {})
+
+def unit_topic_columns(embed):
+    """ Names of columns for the unit topic dumper, and columns to select """
+    columns = ['id', 'alias', 'is_taught', 'is_assessed', 'is_applied']
+    entities = [UnitTopic.id, UnitTopic.alias,
+        UnitTopic.is_taught, UnitTopic.is_assessed, UnitTopic.is_applied]
+
+    if 'unit' in embed:
+        columns.extend(['unit.id', 'unit.code', 'unit.name'])
+        entities.extend([Unit.id, Unit.code, Unit.name])
+    else:
+        columns.append('unit')
+        entities.append(UnitTopic.unit_id)
+
+    if 'topic' in embed:
+        columns.extend(['topic.id', 'topic.name', 'topic.type'])
+        entities.extend([Topic.id, Topic.name, Topic.type])
+    else:
+        columns.append('topic')
+        entities.append(UnitTopic.topic_id)
+
+    if 'contexts' in embed:
+        columns.extend(['contexts.id', 'contexts.name', 'contexts.type'])
+
+    return columns, entities
 
-    unit_topics = query.all()
+def load_contexts(unit_topic_ids, embed):
+    """ Contexts of the unit topics, with one query, in the same order as the
+    relationship loads them. unit_topic_ids can be a list or a subquery """
+    contexts = {}
+    context_entities = [Topic.id]
 
-    schema_fields = {}
+    if 'contexts' in embed:
+        context_entities.extend([Topic.name, Topic.type])
 
-    if 'embed' in request.args:
-        embed = request.args['embed'].split(',')
+    for row in db.session.query(unit_topic_context.c.unit_topic_id, *context_entities).\
+            join(Topic, Topic.id == unit_topic_context.c.topic_id).\
+            filter(unit_topic_context.c.unit_topic_id.in_(unit_topic_ids)).\
+            order_by(unit_topic_context.c.unit_topic_id):
+        contexts.setdefault(row[0], []).append(row[1:] if 'contexts' in embed else row[1])
 
-        if 'topic' in embed:
-            schema_fields['topic'] = fields.Nested(TopicSchema)
+    return contexts
 
-        if 'unit' in embed:
-            schema_fields['unit'] = fields.Nested(UnitSchema)
+def dump_unit_topic_rows(rows, contexts, embed):
+    """ Dumps rows of unit_topic_columns, with contexts from load_contexts """
+    columns, _ = unit_topic_columns(embed)
+    dumper = serializers.dumper(UnitTopic, embed, columns)
 
-        if 'contexts' in embed:
-            schema_fields['contexts'] = fields.Nested(TopicSchema, many=True)
+    return [dumper.dump(row, contexts=contexts.get(row[0], [])) for row in rows]
 
-    Schema = SchemaFactory(UnitTopic, schema_fields)
-    schema = Schema(many=True)
+def load_unit_topics(query, embed):
+    """ Rows of unit_topic_columns of the query's unit topics, and their
+    contexts, with two queries """
+    _, entities = unit_topic_columns(embed)
+    contexts = load_contexts(query.with_entities(UnitTopic.id).subquery(), embed)
 
-    return jsonify({'unit_topics': schema.dump(unit_topics).data})
+    return query.with_entities(*entities).all(), contexts
+
+def dump_unit_topics(query, embed):
+    """ Same as dumping unit topics of the query with their schema, but
+    built straight from rows of the needed columns """
+    rows, contexts = load_unit_topics(query, embed)
+
+    return dump_unit_topic_rows(rows, contexts, embed)
 
 @api.route("/topic/<string:topic_id>")
 def topic(topic_id):
@@ -90,42 +683,45 @@ def topic(topic_id):
 
     return jsonify({'topic': topic_schema.dump(topic).data})
 
-def fetch_categories(topic_name):
-    params = urllib.urlencode({
-        'action': 'query',
-        'prop': 'categories',
-        'format': 'json',
-        'clshow': '!hidden',
-        'cllimit': 'max',
-        'titles': unicode(topic_name).encode('utf-8'),
-        'indexpageids': True})
-    f = urllib.urlopen("http://en.wikipedia.org/w/api.php?{}".format(params))
-    responce = json.load(f)
+@api.route("/search")
+def search():
+    """ Topics matching the words of `q`, as suggestions while it is typed """
+    if not search_index.enabled:
+        abort(404)
 
-    pageid = responce['query']['pageids'][0]
+    limit = request.args.get('limit', 10, type=int)
+    if limit < 1:
+        abort(400)
 
-    if pageid != '-1':
-        page = responce['query']['pages'][pageid]
+    search_index.check_if_due()
 
-        if 'categories' in page:
-            return page['categories']
+    with metrics.timer('search'):
+        results = search_index.search(request.args.get('q', u''), min(limit, 100))
 
-    return []
+    return jsonify({'results': results})
 
-def get_categories(topic):
-    fetched_categories = fetch_categories(topic.name)
-    category_names = map(lambda x: x['title'], fetched_categories)
+@api.route("/topic/<int:topic_id>/enrichment")
+@unversioned
+def topic_enrichment(topic_id):
+    status = category_enricher.status(topic_id)
 
-    if category_names:
-        existing_categories = Category.query.filter(Category.name.in_(category_names)).all()
-        existing_names = map(lambda x: x.name, existing_categories)
+    if status is None:
+        abort(404)
 
-        new_categories = [Category(name) for name in category_names if name not in existing_names]
-        map(db.session.add, new_categories)
+    return jsonify({'enrichment': status})
 
-        return existing_categories + new_categories
-    else:
-        return []
+@api.route("/enrichment")
+@unversioned
+def enrichment():
+    return jsonify({'enrichment': category_enricher.stats()})
+
+@api.route("/metrics")
+@unversioned
+def metrics_histograms():
+    if not metrics.enabled:
+        abort(404)
+
+    return jsonify({'metrics': metrics.snapshot()})
 
 @api.route("/unit_topics/add", methods=['POST'])
 def add_unit_topic():
@@ -147,7 +743,7 @@ def add_unit_topic():
             # TODO: topic.keywords = request.form["keywords"].split(',')
         else: # WP topic
             topic = Topic(name=topic_name)
-            topic.categories = get_categories(topic)
+            # Categories are fetched in the background, once committed
 
         db.session.add(topic)
         db.session.flush() # So that we have access to id
@@ -161,6 +757,11 @@ def add_unit_topic():
 
     db.session.commit()
 
+    invalidate_graphs(unit_topic)
+
+    if is_new and not isinstance(topic, CustomTopic):
+        category_enricher.enqueue(topic.id, topic.name)
+
     return ''
 
 @api.route("/unit_topics/update", methods=['POST'])
@@ -179,6 +780,8 @@ def update_unit_topic():
 
     db.session.commit()
 
+    invalidate_graphs(unit_topic)
+
     return ''
 
 @api.route("/unit_topics/remove", methods=['POST'])
@@ -187,92 +790,336 @@ def remove_syllabus_item():
     unit_topic_id = (request.get_json())['unit_topic_id']
     unit_topic = db.session.query(UnitTopic).get(unit_topic_id)
 
+    # Has to be done while relationships are still loadable
+    invalidate_graphs(unit_topic)
+
     db.session.delete(unit_topic)
+    db.session.flush()
 
     # If topic doesn't relate to more units -- delete it as well
-    if len(unit_topic.topic.unit_topics) == 0:
-        db.session.delete(unit_topic.topic)
+    delete_orphan_topics([unit_topic.topic_id])
 
     db.session.commit()
 
     return ''
 
-@api.route("/graph")
-def units_graph():
-    topics = db.session.query(Topic).all()
+BATCH_OPERATIONS = ('add', 'update', 'remove')
 
-    raw_svg = request.args.has_key('svg')
+class BatchError(Exception):
+    pass
 
-    g = SyllabusGraph(current_app.config['GRAPH_STYLE_PATH'], raw_svg)
-    for topic in topics:
-        topic_node = g.add_topic_node(topic)
+def batch_id(value):
+    """ Ids can be given as numbers or strings of digits """
+    if isinstance(value, basestring) and value.isdigit():
+        return int(value)
+    if isinstance(value, (int, long)) and not isinstance(value, bool):
+        return value
 
-        for unit_topic in topic.unit_topics:
-            unit_node = g.add_unit_node(unit_topic.unit)
-            g.add_edge(unit_node, topic_node)
+    raise ValueError()
 
-    return svg_response(g.render_svg())
+def batch_text(value):
+    if not isinstance(value, basestring):
+        raise ValueError()
 
-@api.route("/graph/unit/<string:unit_code>")
-def unit_graph(unit_code):
-    unit = db.session.query(Unit).filter_by(code=unit_code).one()
+    return value
 
-    raw_svg = request.args.has_key('svg')
+def batch_optional_text(value):
+    return None if value is None else batch_text(value)
 
-    g = SyllabusGraph(current_app.config['GRAPH_STYLE_PATH'], raw_svg)
-    unit_node = g.add_unit_node(unit, unit.code == unit_code)
-    for unit_topic in unit.unit_topics:
-        topic_node = g.add_topic_node(unit_topic.topic)
-        g.add_edge(unit_node, topic_node)
+def batch_flag(value):
+    if not isinstance(value, bool):
+        raise ValueError()
 
-        # Add related units
-        for related_unit_topic in unit_topic.topic.unit_topics:
-            related_unit_node = g.add_unit_node(related_unit_topic.unit)
-            g.add_edge(related_unit_node, topic_node)
+    return value
 
-    addCategoryNodes(g, [ut.topic for ut in unit.unit_topics])
+def batch_contexts(value):
+    if not isinstance(value, list) or \
+            not all(isinstance(context, dict) and 'id' in context for context in value):
+        raise ValueError()
 
-    return svg_response(g.render_svg())
+    return [{'id': batch_id(context['id'])} for context in value]
 
+# Fields of each operation, how they are checked, and whether they are required
+BATCH_FIELDS = {
+    'add': [('unit_code', batch_text, True), ('topic_name', batch_text, True),
+        ('topic_description', batch_optional_text, False)],
+    'update': [('id', batch_id, True), ('alias', batch_optional_text, True),
+        ('is_assessed', batch_flag, True), ('is_taught', batch_flag, True),
+        ('is_applied', batch_flag, True), ('contexts', batch_contexts, True)],
+    'remove': [('unit_topic_id', batch_id, True)],
+}
 
-@api.route("/graph/topic/<string:topic_id>")
-def topic_graph(topic_id):
+def validate_batch_operation(operation):
+    """ The operation with only its own fields, checked and with ids made
+    ints, so that they can be looked up. Raises BatchError otherwise """
+    if not isinstance(operation, dict) or operation.get('op') not in BATCH_OPERATIONS:
+        raise BatchError('Unknown operation')
 
-    topic = db.session.query(Topic).get(topic_id)
+    valid = {'op': operation['op']}
 
-    raw_svg = request.args.has_key('svg')
-    g = SyllabusGraph(current_app.config['GRAPH_STYLE_PATH'], raw_svg)
-    topic_node = g.add_topic_node(topic, True)
-    addCategoryNodes(g, [topic])
+    for key, check, is_required in BATCH_FIELDS[operation['op']]:
+        if key not in operation:
+            if is_required:
+                raise BatchError('Missing %s' % key)
+            continue
 
-    for unit_topic in topic.unit_topics:
-        unit_node = g.add_unit_node(unit_topic.unit)
-        g.add_edge(unit_node, topic_node)
+        try:
+            valid[key] = check(operation[key])
+        except ValueError:
+            raise BatchError('Invalid %s' % key)
 
-        for related_unit_topic in unit_topic.unit.unit_topics:
-            related_topic_node = g.add_topic_node(related_unit_topic.topic)
-            g.add_edge(unit_node, related_topic_node)
+    return valid
 
-        addCategoryNodes(g, [ut.topic for ut in unit_topic.unit.unit_topics])
+@api.route("/unit_topics/batch", methods=['POST'])
+def unit_topics_batch():
+    """ Adds, updates and removes unit topics, given a list of operations
+    with the same arguments as /unit_topics/add, /update and /remove and an
+    `op` of "add", "update" or "remove". Units, topics, unit topics and
+    contexts of all operations are looked up together, and all operations
+    are applied in one transaction - or none of them, if any fails.
 
-    return svg_response(g.render_svg())
+    Responds with a result per operation: the id of the unit topic added,
+    updated or removed, or an error. """
+    args = request.get_json()
+    operations = args.get('operations') if isinstance(args, dict) else None
 
-@api.route("/graph/category/<string:category_id>")
-def category_graph(category_id):
+    if not isinstance(operations, list):
+        abort(400)
 
-    category = db.session.query(Category).get(category_id)
+    results = [None] * len(operations)
 
-    raw_svg = request.args.has_key('svg')
-    g = SyllabusGraph(current_app.config['GRAPH_STYLE_PATH'], raw_svg)
+    def fail(i, message):
+        results[i] = {'status': 'error', 'error': message}
 
-    category_node = g.add_category_node(category, len(category.topics))
+    # Invalid operations are left out of the lookups, as None
+    for i, operation in enumerate(operations):
+        try:
+            operations[i] = validate_batch_operation(operation)
+        except BatchError as e:
+            operations[i] = None
+            fail(i, e.args[0])
 
-    for topic in category.topics:
-        topic_node = g.add_topic_node(topic)
-        g.add_category_edge(category_node, topic_node)
+    # Look up everything the operations refer to
+
+    def values(op, key):
+        return set(operation[key] for operation in operations
+            if operation is not None and operation['op'] == op and key in operation)
+
+    unit_ids = dict(db.session.query(Unit.code, Unit.id).\
+        filter(Unit.code.in_(values('add', 'unit_code')))) if values('add', 'unit_code') else {}
+
+    topic_names = values('add', 'topic_name')
+    topics = dict(db.session.query(Topic.name, Topic).\
+        filter(Topic.name.in_(topic_names))) if topic_names else {}
+
+    unit_topic_ids = values('update', 'id') | values('remove', 'unit_topic_id')
+    unit_topics = dict((unit_topic.id, unit_topic) for unit_topic in
+        db.session.query(UnitTopic).options(subqueryload(UnitTopic.contexts)).\
+            filter(UnitTopic.id.in_(unit_topic_ids))) if unit_topic_ids else {}
+
+    context_ids = set(context['id'] for operation in operations
+        if operation is not None and operation['op'] == 'update'
+        for context in operation['contexts'])
+    contexts = dict((topic.id, topic) for topic in
+        Topic.query.filter(Topic.id.in_(context_ids))) if context_ids else {}
+
+    # Apply them
+
+    new_topics = []
+    added = []
+    removed = set()
+    changed_units = set()
+    changed_topics = set()
+
+    for i, operation in enumerate(operations):
+        if operation is None:
+            continue
+
+        try:
+            if operation['op'] == 'add':
+                unit_id = unit_ids.get(operation['unit_code'])
+                if unit_id is None:
+                    raise BatchError('Unknown unit %s' % operation['unit_code'])
+
+                topic = topics.get(operation['topic_name'])
+
+                if topic is None:
+                    if operation.has_key('topic_description'): # Custom topic
+                        topic = CustomTopic(name=operation['topic_name'])
+                        topic.description = operation['topic_description']
+                    else: # WP topic
+                        topic = Topic(name=operation['topic_name'])
+
+                    topics[topic.name] = topic
+                    new_topics.append(topic)
+
+                unit_topic = UnitTopic(unit_id, None)
+                unit_topic.topic = topic
+                added.append((i, unit_topic))
+
+                changed_units.add(unit_id)
+                continue
+
+            unit_topic_id = operation['id' if operation['op'] == 'update' else 'unit_topic_id']
+            unit_topic = unit_topics.get(unit_topic_id)
+
+            if unit_topic is None or unit_topic_id in removed:
+                raise BatchError('Unknown unit topic %s' % unit_topic_id)
+
+            if operation['op'] == 'update':
+                unit_topic.alias = operation['alias']
+                unit_topic.is_assessed = operation['is_assessed']
+                unit_topic.is_taught = operation['is_taught']
+                unit_topic.is_applied = operation['is_applied']
+
+                unit_topic.contexts = [contexts[context['id']]
+                    for context in operation['contexts'] if context['id'] in contexts]
+            else:
+                db.session.delete(unit_topic)
+                removed.add(unit_topic_id)
+
+            changed_units.add(unit_topic.unit_id)
+            changed_topics.add(unit_topic.topic_id)
 
-        for unit_topic in topic.unit_topics:
-            unit_node = g.add_unit_node(unit_topic.unit)
-            g.add_edge(unit_node, topic_node)
+            results[i] = {'status': 'ok', 'unit_topic_id': unit_topic_id}
 
-    return svg_response(g.render_svg())
+        except BatchError as e:
+            fail(i, e.args[0])
+
+    if any(result is not None and result['status'] == 'error' for result in results):
+        db.session.rollback()
+
+        return jsonify({'results': [result if result is not None and
+            result['status'] == 'error' else {'status': 'skipped'} for result in results]}), 400
+
+    db.session.add_all(unit_topic for _, unit_topic in added)
+    db.session.flush()
+
+    for i, unit_topic in added:
+        results[i] = {'status': 'ok', 'unit_topic_id': unit_topic.id}
+        changed_topics.add(unit_topic.topic_id)
+
+    # Categories of orphan topics can't be looked up once they are deleted
+    tags = graph_tags(changed_units, changed_topics)
+
+    delete_orphan_topics(set(unit_topics[unit_topic_id].topic_id for unit_topic_id in removed))
+
+    db.session.commit()
+
+    graph_cache.invalidate(tags)
+
+    for topic in new_topics:
+        if not isinstance(topic, CustomTopic):
+            category_enricher.enqueue(topic.id, topic.name)
+
+    return jsonify({'results': results})
+
+def new_graph():
+    # Layouts are of graphs with plain labels, same as raw SVG
+    raw_svg = request.args.has_key('svg') or request.args.get('format') == 'json'
+
+    return SyllabusGraph(current_app.config['GRAPH_STYLE_PATH'], raw_svg)
+
+@api.route("/graph")
+def units_graph():
+    data = graph_source().whole_graph()
+
+    if wants_overview(data):
+        g = build_units_overview(new_graph(), data,
+            current_app.config.get('GRAPH_LOD_PROG', 'sfdp'),
+            current_app.config.get('GRAPH_LOD_MAX_EDGES', 2000))
+    else:
+        g = build_units_graph(new_graph(), data)
+
+    return graph_response(g)
+
+@api.route("/graph/unit/<string:unit_code>")
+def unit_graph(unit_code):
+    return graph_response(build_unit_graph(new_graph(), unit_code))
+
+@api.route("/graph/topic/<string:topic_id>")
+def topic_graph(topic_id):
+    return graph_response(build_topic_graph(new_graph(), topic_id))
+
+@api.route("/graph/category/<string:category_id>")
+def category_graph(category_id):
+    return graph_response(build_category_graph(new_graph(), category_id))
+
+# Paths can't be found with a fixed number of queries, so when the graph index
+# is disabled they are searched in this one, built on the first path request
+# and rebuilt only once the data version has changed
+path_fallback_index = GraphIndex()
+path_fallback_index.version = None
+
+def path_index():
+    """ The graph index, or the fallback one when it's disabled """
+    if graph_index.enabled:
+        graph_index.check_if_due()
+        return graph_index
+
+    version = data_version.current()
+
+    with path_fallback_index.lock:
+        if path_fallback_index.version is None or path_fallback_index.version != version:
+            path_fallback_index.build()
+            path_fallback_index.version = version
+
+    return path_fallback_index
+
+def unit_path_or_404(source_code, target_code):
+    """ Shortest path between the units, through categories too unless
+    `topics_only` is given """
+    try:
+        return path_index().unit_path(source_code, target_code,
+            request.args.has_key('topics_only'))
+    except NoResultFound:
+        abort(404)
+
+def units_overlap_or_404():
+    """ Topics shared by units given as `unit_code=CODE|CODE|...`, or by at
+    least `min_units` of them """
+    unit_codes = set(request.args.get('unit_code', '').split('|')) - set([''])
+    min_units = request.args.get('min_units', type=int)
+
+    if len(unit_codes) < 2 or 'min_units' in request.args and \
+            (min_units is None or not 1 <= min_units <= len(unit_codes)):
+        abort(400)
+
+    try:
+        return graph_source().units_overlap(unit_codes, min_units)
+    except NoResultFound:
+        abort(404)
+
+@api.route("/path/<string:source_code>/<string:target_code>")
+def unit_path(source_code, target_code):
+    path = unit_path_or_404(source_code, target_code)
+
+    if path is not None:
+        path = [dict(row._asdict(), type=kind) for kind, row in path]
+
+    return jsonify({'path': path, 'length': path and len(path) - 1})
+
+@api.route("/overlap")
+def units_overlap():
+    data = units_overlap_or_404()
+
+    topic_units = {}
+    for unit_id, topic_id in data.edges:
+        topic_units.setdefault(topic_id, []).append(data.units[unit_id].code)
+
+    return jsonify({'units': [unit._asdict() for unit in data.units.itervalues()],
+        'topics': [dict(topic._asdict(), units=topic_units[topic.id])
+            for topic in data.topics.itervalues()]})
+
+@api.route("/graph/path/<string:source_code>/<string:target_code>")
+def path_graph(source_code, target_code):
+    path = unit_path_or_404(source_code, target_code)
+
+    if path is None:
+        abort(404)
+
+    return graph_response(build_path_graph(new_graph(), path))
+
+@api.route("/graph/overlap")
+def overlap_graph():
+    return graph_response(build_overlap_graph(new_graph(), units_overlap_or_404()))
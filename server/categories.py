@@ -0,0 +1,24 @@
+from models import *
+from wikipedia import wikipedia
+
+def fetch_categories(topic_name):
+    return wikipedia.categories(topic_name) or []
+
+def categories_by_name(category_names):
+    """ Existing categories with given names, plus new ones for the rest """
+    if category_names:
+        existing_categories = Category.query.filter(Category.name.in_(category_names)).all()
+        existing_names = map(lambda x: x.name, existing_categories)
+
+        new_categories = [Category(name) for name in category_names if name not in existing_names]
+        map(db.session.add, new_categories)
+
+        return existing_categories + new_categories
+    else:
+        return []
+
+def get_categories(topic):
+    fetched_categories = fetch_categories(topic.name)
+    category_names = map(lambda x: x['title'], fetched_categories)
+
+    return categories_by_name(category_names)
@@ -0,0 +1,56 @@
+import time
+import itertools
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import *
+
+# Changes to instances of these bump the version
+VERSIONED_MODELS = (Unit, Topic, Category, Keyword, UnitTopic)
+
+def _initial_version():
+    # Starting from the time the table was created, rather than from 0, keeps
+    # versions of a recreated database from repeating those of the old one
+    return int(time.time() * 1000)
+
+@event.listens_for(DataVersion.__table__, 'after_create')
+def _insert_version(table, connection, **kwargs):
+    connection.execute(table.insert(), id=1, version=_initial_version())
+
+def current():
+    """ Version of the data, which changes whenever units, topics or
+    categories do. Read with a single query, without loading any objects """
+    table = DataVersion.__table__
+    return db.session.execute(table.select().with_only_columns([table.c.version]).\
+        where(table.c.id == 1)).scalar()
+
+def bump(session=None):
+    """ Increments the version within the current transaction. Only needed
+    after changes made with bulk statements, which flush events don't see """
+    table = DataVersion.__table__
+    session = session or db.session
+
+    result = session.execute(table.update().where(table.c.id == 1).\
+        values(version=table.c.version + 1))
+
+    if result.rowcount == 0:
+        session.execute(table.insert(), {'id': 1, 'version': _initial_version()})
+
+# Bumped at most once per transaction, by the same transaction that makes the
+# changes, so that processes reading the version never see it ahead of them
+
+@event.listens_for(Session, 'after_flush')
+def _after_flush(session, flush_context):
+    if session.info.get('data_version_bumped'):
+        return
+
+    if any(isinstance(instance, VERSIONED_MODELS)
+            for instance in itertools.chain(session.new, session.dirty, session.deleted)):
+        bump(session)
+        session.info['data_version_bumped'] = True
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def _after_transaction(session):
+    session.info.pop('data_version_bumped', None)
@@ -0,0 +1,122 @@
+import time
+import Queue
+import logging
+import threading
+
+from models import *
+from categories import fetch_categories, categories_by_name
+
+logger = logging.getLogger(__name__)
+
+class CategoryEnricher(object):
+    """ Fetches Wikipedia categories of new topics in background threads, so
+    that adding a topic doesn't wait for Wikipedia.
+
+    At most `ENRICHMENT_WORKERS` lookups run at once. A failed lookup is
+    retried up to `ENRICHMENT_ATTEMPTS` times in total, waiting
+    `ENRICHMENT_RETRY_DELAY` seconds before the first retry and twice as long
+    before each next one. Statuses are kept per process. """
+
+    def __init__(self):
+        self.app = None
+        self.num_workers = 2
+        self.max_attempts = 3
+        self.retry_delay = 1.0
+
+        self.queue = Queue.Queue()
+        self.workers = []
+        self.statuses = {} # topic id -> status dict
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.num_workers = app.config.get('ENRICHMENT_WORKERS', 2)
+        self.max_attempts = app.config.get('ENRICHMENT_ATTEMPTS', 3)
+        self.retry_delay = app.config.get('ENRICHMENT_RETRY_DELAY', 1.0)
+
+    def _start_workers(self):
+        # Started lazily rather than in init_app, so that threads are created
+        # in the worker process rather than in a uWSGI master before forking
+        with self.lock:
+            while len(self.workers) < self.num_workers:
+                worker = threading.Thread(target=self._work, name='category-enricher')
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+    def _set_status(self, topic_id, state, **kwargs):
+        with self.lock:
+            status = self.statuses.setdefault(topic_id, {'topic_id': topic_id})
+            status['state'] = state
+            status.update(kwargs)
+
+    def enqueue(self, topic_id, topic_name):
+        self._set_status(topic_id, 'queued', attempts=0, error=None)
+        self.queue.put((topic_id, topic_name))
+        self._start_workers()
+
+    def status(self, topic_id):
+        with self.lock:
+            status = self.statuses.get(topic_id)
+            return dict(status) if status is not None else None
+
+    def stats(self):
+        with self.lock:
+            counts = dict.fromkeys(['queued', 'running', 'done', 'failed', 'skipped'], 0)
+
+            for status in self.statuses.itervalues():
+                counts[status['state']] += 1
+
+        counts['workers'] = len(self.workers)
+
+        return counts
+
+    def join(self):
+        """ Waits until every queued lookup has finished """
+        self.queue.join()
+
+    def _work(self):
+        while True:
+            topic_id, topic_name = self.queue.get()
+
+            try:
+                self._process(topic_id, topic_name)
+            finally:
+                self.queue.task_done()
+
+    def _process(self, topic_id, topic_name):
+        for attempt in range(1, self.max_attempts + 1):
+            self._set_status(topic_id, 'running', attempts=attempt)
+
+            try:
+                with self.app.app_context():
+                    try:
+                        is_attached = attach_categories(topic_id, fetch_categories(topic_name))
+                    finally:
+                        db.session.remove()
+            except Exception as e:
+                logger.warning('Fetching categories of %r failed (attempt %d): %s',
+                    topic_name, attempt, e)
+
+                if attempt == self.max_attempts:
+                    self._set_status(topic_id, 'failed', error=str(e))
+                else:
+                    time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            else:
+                self._set_status(topic_id, 'done' if is_attached else 'skipped', error=None)
+                return
+
+def attach_categories(topic_id, fetched_categories):
+    """ Sets topic's categories. Returns False if the topic has been removed
+    in the meantime """
+    topic = db.session.query(Topic).get(topic_id)
+
+    if topic is None:
+        return False
+
+    topic.categories = categories_by_name([c['title'] for c in fetched_categories])
+    db.session.commit()
+
+    return True
+
+category_enricher = CategoryEnricher()
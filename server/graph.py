@@ -1,11 +1,39 @@
 import pygraphviz as pgv
-from lxml import etree
 import textwrap
+import math
+import re
 from flask import Flask
 import json
 import os
 import copy
 
+from instrumentation import metrics
+
+SVG_ROOT = re.compile(br'<svg\b[^>]*>')
+SVG_SIZE = re.compile(br'\b(width|height)="[^"]*"')
+SVG_COMMENT = re.compile(br'<!--.*?-->', re.DOTALL)
+SVG_WHITESPACE = re.compile(br'>\s+<')
+
+def postprocess_svg(svg, minify=False):
+    """ Makes Graphviz SVG output (bytes) fit its container, and renders its
+    text precisely, by rewriting the root element only: text-rendering is
+    inherited, so setting it there applies to every <text>. The XML
+    declaration, doctype and comments before the root are dropped.
+
+    With `minify`, comments and whitespace between elements are removed too
+    (Graphviz doesn't put any whitespace that matters there) """
+    root = SVG_ROOT.search(svg)
+
+    svg_tag = SVG_SIZE.sub(br'\1="100%"', root.group(0))
+    svg_tag = svg_tag[:-1] + b' text-rendering="geometricPrecision">'
+
+    body = svg[root.end():]
+
+    if minify:
+        body = SVG_WHITESPACE.sub(b'><', SVG_COMMENT.sub(b'', body)).strip()
+
+    return svg_tag + body
+
 class SyllabusGraph(pgv.AGraph):
 
     def __init__(self, style_path, is_embedded=False):
@@ -13,6 +41,13 @@ class SyllabusGraph(pgv.AGraph):
 
         self.is_embedded = is_embedded
 
+        # Graphviz layout engine
+        self.prog = 'neato'
+
+        # Plain labels and links of nodes, and styles of edges, for render_layout
+        self.node_data = {}
+        self.edge_styles = {}
+
         with open(style_path) as f:
             self.style = json.loads(f.read())
             for key in self.style:
@@ -23,40 +58,51 @@ class SyllabusGraph(pgv.AGraph):
                     self.style[key] = copy.deepcopy(self.style[parent])
                     self.style[key].update(overwrites)
 
+        # Style files predating unit overviews
+        self.style.setdefault('shared_topics_edge', self.style['edge'])
+
     def add_unit_node(self, unit, is_central=False):
         wrapped_name = textwrap.fill(unit.name, width = 15)
 
-        style = None
+        style_name = None
 
         if is_central:
-            style = self.style['central_unit']
+            style_name = 'central_unit'
         else: 
-            style = self.style['unit_' + str(unit.get_year())]
+            style_name = 'unit_' + str(unit.get_year())
 
-        node_name = "unit_{}".format(unit.id)
+        node_name = self.unit_node_name(unit)
+        url = '#/graph/unit/{}'.format(unit.code)
 
         self.add_node(node_name,
             id=node_name,
             label=wrapped_name, 
-            URL='#/graph/unit/{}'.format(unit.code),
-            **style)
+            URL=url,
+            **self.style[style_name])
+
+        self.node_data[node_name] = {'kind': 'unit', 'style': style_name,
+            'label': unit.name, 'url': url}
 
         return node_name
 
     def add_category_node(self, category, weight):
-        label = category.name.split(":",1)[1]
-        label = '\n'.join(textwrap.wrap("%s" % label,  width = 15))
+        name = category.name.split(":",1)[1]
+        label = '\n'.join(textwrap.wrap("%s" % name,  width = 15))
 
-        node_name = "category_{}".format(category.id)
+        node_name = self.category_node_name(category)
+        url = '#/graph/category/{}'.format(category.id)
 
         self.add_node(node_name, 
             id=node_name,
             label=label,
             width=1.7+((weight-1)*0.5), 
             fontsize=14+(weight-1),
-            URL='#/graph/category/{}'.format(category.id),
+            URL=url,
             **self.style['category'])
 
+        self.node_data[node_name] = {'kind': 'category', 'style': 'category',
+            'label': name, 'url': url, 'weight': weight}
+
         return node_name
 
     def add_topic_node(self, topic, is_central=False):
@@ -74,40 +120,137 @@ class SyllabusGraph(pgv.AGraph):
                 topic.id,
                 topic.name)
 
-        style = self.style['central_topic'] if is_central else self.style['topic']
+        style_name = 'central_topic' if is_central else 'topic'
 
         node_name = self.topic_node_name(topic)
 
         self.add_node(node_name, 
             id=node_name,
             label=label,
-            **style)
+            **self.style[style_name])
+
+        self.node_data[node_name] = {'kind': 'topic', 'style': style_name,
+            'label': topic.name, 'url': '#/graph/topic/{}'.format(topic.id),
+            'wikipedia_url': u'//en.wikipedia.org/wiki/{}'.format(topic.name)}
 
         return node_name
 
     def add_edge(self, source, target):
         super(SyllabusGraph, self).add_edge(source, target, **self.style['edge'])
+        self.edge_styles[(source, target)] = 'edge'
 
     def add_category_edge(self, source, target):
         super(SyllabusGraph, self).add_edge(source, target, **self.style['category_edge'])
+        self.edge_styles[(source, target)] = 'category_edge'
+
+    def add_shared_topics_edge(self, source, target, num_topics):
+        """ Edge standing for the topics two units share, thicker the more
+        of them there are """
+        super(SyllabusGraph, self).add_edge(source, target,
+            penwidth=1 + math.log(num_topics, 2),
+            tooltip='%d shared topic%s' % (num_topics, '' if num_topics == 1 else 's'),
+            **self.style['shared_topics_edge'])
+        self.edge_styles[(source, target)] = 'shared_topics_edge'
+
+    def seed_positions(self, positions, pin=False):
+        """ Sets starting positions (in inches) for the next layout. Pinned
+        nodes are kept in place, the rest are only placed there initially """
+        suffix = '!' if pin else ''
+
+        for node in self.nodes():
+            if node in positions:
+                x, y = positions[node]
+                node.attr['pos'] = '{},{}{}'.format(x, y, suffix)
+
+    def positions(self):
+        """ Node positions (in inches) computed by the last layout """
+        positions = {}
+
+        for node in self.nodes():
+            pos = node.attr.get('pos')
 
-    def render_svg(self):
-        self.layout(prog='neato')
-        svg = self.draw(format='svg').decode('utf-8')
+            if pos:
+                x, y = pos.rstrip('!').split(',')
+                positions[str(node)] = (float(x) / 72, float(y) / 72)
 
-        svgparser = etree.XMLParser(encoding='utf-8')
-        svgobj = etree.fromstring(svg.encode('utf-8'), parser=svgparser)
+        return positions
 
-        svgobj.attrib['width'] = "100%"
-        svgobj.attrib['height'] = "100%"
+    def render_svg(self, minify=False):
+        with metrics.timer('layout'):
+            self.layout(prog=self.prog)
 
-        for n in svgobj.xpath('//n:text', namespaces={'n': "http://www.w3.org/2000/svg"}):
-            n.attrib['text-rendering'] = 'geometricPrecision'
+        with metrics.timer('draw'):
+            svg = self.draw(format='svg')
 
-        return etree.tostring(svgobj, pretty_print=True)
+        with metrics.timer('postprocess'):
+            return postprocess_svg(svg, minify)
+
+    def render_layout(self):
+        """ Lays the graph out like render_svg, and returns layout_data() """
+        with metrics.timer('layout'):
+            self.layout(prog=self.prog)
+
+        return self.layout_data()
+
+    def layout_data(self):
+        """ Node positions, sizes, labels and links, and edges of the laid out
+        graph, as a dict to be sent as JSON. Positions and sizes are in
+        points, with y growing upwards, as in Graphviz. Styles used by nodes
+        and edges are included once """
+        def points(value, scale=1):
+            return round(float(value) * scale, 2)
+
+        nodes = []
+
+        for node in self.nodes():
+            x, y = node.attr['pos'].rstrip('!').split(',')
+
+            data = dict(self.node_data[str(node)], id=str(node),
+                x=points(x), y=points(y),
+                width=points(node.attr['width'], 72), height=points(node.attr['height'], 72))
+            nodes.append(data)
+
+        edges = []
+
+        for edge in self.edges():
+            source, target = str(edge[0]), str(edge[1])
+            style_name = self.edge_styles.get((source, target)) or \
+                self.edge_styles[(target, source)]
+
+            edges.append([source, target, style_name])
+
+        style_names = set(n['style'] for n in nodes) | set(e[2] for e in edges)
+
+        bounding_box = self.graph_attr.get('bb')
+        if bounding_box:
+            bounding_box = [points(v) for v in bounding_box.split(',')]
+        elif nodes:
+            bounding_box = [min(n['x'] - n['width'] / 2 for n in nodes),
+                min(n['y'] - n['height'] / 2 for n in nodes),
+                max(n['x'] + n['width'] / 2 for n in nodes),
+                max(n['y'] + n['height'] / 2 for n in nodes)]
+
+        return {'bbox': bounding_box or [0, 0, 0, 0],
+            'styles': dict((name, self.style[name]) for name in style_names),
+            'nodes': nodes,
+            'edges': edges}
+
+    @staticmethod
+    def node_name(kind, id):
+        """ Name of the node of the unit, topic or category with the id, also
+        tagging cached graphs showing it """
+        return '{}_{}'.format(kind, id)
+
+    @staticmethod
+    def unit_node_name(unit):
+        return SyllabusGraph.node_name('unit', unit.id)
 
     @staticmethod
     def topic_node_name(topic):
-        return 'topic_{}'.format(topic.id)
+        return SyllabusGraph.node_name('topic', topic.id)
+
+    @staticmethod
+    def category_node_name(category):
+        return SyllabusGraph.node_name('category', category.id)
 
 
@@ -0,0 +1,168 @@
+from collections import namedtuple, OrderedDict
+
+from sqlalchemy import func, distinct
+from sqlalchemy.orm.exc import NoResultFound
+
+from models import *
+
+class UnitRow(namedtuple('UnitRow', ['id', 'code', 'name'])):
+    __slots__ = ()
+
+    def get_year(self):
+        return unit_year(self.code)
+
+TopicRow = namedtuple('TopicRow', ['id', 'name'])
+
+CategoryRow = namedtuple('CategoryRow', ['id', 'name'])
+
+class GraphData(object):
+    """ Units, topics and categories of a part of the syllabus graph, and the
+    links between them, as plain rows detached from the ORM """
+
+    def __init__(self, central=None):
+        self.central = central
+
+        self.units = OrderedDict()      # id -> UnitRow
+        self.topics = OrderedDict()     # id -> TopicRow
+        self.categories = OrderedDict() # id -> CategoryRow
+
+        self.edges = []                 # (unit id, topic id)
+        self.topic_categories = {}      # topic id -> [category id]
+
+    def add_edge(self, unit, topic):
+        self.units.setdefault(unit.id, unit)
+        self.topics.setdefault(topic.id, topic)
+        self.edges.append((unit.id, topic.id))
+
+    def add_topic_category(self, topic_id, category):
+        self.categories.setdefault(category.id, category)
+        self.topic_categories.setdefault(topic_id, []).append(category.id)
+
+    def unit_topic_ids(self, unit_id):
+        return [t_id for u_id, t_id in self.edges if u_id == unit_id]
+
+# Every loader below issues a fixed number of queries, independent of the
+# size of the graph. Scopes are expressed as subqueries, so that they are
+# resolved by the database rather than passed around as long IN lists.
+
+def _load_edges(data, topic_ids=None, unit_ids=None):
+    query = db.session.query(UnitTopic.unit_id, Unit.code, Unit.name,
+            UnitTopic.topic_id, Topic.name).\
+        join(Unit, UnitTopic.unit_id == Unit.id).\
+        join(Topic, UnitTopic.topic_id == Topic.id)
+
+    if topic_ids is not None:
+        query = query.filter(UnitTopic.topic_id.in_(topic_ids))
+
+    if unit_ids is not None:
+        query = query.filter(UnitTopic.unit_id.in_(unit_ids))
+
+    for unit_id, unit_code, unit_name, topic_id, topic_name in query.order_by(UnitTopic.id):
+        data.add_edge(UnitRow(unit_id, unit_code, unit_name), TopicRow(topic_id, topic_name))
+
+def _load_categories(data, topic_ids):
+    query = db.session.query(topic_category.c.topic_id, Category.id, Category.name).\
+        join(Category, topic_category.c.category_id == Category.id).\
+        filter(topic_category.c.topic_id.in_(topic_ids)).\
+        order_by(Category.id)
+
+    for topic_id, category_id, category_name in query:
+        data.add_topic_category(topic_id, CategoryRow(category_id, category_name))
+
+def whole_graph():
+    """ All topics (including those not used by any unit) and units using them """
+    data = GraphData()
+
+    for topic_id, topic_name in db.session.query(Topic.id, Topic.name).order_by(Topic.id):
+        data.topics[topic_id] = TopicRow(topic_id, topic_name)
+
+    _load_edges(data)
+
+    return data
+
+def unit_neighbourhood(unit_code):
+    """ Unit's topics, other units using them and categories of the topics """
+    unit = UnitRow(*db.session.query(Unit.id, Unit.code, Unit.name).\
+        filter(Unit.code == unit_code).one())
+
+    data = GraphData(unit)
+    data.units[unit.id] = unit
+
+    topic_ids = db.session.query(UnitTopic.topic_id).\
+        filter(UnitTopic.unit_id == unit.id).subquery()
+
+    _load_edges(data, topic_ids=topic_ids)
+    _load_categories(data, topic_ids)
+
+    return data
+
+def topic_neighbourhood(topic_id):
+    """ Units using the topic, all their topics and the topics' categories """
+    topic = TopicRow(*db.session.query(Topic.id, Topic.name).\
+        filter(Topic.id == topic_id).one())
+
+    data = GraphData(topic)
+    data.topics[topic.id] = topic
+
+    unit_ids = db.session.query(UnitTopic.unit_id).\
+        filter(UnitTopic.topic_id == topic.id).subquery()
+
+    _load_edges(data, unit_ids=unit_ids)
+
+    topic_ids = db.session.query(UnitTopic.topic_id).\
+        filter(UnitTopic.unit_id.in_(unit_ids)).subquery()
+
+    _load_categories(data, topic_ids)
+
+    return data
+
+def category_neighbourhood(category_id):
+    """ Category's topics and units using them """
+    category = CategoryRow(*db.session.query(Category.id, Category.name).\
+        filter(Category.id == category_id).one())
+
+    data = GraphData(category)
+    data.categories[category.id] = category
+
+    query = db.session.query(Topic.id, Topic.name).\
+        join(topic_category, topic_category.c.topic_id == Topic.id).\
+        filter(topic_category.c.category_id == category.id).\
+        order_by(Topic.id)
+
+    for t_id, topic_name in query:
+        data.topics[t_id] = TopicRow(t_id, topic_name)
+        data.topic_categories[t_id] = [category.id]
+
+    topic_ids = db.session.query(topic_category.c.topic_id).\
+        filter(topic_category.c.category_id == category.id).subquery()
+
+    _load_edges(data, topic_ids=topic_ids)
+
+    return data
+
+def units_overlap(unit_codes, min_units=None):
+    """ Given units, topics used by at least `min_units` of them (all of
+    them by default), and categories of those topics """
+    data = GraphData()
+    unit_codes = set(unit_codes)
+
+    for unit_id, code, name in db.session.query(Unit.id, Unit.code, Unit.name).\
+            filter(Unit.code.in_(unit_codes)).order_by(Unit.id):
+        data.units[unit_id] = UnitRow(unit_id, code, name)
+
+    if len(data.units) < len(unit_codes):
+        raise NoResultFound('No unit %r' % sorted(unit_codes -
+            set(unit.code for unit in data.units.itervalues()))[0])
+
+    unit_ids = data.units.keys()
+
+    topic_ids = db.session.query(UnitTopic.topic_id).\
+        filter(UnitTopic.unit_id.in_(unit_ids)).\
+        group_by(UnitTopic.topic_id).\
+        having(func.count(distinct(UnitTopic.unit_id)) >= (min_units or len(unit_ids))).\
+        subquery()
+
+    _load_edges(data, topic_ids=topic_ids, unit_ids=unit_ids)
+    _load_categories(data, topic_ids)
+
+    return data
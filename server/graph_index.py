@@ -0,0 +1,485 @@
+import time
+import threading
+from array import array
+from bisect import bisect_left, insort
+from collections import Counter
+
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history, PASSIVE_NO_INITIALIZE
+from sqlalchemy.orm.exc import NoResultFound
+
+from models import *
+from graph_data import GraphData, UnitRow, TopicRow, CategoryRow
+
+def _add(adjacency, key, value):
+    insort(adjacency.setdefault(key, array('i')), value)
+
+def _remove(adjacency, key, value):
+    values = adjacency.get(key)
+
+    if values is not None:
+        i = bisect_left(values, value)
+        if i < len(values) and values[i] == value:
+            del values[i]
+
+        if not values:
+            del adjacency[key]
+
+def _contains(values, value):
+    i = bisect_left(values, value)
+    return i < len(values) and values[i] == value
+
+class GraphIndex(object):
+    """ In-memory copy of the unit - topic - category graph.
+
+    Adjacency is kept as sorted integer arrays: unit topic ids per unit and
+    per topic, and category ids per topic (and vice versa). Labels are kept in
+    separate tables. The index is built once and then kept up to date from
+    session events, so that graph scopes can be answered without touching
+    the database. Changes made by other processes, or with bulk statements,
+    are not seen by events - `check` compares the index with the database and
+    rebuilds it if they differ.
+
+    Scopes return the same `GraphData` as the loaders in `graph_data`. """
+
+    def __init__(self):
+        self.enabled = False
+        self.check_interval = None
+        self.last_check = 0
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        self.units = {}             # id -> UnitRow
+        self.unit_codes = {}        # code -> id
+        self.topics = {}            # id -> TopicRow
+        self.categories = {}        # id -> CategoryRow
+
+        self.unit_topics = {}       # unit topic id -> (unit id, topic id)
+        self.unit_adjacency = {}    # unit id -> unit topic ids
+        self.topic_adjacency = {}   # topic id -> unit topic ids
+
+        self.topic_categories = {}  # topic id -> category ids
+        self.category_topics = {}   # category id -> topic ids
+
+    def init_app(self, app):
+        self.enabled = app.config.get('GRAPH_INDEX', False)
+        self.check_interval = app.config.get('GRAPH_INDEX_CHECK_INTERVAL', 60)
+
+        if self.enabled:
+            with app.app_context():
+                self.build()
+
+    def build(self):
+        """ Loads the whole graph from the database """
+        with self.lock:
+            self.clear()
+
+            for unit_id, code, name in db.session.query(Unit.id, Unit.code, Unit.name):
+                self.set_unit(UnitRow(unit_id, code, name))
+
+            for topic_id, name in db.session.query(Topic.id, Topic.name):
+                self.set_topic(TopicRow(topic_id, name))
+
+            for category_id, name in db.session.query(Category.id, Category.name):
+                self.set_category(CategoryRow(category_id, name))
+
+            for row in db.session.query(UnitTopic.id, UnitTopic.unit_id, UnitTopic.topic_id):
+                self.set_unit_topic(*row)
+
+            for topic_id, category_id in db.session.query(topic_category):
+                self.add_topic_category(topic_id, category_id)
+
+            self.last_check = time.time()
+
+    # Incremental updates
+
+    def set_unit(self, unit):
+        old = self.units.get(unit.id)
+        if old is not None:
+            del self.unit_codes[old.code]
+
+        self.units[unit.id] = unit
+        self.unit_codes[unit.code] = unit.id
+
+    def remove_unit(self, unit_id):
+        unit = self.units.pop(unit_id, None)
+        if unit is not None:
+            del self.unit_codes[unit.code]
+
+    def set_topic(self, topic):
+        self.topics[topic.id] = topic
+
+    def remove_topic(self, topic_id):
+        self.topics.pop(topic_id, None)
+
+        for category_id in list(self.topic_categories.get(topic_id, ())):
+            self.remove_topic_category(topic_id, category_id)
+
+    def set_category(self, category):
+        self.categories[category.id] = category
+
+    def remove_category(self, category_id):
+        self.categories.pop(category_id, None)
+
+        for topic_id in list(self.category_topics.get(category_id, ())):
+            self.remove_topic_category(topic_id, category_id)
+
+    def set_unit_topic(self, unit_topic_id, unit_id, topic_id):
+        self.remove_unit_topic(unit_topic_id)
+
+        self.unit_topics[unit_topic_id] = (unit_id, topic_id)
+        _add(self.unit_adjacency, unit_id, unit_topic_id)
+        _add(self.topic_adjacency, topic_id, unit_topic_id)
+
+    def remove_unit_topic(self, unit_topic_id):
+        row = self.unit_topics.pop(unit_topic_id, None)
+
+        if row is not None:
+            unit_id, topic_id = row
+            _remove(self.unit_adjacency, unit_id, unit_topic_id)
+            _remove(self.topic_adjacency, topic_id, unit_topic_id)
+
+    def add_topic_category(self, topic_id, category_id):
+        if not _contains(self.topic_categories.get(topic_id, ()), category_id):
+            _add(self.topic_categories, topic_id, category_id)
+            _add(self.category_topics, category_id, topic_id)
+
+    def remove_topic_category(self, topic_id, category_id):
+        _remove(self.topic_categories, topic_id, category_id)
+        _remove(self.category_topics, category_id, topic_id)
+
+    def record_deleted_topics(self, session, topic_ids):
+        """ Topics deleted with bulk statements, which flush events don't
+        see, to be removed once the transaction commits """
+        if self.enabled:
+            session.info.setdefault('graph_index_changes', []).extend(
+                ('remove_topic', topic_id) for topic_id in topic_ids)
+
+    def apply(self, changes):
+        with self.lock:
+            for change in changes:
+                getattr(self, change[0])(*change[1:])
+
+    # Consistency with the database
+
+    def fingerprint(self):
+        """ Row counts and id sums of every table the index mirrors """
+        with self.lock:
+            num_topic_categories = sum(len(c) for c in self.topic_categories.itervalues())
+            topic_category_sum = sum(t * len(c) + sum(c)
+                for t, c in self.topic_categories.iteritems())
+
+            return (len(self.units), sum(self.units),
+                len(self.topics), sum(self.topics),
+                len(self.categories), sum(self.categories),
+                len(self.unit_topics), sum(self.unit_topics),
+                num_topic_categories, topic_category_sum)
+
+    @staticmethod
+    def database_fingerprint():
+        def aggregates(column):
+            return (db.session.query(func.count(column)).as_scalar(),
+                db.session.query(func.coalesce(func.sum(column), 0)).as_scalar())
+
+        columns = []
+        for column in (Unit.id, Topic.id, Category.id, UnitTopic.id):
+            columns.extend(aggregates(column))
+
+        columns.append(db.session.query(func.count(topic_category.c.topic_id)).as_scalar())
+        columns.append(db.session.query(func.coalesce(func.sum(
+            topic_category.c.topic_id + topic_category.c.category_id), 0)).as_scalar())
+
+        return tuple(int(x) for x in db.session.query(*columns).one())
+
+    def check(self):
+        """ Rebuilds the index if it doesn't match the database. Returns True
+        if it did match """
+        is_consistent = self.fingerprint() == self.database_fingerprint()
+
+        if not is_consistent:
+            self.build()
+
+        self.last_check = time.time()
+
+        return is_consistent
+
+    def check_if_due(self):
+        if self.check_interval is not None and \
+                time.time() - self.last_check >= self.check_interval:
+            self.check()
+
+    # Scopes, matching the ones in graph_data
+
+    def _add_edges(self, data, unit_topic_ids):
+        for unit_topic_id in sorted(unit_topic_ids):
+            unit_id, topic_id = self.unit_topics[unit_topic_id]
+            data.add_edge(self.units[unit_id], self.topics[topic_id])
+
+    def _add_categories(self, data, topic_ids):
+        for topic_id in topic_ids:
+            for category_id in self.topic_categories.get(topic_id, ()):
+                data.add_topic_category(topic_id, self.categories[category_id])
+
+    def _unit_topics_of_topics(self, topic_ids):
+        unit_topic_ids = set()
+
+        for topic_id in topic_ids:
+            unit_topic_ids.update(self.topic_adjacency.get(topic_id, ()))
+
+        return unit_topic_ids
+
+    def whole_graph(self):
+        with self.lock:
+            data = GraphData()
+
+            for topic_id in sorted(self.topics):
+                data.topics[topic_id] = self.topics[topic_id]
+
+            self._add_edges(data, self.unit_topics)
+
+            return data
+
+    def unit_neighbourhood(self, unit_code):
+        with self.lock:
+            if unit_code not in self.unit_codes:
+                raise NoResultFound('No unit %r' % unit_code)
+
+            unit = self.units[self.unit_codes[unit_code]]
+
+            data = GraphData(unit)
+            data.units[unit.id] = unit
+
+            topic_ids = set(self.unit_topics[ut_id][1]
+                for ut_id in self.unit_adjacency.get(unit.id, ()))
+
+            self._add_edges(data, self._unit_topics_of_topics(topic_ids))
+            self._add_categories(data, sorted(topic_ids))
+
+            return data
+
+    def topic_neighbourhood(self, topic_id):
+        with self.lock:
+            topic = self.topics.get(int(topic_id))
+            if topic is None:
+                raise NoResultFound('No topic %r' % topic_id)
+
+            data = GraphData(topic)
+            data.topics[topic.id] = topic
+
+            unit_ids = set(self.unit_topics[ut_id][0]
+                for ut_id in self.topic_adjacency.get(topic.id, ()))
+
+            unit_topic_ids = set()
+            for unit_id in unit_ids:
+                unit_topic_ids.update(self.unit_adjacency.get(unit_id, ()))
+
+            self._add_edges(data, unit_topic_ids)
+            self._add_categories(data, sorted(set(self.unit_topics[ut_id][1]
+                for ut_id in unit_topic_ids)))
+
+            return data
+
+    def category_neighbourhood(self, category_id):
+        with self.lock:
+            category = self.categories.get(int(category_id))
+            if category is None:
+                raise NoResultFound('No category %r' % category_id)
+
+            data = GraphData(category)
+            data.categories[category.id] = category
+
+            topic_ids = self.category_topics.get(category.id, ())
+
+            for topic_id in topic_ids:
+                data.topics[topic_id] = self.topics[topic_id]
+                data.topic_categories[topic_id] = [category.id]
+
+            self._add_edges(data, self._unit_topics_of_topics(topic_ids))
+
+            return data
+
+    def _unit_ids(self, unit_codes):
+        unit_ids = []
+
+        for unit_code in unit_codes:
+            if unit_code not in self.unit_codes:
+                raise NoResultFound('No unit %r' % unit_code)
+
+            unit_ids.append(self.unit_codes[unit_code])
+
+        return sorted(set(unit_ids))
+
+    def units_overlap(self, unit_codes, min_units=None):
+        with self.lock:
+            unit_ids = self._unit_ids(unit_codes)
+
+            data = GraphData()
+            for unit_id in unit_ids:
+                data.units[unit_id] = self.units[unit_id]
+
+            counts = Counter()
+            for unit_id in unit_ids:
+                counts.update(set(self.unit_topics[ut_id][1]
+                    for ut_id in self.unit_adjacency.get(unit_id, ())))
+
+            topic_ids = set(topic_id for topic_id, count in counts.iteritems()
+                if count >= (min_units or len(unit_ids)))
+
+            self._add_edges(data, [ut_id for unit_id in unit_ids
+                for ut_id in self.unit_adjacency.get(unit_id, ())
+                if self.unit_topics[ut_id][1] in topic_ids])
+            self._add_categories(data, sorted(topic_ids))
+
+            return data
+
+    # Paths, between nodes named ('unit' | 'topic' | 'category', id)
+
+    def _neighbours(self, node, topics_only):
+        kind, node_id = node
+
+        if kind == 'unit':
+            return [('topic', self.unit_topics[ut_id][1])
+                for ut_id in self.unit_adjacency.get(node_id, ())]
+
+        if kind == 'category':
+            return [('topic', topic_id) for topic_id in self.category_topics.get(node_id, ())]
+
+        nodes = [('unit', self.unit_topics[ut_id][0])
+            for ut_id in self.topic_adjacency.get(node_id, ())]
+
+        if not topics_only:
+            nodes.extend(('category', category_id)
+                for category_id in self.topic_categories.get(node_id, ()))
+
+        return nodes
+
+    def shortest_path(self, source, target, topics_only=False):
+        """ Nodes of a shortest path from source to target, or None if they
+        aren't connected. Searches from both ends, a level of the smaller
+        side at a time, which visits far fewer nodes than searching from one
+        end does. With `topics_only`, paths don't go through categories """
+        with self.lock:
+            if source == target:
+                return [source]
+
+            parents = ({source: None}, {target: None})
+            frontiers = [[source], [target]]
+
+            while frontiers[0] and frontiers[1]:
+                side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+                visited, other = parents[side], parents[1 - side]
+                frontier = []
+
+                for node in frontiers[side]:
+                    for neighbour in self._neighbours(node, topics_only):
+                        if neighbour in visited:
+                            continue
+
+                        visited[neighbour] = node
+
+                        # The sides didn't meet before this level, so this
+                        # is as short as any path found later would be
+                        if neighbour in other:
+                            return self._join(parents, neighbour)
+
+                        frontier.append(neighbour)
+
+                frontiers[side] = frontier
+
+            return None
+
+    @staticmethod
+    def _join(parents, middle):
+        path = []
+
+        node = middle
+        while node is not None:
+            path.append(node)
+            node = parents[0][node]
+
+        path.reverse()
+
+        node = parents[1][middle]
+        while node is not None:
+            path.append(node)
+            node = parents[1][node]
+
+        return path
+
+    def unit_path(self, source_code, target_code, topics_only=False):
+        """ Shortest path between two units, as a list of ('unit' | 'topic' |
+        'category', row), or None if they aren't connected """
+        with self.lock:
+            source_id, target_id = [self._unit_ids([code])[0] for code in (source_code, target_code)]
+
+            path = self.shortest_path(('unit', source_id), ('unit', target_id), topics_only)
+            if path is None:
+                return None
+
+            tables = {'unit': self.units, 'topic': self.topics, 'category': self.categories}
+            return [(kind, tables[kind][node_id]) for kind, node_id in path]
+
+graph_index = GraphIndex()
+
+# Changes are collected when flushed, and applied to the index only once the
+# transaction commits
+
+def _added_and_deleted(instance, key):
+    # Collections that were never loaded can't have been changed through this
+    # side of the relationship, and shouldn't be loaded mid-flush
+    history = get_history(instance, key, passive=PASSIVE_NO_INITIALIZE)
+    return history.added or (), history.deleted or ()
+
+def _collect_changes(session):
+    changes = []
+
+    for instance in session.new.union(session.dirty):
+        if isinstance(instance, Unit):
+            changes.append(('set_unit', UnitRow(instance.id, instance.code, instance.name)))
+
+        elif isinstance(instance, Topic):
+            changes.append(('set_topic', TopicRow(instance.id, instance.name)))
+
+            added, deleted = _added_and_deleted(instance, 'categories')
+            changes.extend(('add_topic_category', instance.id, c.id) for c in added)
+            changes.extend(('remove_topic_category', instance.id, c.id) for c in deleted)
+
+        elif isinstance(instance, Category):
+            changes.append(('set_category', CategoryRow(instance.id, instance.name)))
+
+            added, deleted = _added_and_deleted(instance, 'topics')
+            changes.extend(('add_topic_category', t.id, instance.id) for t in added)
+            changes.extend(('remove_topic_category', t.id, instance.id) for t in deleted)
+
+        elif isinstance(instance, UnitTopic):
+            changes.append(('set_unit_topic', instance.id, instance.unit_id, instance.topic_id))
+
+    for instance in session.deleted:
+        if isinstance(instance, Unit):
+            changes.append(('remove_unit', instance.id))
+        elif isinstance(instance, Topic):
+            changes.append(('remove_topic', instance.id))
+        elif isinstance(instance, Category):
+            changes.append(('remove_category', instance.id))
+        elif isinstance(instance, UnitTopic):
+            changes.append(('remove_unit_topic', instance.id))
+
+    return changes
+
+@event.listens_for(Session, 'after_flush')
+def _after_flush(session, flush_context):
+    if graph_index.enabled:
+        session.info.setdefault('graph_index_changes', []).extend(_collect_changes(session))
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    changes = session.info.pop('graph_index_changes', None)
+
+    if changes:
+        graph_index.apply(changes)
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('graph_index_changes', None)
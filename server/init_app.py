@@ -1,6 +1,24 @@
 from api import api
+from render_cache import graph_cache
+from layout_store import layout_store
+from render_pool import render_pool
+from graph_index import graph_index
+from search_index import search_index
+from similarity import unit_similarity
+from enrichment import category_enricher
+from wikipedia import wikipedia
+from instrumentation import metrics
 
 def init_app(app, config):
 	app.config.from_pyfile(config)
 	app.add_url_rule('/', 'root', lambda: app.send_static_file('index.html'))
 	app.register_blueprint(api, url_prefix='/api')
+	graph_cache.init_app(app)
+	layout_store.init_app(app)
+	render_pool.init_app(app)
+	graph_index.init_app(app)
+	search_index.init_app(app)
+	unit_similarity.init_app(app)
+	category_enricher.init_app(app)
+	wikipedia.init_app(app)
+	metrics.init_app(app)
@@ -0,0 +1,159 @@
+import bisect
+import timeit
+import functools
+import threading
+
+from flask import g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds of histogram buckets, in milliseconds
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+class Histogram(object):
+    """ Counts of durations by bucket, with their total """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, ms):
+        self.counts[bisect.bisect_left(BUCKETS, ms)] += 1
+        self.count += 1
+        self.sum += ms
+
+    def to_dict(self):
+        """ Cumulative counts of durations up to each bound, as in Prometheus """
+        buckets = []
+        total = 0
+
+        for bound, count in zip(BUCKETS + ('inf',), self.counts):
+            total += count
+            buckets.append([bound, total])
+
+        return {'count': self.count, 'sum': round(self.sum, 3), 'buckets': buckets}
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_TIMER = NullTimer()
+
+class Timer(object):
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.record(self.name, (timeit.default_timer() - self.start) * 1000)
+        return False
+
+class Metrics(object):
+    """ Time spent in SQL statements, graph phases, serialisation and
+    Wikipedia lookups.
+
+    With `METRICS = True`, every API response gets a Server-Timing header
+    with the time each phase took during the request (and the number of
+    times it ran), and durations are collected in histograms, per phase and
+    per endpoint, shown at /api/metrics. Histograms are kept per process.
+
+    When disabled, timers do nothing and SQL statements aren't watched. """
+
+    def __init__(self):
+        self.enabled = False
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        self.enabled = app.config.get('METRICS', False)
+
+        if self.enabled and not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+            # All engines, as tests and scripts change the database URI
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    def timer(self, name):
+        """ Context manager timing its block as phase `name` """
+        if not self.enabled:
+            return NULL_TIMER
+
+        return Timer(self, name)
+
+    def timed(self, name):
+        """ Decorator timing calls of the function as phase `name` """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def record(self, name, ms):
+        self._observe(name, ms)
+
+        if has_request_context() and hasattr(g, 'timings'):
+            total, count = g.timings.get(name, (0.0, 0))
+            g.timings[name] = (total + ms, count + 1)
+
+    def _observe(self, name, ms):
+        with self.lock:
+            histogram = self.histograms.get(name)
+
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+
+            histogram.observe(ms)
+
+    def start_request(self):
+        if self.enabled:
+            g.timings = {}
+            g.request_start = timeit.default_timer()
+
+    def finish_request(self, endpoint, response):
+        """ Records the request's duration, and adds the Server-Timing header """
+        if not self.enabled or not hasattr(g, 'timings'):
+            return
+
+        ms = (timeit.default_timer() - g.request_start) * 1000
+
+        # Without the blueprint's name
+        self._observe('request.' + (endpoint or 'unknown').split('.')[-1], ms)
+
+        entries = ['%s;dur=%.2f;desc="%d"' % (name, total, count)
+            for name, (total, count) in sorted(g.timings.iteritems())]
+        entries.append('total;dur=%.2f' % ms)
+
+        response.headers['Server-Timing'] = ', '.join(entries)
+
+    def snapshot(self):
+        with self.lock:
+            return dict((name, histogram.to_dict())
+                for name, histogram in self.histograms.iteritems())
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if metrics.enabled:
+        conn.info.setdefault('query_start', []).append(timeit.default_timer())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_start')
+
+    if metrics.enabled and starts:
+        metrics.record('sql', (timeit.default_timer() - starts.pop()) * 1000)
+
+metrics = Metrics()
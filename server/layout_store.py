@@ -0,0 +1,50 @@
+import threading
+
+class LayoutStore(object):
+    """ Remembers where nodes were placed by the previous layout of each graph,
+    so that the next layout of the same graph does not start from scratch.
+
+    Modes:
+    - cold: positions are ignored, every layout starts from scratch
+    - seed: known nodes start where they were, but are free to move
+    - pin: known nodes stay where they were, only new nodes are placed """
+
+    MODES = ('cold', 'seed', 'pin')
+
+    def __init__(self, mode='cold'):
+        self.mode = mode
+        self.scopes = {} # scope -> {node name -> (x, y)}
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        self.mode = self._check_mode(app.config.get('GRAPH_LAYOUT_MODE', 'cold'))
+
+    def _check_mode(self, mode):
+        if mode not in self.MODES:
+            raise ValueError('Unknown layout mode: %r' % mode)
+
+        return mode
+
+    def seed(self, graph, scope, mode=None):
+        mode = self._check_mode(mode or self.mode)
+
+        if mode == 'cold':
+            return
+
+        with self.lock:
+            positions = self.scopes.get(scope)
+
+        if positions:
+            graph.seed_positions(positions, pin=(mode == 'pin'))
+
+    def record(self, graph, scope):
+        positions = graph.positions()
+
+        with self.lock:
+            self.scopes[scope] = positions
+
+    def clear(self):
+        with self.lock:
+            self.scopes.clear()
+
+layout_store = LayoutStore()
@@ -75,9 +75,12 @@ class Unit(db.Model):
         return "<Unit %r %r>" % (self.code, self.name)
 
     def get_year(self):
-        return 1
-        #TODO: only for UoM, do
-        #return int(re.search("\d", self.code).group(0))
+        return unit_year(self.code)
+
+def unit_year(unit_code):
+    return 1
+    #TODO: only for UoM, do
+    #return int(re.search("\d", unit_code).group(0))
 
 topic_category = db.Table('topic_category', db.Model.metadata,
     db.Column('topic_id', db.Integer, db.ForeignKey('topic.id')),
@@ -136,3 +139,45 @@ class Category(db.Model):
 class Keyword(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.Text, unique=True)
+
+class ImportedWorkbook(db.Model):
+    """ Spreadsheet imported by add_initial_data.py, with checksum of its file """
+    id = db.Column(db.Integer, primary_key=True)
+
+    name = db.Column(db.Text, unique=True)
+    checksum = db.Column(db.String(40))
+
+    rows = db.relationship('ImportedRow', backref='workbook', cascade='all, delete-orphan')
+
+    def __init__(self, name, checksum):
+        self.name = name
+        self.checksum = checksum
+
+    def __repr__(self):
+        return '<ImportedWorkbook %r>' % self.name
+
+class ImportedRow(db.Model):
+    """ Spreadsheet row, with checksum of its cells, and the unit topic it was
+    imported as """
+    id = db.Column(db.Integer, primary_key=True)
+
+    workbook_id = db.Column(db.Integer, db.ForeignKey('imported_workbook.id'))
+
+    # Rows whose unit topic was removed through the app keep their checksum,
+    # so that the unit topic isn't imported again while the row is unchanged
+    unit_topic_id = db.Column(db.Integer,
+        db.ForeignKey('unit_topic.id', ondelete='SET NULL'))
+
+    checksum = db.Column(db.String(40))
+
+    def __init__(self, checksum, unit_topic_id):
+        self.checksum = checksum
+        self.unit_topic_id = unit_topic_id
+
+    def __repr__(self):
+        return '<ImportedRow %r %r>' % (self.checksum, self.unit_topic_id)
+
+class DataVersion(db.Model):
+    # Single row, see data_version.py
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.BigInteger)
@@ -0,0 +1,189 @@
+import os
+import json
+import errno
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+class MemoryBackend(object):
+    """ Bounded in-process LRU of rendered graphs """
+
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key -> (value, tags)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+
+            if entry is None:
+                return None
+
+            # Re-insert, so that the entry becomes the most recently used one
+            self.entries[key] = entry
+
+            return entry[0]
+
+    def set(self, key, value, tags):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, frozenset(tags))
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, tags):
+        tags = set(tags)
+
+        with self.lock:
+            stale = [key for key, (_, entry_tags) in self.entries.iteritems()
+                if not entry_tags.isdisjoint(tags)]
+
+            for key in stale:
+                del self.entries[key]
+
+        return len(stale)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class FileBackend(object):
+    """ Rendered graphs stored on disk, one file per entry. Unlike the memory
+    backend, entries are shared between worker processes and survive restarts """
+
+    def __init__(self, path):
+        self.path = path
+
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key + '.svg')
+
+    def _tags_path(self, key):
+        return os.path.join(self.path, key + '.tags')
+
+    def _write(self, path, data):
+        # Write to a temporary file first, so that concurrent readers never
+        # see a partially written entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+
+    def get(self, key):
+        try:
+            with open(self._entry_path(key), 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def set(self, key, value, tags):
+        self._write(self._tags_path(key), json.dumps(sorted(tags)))
+        self._write(self._entry_path(key), value)
+
+    def invalidate(self, tags):
+        tags = set(tags)
+        removed = 0
+
+        for filename in os.listdir(self.path):
+            if not filename.endswith('.tags'):
+                continue
+
+            key = filename[:-len('.tags')]
+
+            try:
+                with open(self._tags_path(key)) as f:
+                    entry_tags = json.load(f)
+            except (IOError, ValueError):
+                continue
+
+            if tags.isdisjoint(entry_tags):
+                continue
+
+            for path in (self._entry_path(key), self._tags_path(key)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+            removed += 1
+
+        return removed
+
+    def clear(self):
+        for filename in os.listdir(self.path):
+            if filename.endswith('.svg') or filename.endswith('.tags'):
+                os.remove(os.path.join(self.path, filename))
+
+class RenderCache(object):
+    """ Cache of rendered graphs.
+
+    Entries are content-addressed (see `key`), so a changed graph can never be
+    served from a stale entry. Every entry is also tagged with the names of
+    the nodes it contains, which lets the mutation endpoints drop entries for
+    affected units, topics and categories instead of letting them linger until
+    evicted. """
+
+    def __init__(self, backend=None):
+        self.backend = backend
+
+    def init_app(self, app):
+        kind = app.config.get('GRAPH_CACHE')
+
+        if kind == 'memory':
+            self.backend = MemoryBackend(app.config.get('GRAPH_CACHE_SIZE', 128))
+        elif kind == 'file':
+            self.backend = FileBackend(app.config['GRAPH_CACHE_DIR'])
+        elif kind is None:
+            self.backend = None
+        else:
+            raise ValueError('Unknown GRAPH_CACHE backend: %r' % kind)
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    @staticmethod
+    def key(graph, flavour):
+        """ Hash of the graph's nodes, edges, style and layout engine, and of
+        the output flavour ('html', 'svg' or 'json', '-min' when minified) """
+        dot = graph.string()
+        if isinstance(dot, unicode):
+            dot = dot.encode('utf-8')
+
+        h = hashlib.sha1()
+        h.update(dot)
+        h.update(json.dumps(graph.style, sort_keys=True))
+        h.update(graph.prog)
+        h.update(flavour)
+
+        return h.hexdigest()
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+
+        return self.backend.get(key)
+
+    def set(self, key, value, tags):
+        if self.enabled:
+            self.backend.set(key, value, tags)
+
+    def invalidate(self, tags):
+        if not self.enabled:
+            return 0
+
+        return self.backend.invalidate(tags)
+
+    def clear(self):
+        if self.enabled:
+            self.backend.clear()
+
+graph_cache = RenderCache()
@@ -0,0 +1,156 @@
+import time
+import threading
+import subprocess
+import multiprocessing
+
+# How often waiting renders check for timeouts and disconnected clients
+POLL_INTERVAL = 0.05
+
+class RenderError(Exception):
+    pass
+
+class RenderPoolFull(RenderError):
+    """ Too many renders are waiting already """
+
+class RenderTimeout(RenderError):
+    pass
+
+class RenderCancelled(RenderError):
+    """ The client went away before its graph was rendered """
+
+class RenderPool(object):
+    """ Runs Graphviz layouts and renders in separate processes, fed with DOT,
+    at most `GRAPH_RENDER_WORKERS` at once.
+
+    Up to `GRAPH_RENDER_QUEUE_SIZE` more renders wait for a free slot, others
+    are refused with RenderPoolFull, so that graph requests can't tie up
+    every worker. A render that takes longer than `GRAPH_RENDER_TIMEOUT`
+    seconds (waiting included), or whose client has gone, is killed.
+
+    Slots are counted with a semaphore shared between processes forked after
+    init_app, i.e. between uWSGI workers unless lazy-apps is used. The pool
+    is disabled (graphs are rendered in the request, as before) when
+    `GRAPH_RENDER_WORKERS` is 0, the default. """
+
+    def __init__(self, workers=0, queue_size=8, timeout=30, retry_after=5):
+        self.configure(workers, queue_size, timeout, retry_after)
+
+    def init_app(self, app):
+        self.configure(app.config.get('GRAPH_RENDER_WORKERS', 0),
+            app.config.get('GRAPH_RENDER_QUEUE_SIZE', 8),
+            app.config.get('GRAPH_RENDER_TIMEOUT', 30),
+            app.config.get('GRAPH_RENDER_RETRY_AFTER', 5))
+
+    def configure(self, workers, queue_size, timeout, retry_after):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.retry_after = retry_after
+
+        self.slots = multiprocessing.BoundedSemaphore(max(workers, 1))
+        self.waiting = multiprocessing.Value('i', 0)
+
+    @property
+    def enabled(self):
+        return self.workers > 0
+
+    def layout(self, graph, is_cancelled=None, prog='neato'):
+        """ Lays the graph out, same as graph.layout(prog) """
+        graph.from_string(self.run([prog, '-Tdot'], graph.string(), is_cancelled))
+        graph.has_layout = True
+
+    def draw(self, graph, format='svg', is_cancelled=None):
+        """ Draws a laid out graph, same as graph.draw(format=format) """
+        return self.run(['neato', '-n2', '-T' + format], graph.string(), is_cancelled)
+
+    def run(self, args, dot, is_cancelled=None):
+        """ Runs a Graphviz command with DOT as its input, and returns its
+        output. `is_cancelled` is polled while waiting """
+        if isinstance(dot, unicode):
+            dot = dot.encode('utf-8')
+
+        deadline = time.time() + self.timeout
+
+        self._acquire(deadline, is_cancelled)
+        try:
+            return self._run(args, dot, deadline, is_cancelled)
+        finally:
+            self.slots.release()
+
+    def _acquire(self, deadline, is_cancelled):
+        if self.slots.acquire(False):
+            return
+
+        with self.waiting.get_lock():
+            if self.waiting.value >= self.queue_size:
+                raise RenderPoolFull('%d renders are waiting already' % self.waiting.value)
+
+            self.waiting.value += 1
+
+        try:
+            while not self.slots.acquire(True, POLL_INTERVAL):
+                _check(deadline, is_cancelled)
+        finally:
+            with self.waiting.get_lock():
+                self.waiting.value -= 1
+
+    def _run(self, args, dot, deadline, is_cancelled):
+        process = subprocess.Popen(args, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        # communicate() can't time out in Python 2, so it runs in a thread
+        # while this one watches the clock and the client
+        result = {}
+
+        def communicate():
+            result['output'] = process.communicate(dot)
+
+        thread = threading.Thread(target=communicate)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            while thread.is_alive():
+                thread.join(POLL_INTERVAL)
+
+                if thread.is_alive():
+                    _check(deadline, is_cancelled)
+        except RenderError:
+            _kill(process)
+            thread.join()
+            raise
+
+        out, err = result['output']
+
+        if process.returncode != 0:
+            raise RenderError('%s exited with %d: %s' % (args[0], process.returncode, err.strip()))
+
+        return out
+
+def _check(deadline, is_cancelled):
+    if is_cancelled is not None and is_cancelled():
+        raise RenderCancelled('Client disconnected')
+
+    if time.time() > deadline:
+        raise RenderTimeout('Render took too long')
+
+def _kill(process):
+    try:
+        process.kill()
+    except OSError:
+        # Already exited
+        pass
+
+def client_disconnected():
+    """ Function telling whether the client of the current request went away,
+    or None when that can't be told (outside uWSGI) """
+    try:
+        import uwsgi
+    except ImportError:
+        return None
+
+    fd = uwsgi.connection_fd()
+
+    return lambda: not uwsgi.is_connected(fd)
+
+render_pool = RenderPool()
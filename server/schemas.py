@@ -1,5 +1,5 @@
 from __future__ import print_function
-from marshmallow import fields
+from marshmallow import fields, utils
 from flask_marshmallow import Marshmallow
 
 from app import app
@@ -18,7 +18,8 @@ class UnitSchema(ma.ModelSchema):
         exclude = ('unit_topics',)
 
 class UnitSchemaWithCount(ma.ModelSchema):
-    num_topics = fields.Function(lambda x: len(x.unit_topics))
+    # Counted by the query, see api.units
+    num_topics = fields.Integer()
     class Meta:
         model = Unit
         exclude = ('unit_topics',)
@@ -28,3 +29,124 @@ def SchemaFactory(model, fields):
     dict['Meta'] = type('Meta', (), {'model': model})
 
     return type(model.__name__ + 'Schema', (ma.ModelSchema,), dict)
+
+def unit_topic_fields(embed):
+    """ Fields of unit topics, with given relationships embedded. Others are
+    dumped as ids, same as ModelSchema does, but without it querying the
+    whole related table for every value """
+    schema_fields = {
+        'unit': fields.Function(lambda unit_topic: unit_topic.unit_id),
+        'topic': fields.Function(lambda unit_topic: unit_topic.topic_id),
+        'contexts': fields.Function(lambda unit_topic: [t.id for t in unit_topic.contexts]),
+    }
+
+    if 'topic' in embed:
+        schema_fields['topic'] = fields.Nested(TopicSchema)
+
+    if 'unit' in embed:
+        schema_fields['unit'] = fields.Nested(UnitSchema)
+
+    if 'contexts' in embed:
+        schema_fields['contexts'] = fields.Nested(TopicSchema, many=True)
+
+    return schema_fields
+
+def _converter(field):
+    """ Function formatting a column value the same way the field does """
+    if isinstance(field, fields.Boolean):
+        convert = bool
+    elif isinstance(field, fields.Number) and not field.as_string:
+        convert = field.num_type
+    elif isinstance(field, fields.String):
+        convert = utils.ensure_text_type
+    elif isinstance(field, fields.Function):
+        # Values are expected to be given as the function would return them
+        return lambda value: value
+    else:
+        raise TypeError('Fields of type %s have no fast dump path' % type(field).__name__)
+
+    return lambda value: None if value is None else convert(value)
+
+class RowDumper(object):
+    """ Builds the same dicts as dumping objects with a schema, straight from
+    row tuples, without constructing any objects.
+
+    `columns` names the values of a row. These are fields of the schema, and
+    fields of schemas nested in it as 'field.nested_field'. Values of other
+    fields are passed to `dump` as keyword arguments: collections of nested
+    schemas as lists of rows, whose columns are named the same way, and
+    anything else as it would be dumped. """
+
+    def __init__(self, schema, columns):
+        self.columns = []   # (name, position within a row, converter)
+        self.nested = []    # (name, RowDumper, positions within a row)
+        self.keywords = []  # (name, converter or RowDumper)
+
+        collections = set(name for name, field in schema.fields.iteritems()
+            if isinstance(field, fields.Nested) and field.many)
+
+        def nested_columns(name, columns):
+            return [c[len(name) + 1:] for c in columns if c.startswith(name + '.')]
+
+        row_columns = [c for c in columns if c.split('.')[0] not in collections]
+
+        for name, field in schema.fields.iteritems():
+            if name in collections:
+                dumper = RowDumper(field.schema, nested_columns(name, columns))
+                self.keywords.append((name, dumper))
+            elif name in row_columns:
+                self.columns.append((name, row_columns.index(name), _converter(field)))
+            elif isinstance(field, fields.Nested):
+                positions = [i for i, c in enumerate(row_columns) if c.startswith(name + '.')]
+                dumper = RowDumper(field.schema, nested_columns(name, row_columns))
+                self.nested.append((name, dumper, positions))
+            else:
+                self.keywords.append((name, _converter(field)))
+
+    def dump(self, row, **values):
+        data = dict((name, convert(row[i])) for name, i, convert in self.columns)
+
+        for name, dumper, positions in self.nested:
+            data[name] = dumper.dump([row[i] for i in positions])
+
+        for name, convert in self.keywords:
+            if isinstance(convert, RowDumper):
+                data[name] = [convert.dump(r) for r in values[name]]
+            else:
+                data[name] = convert(values[name])
+
+        return data
+
+class SerializerRegistry(object):
+    """ Schema classes and row dumpers, built once per model and set of
+    embedded relationships rather than on every request """
+
+    def __init__(self):
+        self.field_factories = {}   # model -> function of embed to fields
+        self.schemas = {}           # (model, embed) -> schema class
+        self.dumpers = {}           # (schema class, columns) -> RowDumper
+
+    def register(self, model, field_factory):
+        self.field_factories[model] = field_factory
+
+    def schema(self, model, embed=()):
+        key = (model, frozenset(embed))
+
+        if key not in self.schemas:
+            self.schemas[key] = SchemaFactory(model, self.field_factories[model](key[1]))
+
+        return self.schemas[key]
+
+    def row_dumper(self, schema_class, columns):
+        key = (schema_class, tuple(columns))
+
+        if key not in self.dumpers:
+            self.dumpers[key] = RowDumper(schema_class(), list(columns))
+
+        return self.dumpers[key]
+
+    def dumper(self, model, embed=(), columns=()):
+        return self.row_dumper(self.schema(model, embed), columns)
+
+serializers = SerializerRegistry()
+serializers.register(UnitTopic, unit_topic_fields)
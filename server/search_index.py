@@ -0,0 +1,489 @@
+import re
+import sys
+import time
+import heapq
+import operator
+import itertools
+import threading
+from bisect import bisect_left, insort
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history, PASSIVE_NO_INITIALIZE
+
+from models import *
+import data_version
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+
+# Sorts after any character of a word, so words starting with a prefix sort
+# before the prefix followed by it
+MAX_CHARACTER = unichr(sys.maxunicode)
+
+# Weights of matches in each field of a topic
+NAME = 8
+ALIAS = 4
+KEYWORD = 2
+CATEGORY = 1
+DESCRIPTION = 1
+
+# Prefixes matching at least this many topics keep their matches, so that
+# they aren't gathered from every word starting with them on each keystroke,
+# and the best TOP_RESULTS results of searching for them alone, until their
+# matches change. They are dropped once they match half as many
+POPULAR_PREFIX = 100
+TOP_RESULTS = 100
+
+def tokenize(text):
+    return [token.lower() for token in TOKEN.findall(text or u'')]
+
+def category_label(name):
+    return name.split(':', 1)[-1]
+
+class SearchIndex(object):
+    """ In-memory index of topics by the words of their names, aliases given
+    to them by units, keywords and descriptions of custom topics, and names
+    of their categories.
+
+    Words of a query are matched as prefixes of indexed words, so that
+    suggestions can be given as a query is typed. Topics matching every word
+    are ranked by where the words were found, then by how many units use the
+    topic. Matches of prefixes shared by many topics, such as single letters,
+    are kept with the index, so that they only have to be ranked, and so are
+    results of searching for them alone.
+
+    Like the graph index, it is only enabled with `SEARCH_INDEX`, built at
+    startup and kept up to date from session events. Changes made by other processes are caught by comparing
+    the data version every `SEARCH_INDEX_CHECK_INTERVAL` seconds, and
+    rebuilding the index if it changed. As the version also changes with
+    local commits, that may rebuild an index which was already up to date,
+    at most once per interval. """
+
+    def __init__(self):
+        self.enabled = False
+        self.check_interval = None
+        self.last_check = 0
+        self.version = None
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        self.topics = {}                # id -> {'name', 'type', 'description', 'keywords'}
+        self.categories = {}            # id -> name
+        self.unit_topics = {}           # id -> (unit id, topic id, alias)
+
+        self.topic_unit_topics = {}     # topic id -> set of unit topic ids
+        self.topic_categories = {}      # topic id -> set of category ids
+        self.category_topics = {}       # category id -> set of topic ids
+
+        self.postings = {}              # word -> {topic id: weight}
+        self.words = []                 # sorted words, for prefix lookups
+        self.topic_words = {}           # topic id -> {word: weight}
+        self.topic_names = {}           # topic id -> words of the name, for ranking
+        self.names = []                 # sorted (words of the name, topic id)
+
+        self.prefix_counts = {}         # prefix -> number of topics with words starting with it
+        self.popular = {}               # popular prefix -> {topic id: score}
+        self.popular_results = {}       # popular prefix -> best ranked results, once searched
+
+        self.is_built = False
+
+    def init_app(self, app):
+        self.enabled = app.config.get('SEARCH_INDEX', False)
+        self.check_interval = app.config.get('SEARCH_INDEX_CHECK_INTERVAL', 60)
+
+        if self.enabled:
+            with app.app_context():
+                self.build()
+
+    def build(self):
+        """ Loads all topics from the database """
+        with self.lock:
+            self.clear()
+            self.version = data_version.current()
+
+            for topic_id, name, type in db.session.query(Topic.id, Topic.name, Topic.type):
+                self.topics[topic_id] = {'name': name, 'type': type,
+                    'description': None, 'keywords': []}
+
+            for topic_id, description in db.session.query(CustomTopic.id, CustomTopic.description):
+                self.topics[topic_id]['description'] = description
+
+            for topic_id, keyword in db.session.query(custom_topic_keyword.c.custom_topic_id,
+                    Keyword.name).join(Keyword, Keyword.id == custom_topic_keyword.c.keyword_id):
+                self.topics[topic_id]['keywords'].append(keyword)
+
+            for category_id, name in db.session.query(Category.id, Category.name):
+                self.categories[category_id] = name
+
+            for topic_id, category_id in db.session.query(topic_category):
+                self._link_category(topic_id, category_id)
+
+            for row in db.session.query(UnitTopic.id, UnitTopic.unit_id,
+                    UnitTopic.topic_id, UnitTopic.alias):
+                self.set_unit_topic(*row)
+
+            for topic_id in self.topics:
+                self._index_topic(topic_id)
+
+            self.is_built = True
+            self.last_check = time.time()
+
+    def check_if_due(self):
+        """ Builds the index if it hasn't been, or rebuilds it if the data
+        version has changed since, and the check interval has passed """
+        if not self.is_built:
+            self.build()
+        elif self.check_interval is not None and \
+                time.time() - self.last_check >= self.check_interval:
+            if data_version.current() != self.version:
+                self.build()
+
+            self.last_check = time.time()
+
+    # Words of topics
+
+    def _fields(self, topic_id):
+        """ Words of the topic, with the weight of the field they come from """
+        topic = self.topics[topic_id]
+
+        yield NAME, topic['name']
+
+        for unit_topic_id in self.topic_unit_topics.get(topic_id, ()):
+            yield ALIAS, self.unit_topics[unit_topic_id][2]
+
+        for keyword in topic['keywords']:
+            yield KEYWORD, keyword
+
+        for category_id in self.topic_categories.get(topic_id, ()):
+            yield CATEGORY, category_label(self.categories[category_id])
+
+        yield DESCRIPTION, topic['description']
+
+    def _unindex_topic(self, topic_id):
+        name = self.topic_names.pop(topic_id, None)
+        if name is not None:
+            del self.names[bisect_left(self.names, (name, topic_id))]
+
+        words = self.topic_words.pop(topic_id, {})
+
+        for prefix in self._prefix_scores(words):
+            count = self.prefix_counts[prefix] = self.prefix_counts[prefix] - 1
+
+            if prefix in self.popular:
+                del self.popular[prefix][topic_id]
+                self.popular_results.pop(prefix, None)
+
+                if count < POPULAR_PREFIX // 2:
+                    del self.popular[prefix]
+            elif not count:
+                del self.prefix_counts[prefix]
+
+        for word in words:
+            postings = self.postings[word]
+            del postings[topic_id]
+
+            # Words stay in the sorted list until the next build, with no
+            # postings, rather than being deleted from the middle of it
+            if not postings:
+                del self.postings[word]
+
+    def _index_topic(self, topic_id):
+        self._unindex_topic(topic_id)
+
+        if topic_id not in self.topics:
+            return
+
+        words = {}
+        for weight, text in self._fields(topic_id):
+            for word in tokenize(text):
+                words[word] = max(words.get(word, 0), weight)
+
+        for word, weight in words.iteritems():
+            if word not in self.postings:
+                self.postings[word] = {}
+
+                i = bisect_left(self.words, word)
+                if i == len(self.words) or self.words[i] != word:
+                    self.words.insert(i, word)
+
+            self.postings[word][topic_id] = weight
+
+        self.topic_words[topic_id] = words
+
+        name = self.topic_names[topic_id] = u' '.join(tokenize(self.topics[topic_id]['name']))
+        insort(self.names, (name, topic_id))
+
+        for prefix, score in self._prefix_scores(words).iteritems():
+            count = self.prefix_counts[prefix] = self.prefix_counts.get(prefix, 0) + 1
+
+            if prefix in self.popular:
+                self.popular[prefix][topic_id] = score
+                self.popular_results.pop(prefix, None)
+            elif count >= POPULAR_PREFIX:
+                self.popular[prefix] = self._gather(prefix)
+
+    @staticmethod
+    def _prefix_scores(words):
+        """ Score of a topic with the given words for every prefix of them,
+        as in search """
+        scores = {}
+
+        for word, weight in words.iteritems():
+            for n in range(1, len(word)):
+                scores[word[:n]] = max(scores.get(word[:n], 0), weight * 0.5)
+
+        for word, weight in words.iteritems():
+            scores[word] = max(scores.get(word, 0), weight)
+
+        return scores
+
+    # Incremental updates. Each returns ids of topics to index again
+
+    def _link_category(self, topic_id, category_id):
+        self.topic_categories.setdefault(topic_id, set()).add(category_id)
+        self.category_topics.setdefault(category_id, set()).add(topic_id)
+
+    def set_unit_topic(self, unit_topic_id, unit_id, topic_id, alias):
+        affected = self.remove_unit_topic(unit_topic_id)
+
+        self.unit_topics[unit_topic_id] = (unit_id, topic_id, alias)
+        self.topic_unit_topics.setdefault(topic_id, set()).add(unit_topic_id)
+
+        return affected | set([topic_id])
+
+    def remove_unit_topic(self, unit_topic_id):
+        row = self.unit_topics.pop(unit_topic_id, None)
+
+        if row is None:
+            return set()
+
+        self.topic_unit_topics.get(row[1], set()).discard(unit_topic_id)
+        return set([row[1]])
+
+    def set_topic(self, topic_id, name, type, description):
+        topic = self.topics.setdefault(topic_id, {'keywords': []})
+        topic.update({'name': name, 'type': type, 'description': description})
+
+        return set([topic_id])
+
+    def remove_topic(self, topic_id):
+        self.topics.pop(topic_id, None)
+
+        for category_id in self.topic_categories.pop(topic_id, ()):
+            self.category_topics.get(category_id, set()).discard(topic_id)
+
+        return set([topic_id])
+
+    def add_topic_keyword(self, topic_id, keyword):
+        if topic_id in self.topics:
+            self.topics[topic_id]['keywords'].append(keyword)
+
+        return set([topic_id])
+
+    def remove_topic_keyword(self, topic_id, keyword):
+        keywords = self.topics.get(topic_id, {}).get('keywords', [])
+        if keyword in keywords:
+            keywords.remove(keyword)
+
+        return set([topic_id])
+
+    def set_category(self, category_id, name):
+        self.categories[category_id] = name
+        return set(self.category_topics.get(category_id, ()))
+
+    def remove_category(self, category_id):
+        self.categories.pop(category_id, None)
+        topic_ids = self.category_topics.pop(category_id, set())
+
+        for topic_id in topic_ids:
+            self.topic_categories.get(topic_id, set()).discard(category_id)
+
+        return topic_ids
+
+    def add_topic_category(self, topic_id, category_id):
+        self._link_category(topic_id, category_id)
+        return set([topic_id])
+
+    def remove_topic_category(self, topic_id, category_id):
+        self.topic_categories.get(topic_id, set()).discard(category_id)
+        self.category_topics.get(category_id, set()).discard(topic_id)
+
+        return set([topic_id])
+
+    def record_deleted_topics(self, session, topic_ids):
+        """ Topics deleted with bulk statements, which flush events don't
+        see, to be removed once the transaction commits """
+        if self.enabled and self.is_built:
+            session.info.setdefault('search_index_changes', []).extend(
+                ('remove_topic', topic_id) for topic_id in topic_ids)
+
+    def apply(self, changes):
+        with self.lock:
+            if not self.is_built:
+                return
+
+            affected = set()
+            for change in changes:
+                affected |= getattr(self, change[0])(*change[1:])
+
+            for topic_id in affected:
+                self._index_topic(topic_id)
+
+    # Queries
+
+    def _prefixed(self, prefix):
+        """ Indexed words starting with the prefix """
+        i = bisect_left(self.words, prefix)
+
+        while i < len(self.words) and self.words[i].startswith(prefix):
+            if self.words[i] in self.postings:
+                yield self.words[i]
+            i += 1
+
+    def _gather(self, prefix):
+        """ Topics with words starting with the prefix, scored by the weight
+        of the best of them. Whole words count more than prefixes """
+        matches = {}
+
+        for indexed_word in self._prefixed(prefix):
+            factor = 1.0 if indexed_word == prefix else 0.5
+
+            for topic_id, weight in self.postings[indexed_word].iteritems():
+                matches[topic_id] = max(matches.get(topic_id, 0), weight * factor)
+
+        return matches
+
+    def num_units(self, topic_id):
+        # Counting unit topics, as a unit normally has a topic only once
+        return len(self.topic_unit_topics.get(topic_id, ()))
+
+    def _rank(self, scores, query, limit):
+        """ Best `limit` of the scored topics, names starting with the query
+        first, as (score, topic id) """
+        # Names are few enough to look up, but scores may be of thousands of
+        # topics, so they are only compared with builtins
+        bonuses = {}
+        start = bisect_left(self.names, (query,))
+        end = bisect_left(self.names, (query + MAX_CHARACTER,), start)
+
+        for name, topic_id in self.names[start:end]:
+            if topic_id in scores:
+                bonuses[topic_id] = scores[topic_id] + (2 * NAME if name == query else NAME)
+
+        if bonuses:
+            scores = dict(scores)
+            scores.update(bonuses)
+
+        # Ordered by score, then number of units (scores are multiples of
+        # 0.5, so numbers of units scaled below that don't change their order),
+        # then name
+        topic_ids = scores.keys()
+        scale = 2 * len(self.unit_topics) + 2
+        num_units = map(len, map(self.topic_unit_topics.get, topic_ids,
+            itertools.repeat((), len(topic_ids))))
+        keys = map(operator.sub, map(operator.mul, scores.values(),
+            itertools.repeat(-scale, len(topic_ids))), num_units)
+
+        return [(scores[topic_id], topic_id) for _, _, topic_id in heapq.nsmallest(limit,
+            itertools.izip(keys, map(self.topic_names.__getitem__, topic_ids), topic_ids))]
+
+    def search(self, query, limit=10):
+        """ Best matching topics, as dicts with their id, name, type, score
+        and number of units using them """
+        words = tokenize(query)
+        if not words:
+            return []
+
+        query = u' '.join(words)
+
+        with self.lock:
+            if query in self.popular and limit <= TOP_RESULTS:
+                if query not in self.popular_results:
+                    self.popular_results[query] = self._rank(self.popular[query], query, TOP_RESULTS)
+
+                results = self.popular_results[query][:limit]
+            else:
+                found = dict((word, self.popular[word] if word in self.popular
+                    else self._gather(word)) for word in set(words))
+                matches = sorted((found[word] for word in words), key=len)
+
+                # Summed with builtins, as even topics matching every word
+                # may be thousands
+                topic_ids = list(set(matches[0]).intersection(*matches[1:]))
+                totals = map(matches[0].__getitem__, topic_ids)
+
+                for m in matches[1:]:
+                    totals = map(operator.add, totals, map(m.__getitem__, topic_ids))
+
+                scores = dict(itertools.izip(topic_ids, totals))
+
+                results = self._rank(scores, query, limit)
+
+            return [{'id': topic_id, 'name': self.topics[topic_id]['name'],
+                    'type': self.topics[topic_id]['type'],
+                    'score': score, 'num_units': self.num_units(topic_id)}
+                for score, topic_id in results]
+
+search_index = SearchIndex()
+
+# Changes are collected when flushed, and applied to the index only once the
+# transaction commits, same as for the graph index
+
+def _added_and_deleted(instance, key):
+    history = get_history(instance, key, passive=PASSIVE_NO_INITIALIZE)
+    return history.added or (), history.deleted or ()
+
+def _collect_changes(session):
+    changes = []
+
+    for instance in session.new.union(session.dirty):
+        if isinstance(instance, Topic):
+            changes.append(('set_topic', instance.id, instance.name, instance.type,
+                getattr(instance, 'description', None)))
+
+            added, deleted = _added_and_deleted(instance, 'categories')
+            changes.extend(('add_topic_category', instance.id, c.id) for c in added)
+            changes.extend(('remove_topic_category', instance.id, c.id) for c in deleted)
+
+            if isinstance(instance, CustomTopic):
+                added, deleted = _added_and_deleted(instance, 'keywords')
+                changes.extend(('add_topic_keyword', instance.id, k.name) for k in added)
+                changes.extend(('remove_topic_keyword', instance.id, k.name) for k in deleted)
+
+        elif isinstance(instance, Category):
+            changes.append(('set_category', instance.id, instance.name))
+
+            added, deleted = _added_and_deleted(instance, 'topics')
+            changes.extend(('add_topic_category', t.id, instance.id) for t in added)
+            changes.extend(('remove_topic_category', t.id, instance.id) for t in deleted)
+
+        elif isinstance(instance, UnitTopic):
+            changes.append(('set_unit_topic', instance.id, instance.unit_id,
+                instance.topic_id, instance.alias))
+
+    for instance in session.deleted:
+        if isinstance(instance, Topic):
+            changes.append(('remove_topic', instance.id))
+        elif isinstance(instance, Category):
+            changes.append(('remove_category', instance.id))
+        elif isinstance(instance, UnitTopic):
+            changes.append(('remove_unit_topic', instance.id))
+
+    return changes
+
+@event.listens_for(Session, 'after_flush')
+def _after_flush(session, flush_context):
+    if search_index.enabled and search_index.is_built:
+        session.info.setdefault('search_index_changes', []).extend(_collect_changes(session))
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    changes = session.info.pop('search_index_changes', None)
+
+    if changes:
+        search_index.apply(changes)
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('search_index_changes', None)
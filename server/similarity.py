@@ -0,0 +1,386 @@
+import time
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history, PASSIVE_NO_INITIALIZE
+
+try:
+    import numpy
+    import scipy.sparse
+except ImportError:
+    numpy = None
+
+from models import *
+import data_version
+
+# Units are compared a block of rows at a time, bounding the size of the
+# similarity matrix held at once
+BLOCK_SIZE = 256
+
+FLAGS = ('is_taught', 'is_assessed', 'is_applied')
+
+class UnitSimilarity(object):
+    """ Cosine similarity of units, by the topics they have.
+
+    Units are rows of a sparse unit x topic matrix. A unit topic counts 1,
+    plus the weight in `SIMILARITY_WEIGHTS` of each of is_taught, is_assessed
+    and is_applied set on it. With a `SIMILARITY_CATEGORY_WEIGHT`, rows also
+    get a column per category, of the unit's topics in it times that weight,
+    so that units with topics of the same categories count as similar too.
+
+    The `SIMILARITY_TOP_K` most similar units of every unit are computed
+    when it is built, with sparse matrix products. Rows are then kept apart,
+    along with the rows having each column, so that when a unit topic
+    changes, only its unit's row is replaced, and its scores are computed
+    from the rows sharing its columns. Only the top lists it appears in are
+    updated. Changes to categories of topics, and changes by other processes
+    (seen by the data version, every `SIMILARITY_CHECK_INTERVAL` seconds),
+    rebuild it on the next query.
+
+    Needs NumPy and SciPy, which are only imported when `SIMILARITY` is set. """
+
+    def __init__(self):
+        self.enabled = False
+        self.top_k = 20
+        self.weights = {}
+        self.category_weight = 0
+        self.check_interval = None
+        self.last_check = 0
+        self.version = None
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        self.unit_topics = {}       # unit topic id -> (unit id, topic id, weight)
+        self.unit_unit_topics = {}  # unit id -> set of unit topic ids
+        self.topic_categories = {}  # topic id -> set of category ids
+
+        self.rows = {}              # unit id -> row
+        self.unit_ids = []          # row -> unit id
+        self.columns = {}           # ('topic' or 'category', id) -> column
+        self.row_features = []      # row -> (columns, values), normalised
+        self.column_rows = {}       # column -> {row: value}
+
+        self.top = []               # row -> [(score, row)], most similar first
+        self.listed_in = []         # row -> set of rows listing it in their top
+
+        self.is_built = False
+        self.is_stale = False
+
+    def init_app(self, app):
+        self.enabled = app.config.get('SIMILARITY', False)
+        self.top_k = app.config.get('SIMILARITY_TOP_K', 20)
+        self.weights = app.config.get('SIMILARITY_WEIGHTS', {})
+        self.category_weight = app.config.get('SIMILARITY_CATEGORY_WEIGHT', 0)
+        self.check_interval = app.config.get('SIMILARITY_CHECK_INTERVAL', 60)
+
+        if self.enabled:
+            if numpy is None:
+                raise RuntimeError('SIMILARITY needs NumPy and SciPy installed')
+
+            with app.app_context():
+                self.build()
+
+    def weight(self, is_taught, is_assessed, is_applied):
+        return 1.0 + sum(self.weights.get(flag, 0) for flag, value in
+            zip(FLAGS, (is_taught, is_assessed, is_applied)) if value)
+
+    # Features of units
+
+    def _column(self, kind, id):
+        key = (kind, id)
+        column = self.columns.get(key)
+
+        if column is None:
+            column = self.columns[key] = len(self.columns)
+
+        return column
+
+    def _row(self, unit_id):
+        row = self.rows.get(unit_id)
+
+        if row is None:
+            row = self.rows[unit_id] = len(self.unit_ids)
+            self.unit_ids.append(unit_id)
+            self.row_features.append((numpy.zeros(0, numpy.int64), numpy.zeros(0)))
+            self.top.append([])
+            self.listed_in.append(set())
+
+        return row
+
+    def _features(self, unit_id):
+        """ Columns and normalised values of the unit's row """
+        features = {}
+
+        for unit_topic_id in self.unit_unit_topics.get(unit_id, ()):
+            _, topic_id, weight = self.unit_topics[unit_topic_id]
+
+            column = self._column('topic', topic_id)
+            features[column] = features.get(column, 0) + weight
+
+            if self.category_weight:
+                for category_id in self.topic_categories.get(topic_id, ()):
+                    column = self._column('category', category_id)
+                    features[column] = features.get(column, 0) + weight * self.category_weight
+
+        columns = numpy.fromiter(features.iterkeys(), numpy.int64, len(features))
+        values = numpy.fromiter(features.itervalues(), numpy.float64, len(features))
+
+        norm = numpy.sqrt(numpy.dot(values, values))
+        return columns, values / norm if norm else values
+
+    # Building
+
+    def build(self):
+        """ Loads unit topics from the database, and computes top lists of
+        all units """
+        with self.lock:
+            self.clear()
+            self.version = data_version.current()
+
+            for row in db.session.query(UnitTopic.id, UnitTopic.unit_id, UnitTopic.topic_id,
+                    UnitTopic.is_taught, UnitTopic.is_assessed, UnitTopic.is_applied):
+                self._set_unit_topic(*row)
+
+            if self.category_weight:
+                for topic_id, category_id in db.session.query(topic_category):
+                    self.topic_categories.setdefault(topic_id, set()).add(category_id)
+
+            rows, columns, values = [], [], []
+
+            for unit_id in sorted(self.unit_unit_topics):
+                row = self._row(unit_id)
+                unit_columns, unit_values = self._features(unit_id)
+                self._set_row(row, unit_columns, unit_values)
+
+                rows.append(numpy.repeat(row, len(unit_columns)))
+                columns.append(unit_columns)
+                values.append(unit_values)
+
+            if rows:
+                rows, columns, values = map(numpy.concatenate, (rows, columns, values))
+
+            # The matrix is only needed for the products of all rows
+            matrix = scipy.sparse.csr_matrix((values, (rows, columns)),
+                shape=(len(self.unit_ids), len(self.columns)))
+
+            transposed = matrix.T.tocsr()
+
+            for start in range(0, len(self.unit_ids), BLOCK_SIZE):
+                block = matrix[start:start + BLOCK_SIZE].dot(transposed).tocsr()
+
+                for i in range(block.shape[0]):
+                    entries = slice(block.indptr[i], block.indptr[i + 1])
+                    self._set_top(start + i, block.indices[entries], block.data[entries])
+
+            self.is_built = True
+            self.last_check = time.time()
+
+    def check_if_due(self):
+        """ Builds the index if it hasn't been or is stale, or rebuilds it if
+        the data version has changed since, and the check interval has passed """
+        if not self.is_built or self.is_stale:
+            self.build()
+        elif self.check_interval is not None and \
+                time.time() - self.last_check >= self.check_interval:
+            if data_version.current() != self.version:
+                self.build()
+
+            self.last_check = time.time()
+
+    # Top lists
+
+    def _set_top(self, row, rows, scores):
+        """ Sets the top list of the row, from scores of other rows """
+        for other in self.top[row]:
+            self.listed_in[other[1]].discard(row)
+
+        others = rows != row
+        rows, scores = rows[others], scores[others]
+
+        if len(scores) > self.top_k:
+            best = numpy.argpartition(-scores, self.top_k - 1)[:self.top_k]
+            rows, scores = rows[best], scores[best]
+
+        self.top[row] = sorted(zip(scores.tolist(), rows.tolist()), key=lambda x: (-x[0], x[1]))
+
+        for _, other in self.top[row]:
+            self.listed_in[other].add(row)
+
+    def _recompute_top(self, row):
+        self._set_top(row, *self._scores(row))
+
+    def _set_score(self, row, other, score):
+        """ Updates the top list of `row` with a new score for `other`. The
+        list is recomputed if `other` drops out of it and so another row may
+        take its place """
+        top = self.top[row]
+        is_full = len(top) >= self.top_k
+        listed = [i for i, (_, r) in enumerate(top) if r == other]
+
+        if listed:
+            # Rows left out of a full list scored at most its last score
+            if is_full and score < top[-1][0]:
+                self._recompute_top(row)
+                return
+
+            del top[listed[0]]
+
+            if score <= 0:
+                self.listed_in[other].discard(row)
+                return
+
+        elif score <= 0 or is_full and score <= top[-1][0]:
+            return
+
+        top.append((score, other))
+        top.sort(key=lambda x: (-x[0], x[1]))
+
+        if len(top) > self.top_k:
+            _, dropped = top.pop()
+            self.listed_in[dropped].discard(row)
+
+        self.listed_in[other].add(row)
+
+    # Rows
+
+    def _set_row(self, row, columns, values):
+        """ Replaces the row, and its values in the rows of its old and new columns """
+        for column in self.row_features[row][0].tolist():
+            del self.column_rows[column][row]
+
+        for column, value in zip(columns.tolist(), values.tolist()):
+            self.column_rows.setdefault(column, {})[row] = value
+
+        self.row_features[row] = (columns, values)
+
+    def _scores(self, row):
+        """ Rows sharing columns with the row, and their dot products with it """
+        scores = {}
+        columns, values = self.row_features[row]
+
+        for column, value in zip(columns.tolist(), values.tolist()):
+            for other, other_value in self.column_rows[column].iteritems():
+                scores[other] = scores.get(other, 0) + value * other_value
+
+        return (numpy.fromiter(scores.iterkeys(), numpy.int64, len(scores)),
+            numpy.fromiter(scores.itervalues(), numpy.float64, len(scores)))
+
+    def _update_unit(self, unit_id):
+        """ Replaces the unit's row, then updates its top list and those of
+        units whose similarity to it changed """
+        row = self._row(unit_id)
+        self._set_row(row, *self._features(unit_id))
+
+        rows, scores = self._scores(row)
+        others = dict(zip(rows.tolist(), scores.tolist()))
+
+        self._set_top(row, rows, scores)
+
+        for other in set(others) | self.listed_in[row]:
+            if other != row:
+                self._set_score(other, row, others.get(other, 0))
+
+    # Incremental updates
+
+    def _set_unit_topic(self, unit_topic_id, unit_id, topic_id, is_taught, is_assessed, is_applied):
+        affected = self._remove_unit_topic(unit_topic_id)
+
+        self.unit_topics[unit_topic_id] = (unit_id, topic_id,
+            self.weight(is_taught, is_assessed, is_applied))
+        self.unit_unit_topics.setdefault(unit_id, set()).add(unit_topic_id)
+
+        return affected | set([unit_id])
+
+    def _remove_unit_topic(self, unit_topic_id):
+        row = self.unit_topics.pop(unit_topic_id, None)
+
+        if row is None:
+            return set()
+
+        self.unit_unit_topics.get(row[0], set()).discard(unit_topic_id)
+        return set([row[0]])
+
+    def apply(self, changes):
+        with self.lock:
+            if not self.is_built or self.is_stale:
+                return
+
+            affected = set()
+            for change in changes:
+                if change[0] == 'stale':
+                    self.is_stale = True
+                    return
+
+                method = self._set_unit_topic if change[0] == 'set_unit_topic' else self._remove_unit_topic
+                affected |= method(*change[1:])
+
+            for unit_id in sorted(affected):
+                self._update_unit(unit_id)
+
+    # Queries
+
+    def similar(self, unit_id, limit=10):
+        """ Most similar units, as (unit id, score, number of shared topics) """
+        with self.lock:
+            row = self.rows.get(unit_id)
+
+            if row is None:
+                return []
+
+            topics = self.topic_ids(unit_id)
+
+            return [(self.unit_ids[other], score,
+                    len(topics & self.topic_ids(self.unit_ids[other])))
+                for score, other in self.top[row][:limit]]
+
+    def topic_ids(self, unit_id):
+        return set(self.unit_topics[unit_topic_id][1]
+            for unit_topic_id in self.unit_unit_topics.get(unit_id, ()))
+
+unit_similarity = UnitSimilarity()
+
+# Changes are collected when flushed, and applied only once the transaction
+# commits, same as for the graph index
+
+def _categories_changed(instance, key):
+    history = get_history(instance, key, passive=PASSIVE_NO_INITIALIZE)
+    return bool(history.added or history.deleted)
+
+def _collect_changes(session):
+    changes = []
+
+    for instance in session.new.union(session.dirty):
+        if isinstance(instance, UnitTopic):
+            changes.append(('set_unit_topic', instance.id, instance.unit_id, instance.topic_id,
+                instance.is_taught, instance.is_assessed, instance.is_applied))
+
+        elif unit_similarity.category_weight and (
+                isinstance(instance, Topic) and _categories_changed(instance, 'categories') or
+                isinstance(instance, Category) and _categories_changed(instance, 'topics')):
+            changes.append(('stale',))
+
+    for instance in session.deleted:
+        if isinstance(instance, UnitTopic):
+            changes.append(('remove_unit_topic', instance.id))
+        elif isinstance(instance, Category) and unit_similarity.category_weight:
+            changes.append(('stale',))
+
+    return changes
+
+@event.listens_for(Session, 'after_flush')
+def _after_flush(session, flush_context):
+    if unit_similarity.enabled and unit_similarity.is_built:
+        session.info.setdefault('similarity_changes', []).extend(_collect_changes(session))
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    changes = session.info.pop('similarity_changes', None)
+
+    if changes:
+        unit_similarity.apply(changes)
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('similarity_changes', None)
@@ -0,0 +1,40 @@
+from contextlib import contextmanager
+from sqlalchemy import event
+
+from ..app import app
+from ..models import db
+
+# Registers the hook inserting the data version row, which has to happen before
+# tables are created, and would otherwise wait for the first test client
+from .. import data_version
+
+def setup_database(uri='sqlite://'):
+    """ Points the app to a fresh database, in-memory one by default """
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    app.config['TESTING'] = True
+
+    db.drop_all()
+    db.create_all()
+
+def test_client():
+    """ Client of the app with the API registered, as in init_app """
+    from ..api import api
+
+    if api.name not in app.blueprints:
+        app.register_blueprint(api, url_prefix='/api')
+
+    return app.test_client()
+
+@contextmanager
+def count_queries():
+    """ Counts statements sent to the database within the block """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
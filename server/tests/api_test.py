@@ -0,0 +1,514 @@
+import os
+import json
+import unittest
+import contextlib
+from collections import Counter
+from sqlalchemy import event
+from . import setup_database, count_queries, test_client
+from .graph_data_test import populate
+from ..app import app
+from ..models import *
+from ..render_pool import render_pool
+from ..instrumentation import metrics
+
+def data_queries(queries):
+    """ Queries other than reading the data version for the ETag """
+    return [q for q in queries if 'data_version' not in q]
+
+class ListingQueriesTest(unittest.TestCase):
+
+    URLS = ['/api/units', '/api/unit_topics', '/api/unit_topics?embed=topic',
+        '/api/unit_topics?embed=unit,topic,contexts',
+        '/api/unit_topics?unit_code=COMP00000|COMP00001&embed=unit']
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+        setup_database()
+        self.client = test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        self.ctx.pop()
+
+    def add_contexts(self):
+        for unit_topic in UnitTopic.query:
+            unit_topic.contexts = [unit_topic.topic]
+
+        db.session.commit()
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        return json.loads(response.data)
+
+    def test_query_count_is_constant(self):
+        populate(2)
+        self.add_contexts()
+
+        small = []
+        for url in self.URLS:
+            with count_queries() as queries:
+                self.get(url)
+            small.append(len(data_queries(queries)))
+
+        populate(30)
+        self.add_contexts()
+
+        for url, num_small in zip(self.URLS, small):
+            with count_queries() as queries:
+                self.get(url)
+            self.assertEqual(len(data_queries(queries)), num_small, url)
+            self.assertLessEqual(len(data_queries(queries)), 2, url)
+
+    def test_units_topic_counts(self):
+        populate(2)
+        db.session.add(Unit('COMP99999', 'No topics'))
+        db.session.commit()
+
+        units = self.get('/api/units')['units']
+
+        self.assertEqual([(u['code'], u['num_topics']) for u in units],
+            [('COMP00000', 3), ('COMP00001', 4), ('COMP99999', 0)])
+
+    def test_unit_topics_relationships(self):
+        populate(2)
+        self.add_contexts()
+
+        unit_topic = self.get('/api/unit_topics?unit_code=COMP00001')['unit_topics'][0]
+        self.assertEqual(unit_topic['topic'], unit_topic['contexts'][0])
+        self.assertIsInstance(unit_topic['unit'], int)
+
+        unit_topic = self.get('/api/unit_topics?unit_code=COMP00001&embed=unit,topic,contexts')\
+            ['unit_topics'][0]
+        self.assertEqual(unit_topic['unit']['code'], 'COMP00001')
+        self.assertEqual(unit_topic['contexts'], [unit_topic['topic']])
+
+class ConditionalGetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+        setup_database()
+        populate(2)
+        self.client = test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        self.ctx.pop()
+
+    def test_etag(self):
+        response = self.client.get('/api/units')
+        etag = response.headers['ETag']
+
+        self.assertIn('public', response.headers['Cache-Control'])
+        self.assertEqual(self.client.get('/api/units').headers['ETag'], etag)
+        self.assertNotEqual(self.client.get('/api/unit_topics').headers['ETag'], etag)
+
+        with count_queries() as queries:
+            response = self.client.get('/api/units', headers={'If-None-Match': etag})
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.data, '')
+        self.assertEqual(len(queries), 1)
+
+    def test_changes_bump_version(self):
+        etag = self.client.get('/api/units').headers['ETag']
+
+        response = self.client.post('/api/unit_topics/update', content_type='application/json',
+            data=json.dumps({'id': 1, 'alias': 'Alias', 'is_assessed': True,
+                'is_taught': True, 'is_applied': False, 'contexts': [{'id': 1}]}))
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get('/api/units', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_unversioned(self):
+        response = self.client.get('/api/enrichment')
+
+        self.assertNotIn('ETag', response.headers)
+
+class PaginationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+        setup_database()
+        populate(12)
+
+        # Same names, so that pages have to break ties by id
+        for unit in Unit.query:
+            unit.name = 'Unit'
+        db.session.commit()
+
+        self.client = test_client()
+        app.config['API_STREAM_BATCH_SIZE'] = 4
+
+    def tearDown(self):
+        app.config.pop('API_STREAM_BATCH_SIZE')
+        db.session.remove()
+        self.ctx.pop()
+
+    def get(self, url, status=200):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status)
+
+        return json.loads(response.data) if status == 200 else None
+
+    def pages(self, url, name, limit):
+        items = []
+        next = ''
+
+        while next is not None:
+            page = self.get('%s&limit=%d%s' % (url, limit, '&after=' + next if next else ''))
+            self.assertLessEqual(len(page[name]), limit)
+
+            items.extend(page[name])
+            next = page['next']
+
+        return items
+
+    def test_pages(self):
+        for url, name in [('/api/units?', 'units'),
+                ('/api/unit_topics?embed=topic,contexts', 'unit_topics'),
+                ('/api/unit_topics?topic_name=Topic 0.0|Topic 1.1|Topic 2.2&embed=unit', 'unit_topics')]:
+            expected = self.get(url)[name]
+
+            # Unordered listings are paged by id
+            if 'topic_name' not in url:
+                expected.sort(key=lambda item: item['id'])
+
+            for limit in (1, 5, len(expected), len(expected) + 1):
+                self.assertEqual(self.pages(url, name, limit), expected, (url, limit))
+
+    def test_stream(self):
+        for url, name in [('/api/units?', 'units'),
+                ('/api/unit_topics?unit_code=COMP00000|COMP00003&embed=unit,topic', 'unit_topics')]:
+            expected = self.get(url)[name]
+
+            self.assertEqual(self.get(url + '&stream')[name], expected)
+
+            for limit in (3, 4, 5, len(expected)):
+                self.assertEqual(self.get('%s&stream&limit=%d' % (url, limit)),
+                    self.get('%s&limit=%d' % (url, limit)))
+
+    def test_invalid(self):
+        self.get('/api/units?limit=0', 400)
+        self.get('/api/units?limit=x', 400)
+        self.get('/api/units?limit=1&after=x', 400)
+        self.get('/api/units?limit=1&after=WzEsIDJd', 400) # [1, 2]
+
+class GraphLayoutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+        setup_database()
+        populate(2)
+        self.client = test_client()
+        app.config['GRAPH_STYLE_PATH'] = os.path.join(os.path.dirname(__file__),
+            '..', 'graph_style.initial.json')
+
+    def tearDown(self):
+        app.config.pop('GRAPH_STYLE_PATH')
+        db.session.remove()
+        self.ctx.pop()
+
+    def test_json_layout(self):
+        response = self.client.get('/api/graph/unit/COMP00000?format=json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/json')
+
+        layout = json.loads(response.data)
+        nodes = dict((n['id'], n) for n in layout['nodes'])
+
+        self.assertEqual(nodes['unit_1']['kind'], 'unit')
+        self.assertEqual(nodes['unit_1']['style'], 'central_unit')
+        self.assertEqual(nodes['unit_1']['url'], '#/graph/unit/COMP00000')
+
+        for node in layout['nodes']:
+            self.assertIn(node['style'], layout['styles'])
+            self.assertGreater(node['width'], 0)
+
+        for source, target, style in layout['edges']:
+            self.assertIn(source, nodes)
+            self.assertIn(target, nodes)
+            self.assertIn(style, layout['styles'])
+
+        self.assertEqual(len(layout['bbox']), 4)
+
+    def test_path_and_overlap(self):
+        path = json.loads(self.client.get('/api/path/COMP00000/COMP00001').data)
+        self.assertEqual(path['length'], 2)
+        self.assertEqual([(node['type'], node['id']) for node in path['path']],
+            [('unit', 1), ('topic', 1), ('unit', 2)])
+        self.assertEqual(path['path'][0]['code'], 'COMP00000')
+
+        self.assertEqual(self.client.get('/api/path/COMP00000/COMP99999').status_code, 404)
+
+        overlap = json.loads(self.client.get('/api/overlap?unit_code=COMP00000|COMP00001').data)
+        self.assertEqual([unit['code'] for unit in overlap['units']], ['COMP00000', 'COMP00001'])
+        self.assertEqual(overlap['topics'], [{'id': 1, 'name': 'Topic 0.0',
+            'units': ['COMP00000', 'COMP00001']}])
+
+        self.assertEqual(self.client.get('/api/overlap?unit_code=COMP00000').status_code, 400)
+        self.assertEqual(self.client.get(
+            '/api/overlap?unit_code=COMP00000|COMP00001&min_units=3').status_code, 400)
+
+        kinds, edges = self.layout('/api/graph/path/COMP00000/COMP00001?format=json')
+        self.assertEqual(sorted(edges), [['unit_1', 'topic_1', 'edge'], ['unit_2', 'topic_1', 'edge']])
+
+        kinds, edges = self.layout('/api/graph/overlap?unit_code=COMP00000|COMP00001'
+            '&min_units=1&format=json')
+        self.assertEqual(Counter(style for _, _, style in edges),
+            {'edge': 7, 'category_edge': 6})
+
+    def test_path_index_rebuilt_only_after_changes(self):
+        url = '/api/path/COMP00000/COMP00001'
+        self.assertEqual(json.loads(self.client.get(url).data)['length'], 2)
+
+        # Reused while the data version stays the same
+        with count_queries() as queries:
+            self.assertEqual(json.loads(self.client.get(url).data)['length'], 2)
+        self.assertEqual(data_queries(queries), [])
+
+        db.session.delete(db.session.query(UnitTopic).filter_by(unit_id=2, topic_id=1).one())
+        db.session.commit()
+
+        # The units shared no other topic
+        self.assertIsNone(json.loads(self.client.get(url).data)['path'])
+
+    def test_invalid_format(self):
+        self.assertEqual(self.client.get('/api/graph?format=png').status_code, 400)
+
+    def layout(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        layout = json.loads(response.data)
+        return set(n['kind'] for n in layout['nodes']), layout['edges']
+
+    def test_units_overview(self):
+        populate(1)
+
+        kinds, edges = self.layout('/api/graph?format=json&detail=overview')
+        self.assertEqual(kinds, set(['unit']))
+        self.assertEqual(sorted(edges), [['unit_1', 'unit_2', 'shared_topics_edge'],
+            ['unit_1', 'unit_3', 'shared_topics_edge'], ['unit_2', 'unit_3', 'shared_topics_edge']])
+
+        self.assertEqual(self.layout('/api/graph?format=json')[0], set(['unit', 'topic']))
+
+        app.config['GRAPH_LOD_MAX_NODES'] = 10
+        try:
+            self.assertEqual(self.layout('/api/graph?format=json')[0], set(['unit']))
+            self.assertEqual(self.layout('/api/graph?format=json&detail=full')[0],
+                set(['unit', 'topic']))
+        finally:
+            app.config.pop('GRAPH_LOD_MAX_NODES')
+
+        self.assertEqual(self.client.get('/api/graph?detail=some').status_code, 400)
+
+    def test_render_pool_full(self):
+        render_pool.configure(1, 0, 30, 7)
+        render_pool.slots.acquire()
+
+        try:
+            response = self.client.get('/api/graph')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '7')
+
+            # Listings don't wait for graphs
+            self.assertEqual(self.client.get('/api/units').status_code, 200)
+        finally:
+            render_pool.slots.release()
+            render_pool.configure(0, 8, 30, 5)
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+        setup_database()
+        populate(2)
+        self.client = test_client()
+
+        app.config['METRICS'] = True
+        metrics.init_app(app)
+
+    def tearDown(self):
+        app.config.pop('METRICS')
+        metrics.init_app(app)
+        metrics.reset()
+
+        db.session.remove()
+        self.ctx.pop()
+
+    def test_server_timing(self):
+        response = self.client.get('/api/unit_topics?embed=unit')
+        timings = dict(entry.split(';', 1) for entry in
+            response.headers['Server-Timing'].split(', '))
+
+        # Data version and two data queries
+        self.assertIn('desc="3"', timings['sql'])
+        self.assertIn('serialize', timings)
+        self.assertIn('total', timings)
+
+        histograms = json.loads(self.client.get('/api/metrics').data)['metrics']
+
+        self.assertEqual(histograms['request.unit_topics']['count'], 1)
+        self.assertEqual(histograms['sql']['count'], 3)
+        self.assertEqual(histograms['sql']['buckets'][-1], ['inf', 3])
+
+    def test_no_queries_while_serializing(self):
+        serializing = []
+        queried_while_serializing = []
+        timer = metrics.timer
+
+        @contextlib.contextmanager
+        def tracking_timer(name):
+            with timer(name):
+                serializing.append(name == 'serialize')
+                try:
+                    yield
+                finally:
+                    serializing.pop()
+
+        def before_cursor_execute(*args):
+            queried_while_serializing.append(any(serializing))
+
+        metrics.timer = tracking_timer
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            for url in ['/api/unit_topics?embed=contexts', '/api/unit_topics?embed=contexts&limit=1',
+                    '/api/units?limit=1']:
+                response = self.client.get(url)
+                self.assertIn('serialize;', response.headers['Server-Timing'])
+        finally:
+            del metrics.timer
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+        self.assertTrue(queried_while_serializing)
+        self.assertFalse(any(queried_while_serializing))
+
+    def test_disabled(self):
+        app.config['METRICS'] = False
+        metrics.init_app(app)
+
+        self.assertNotIn('Server-Timing', self.client.get('/api/units').headers)
+        self.assertEqual(self.client.get('/api/metrics').status_code, 404)
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+        setup_database()
+        populate(2)
+        self.client = test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        self.ctx.pop()
+
+    def batch(self, operations, status_code=200):
+        response = self.client.post('/api/unit_topics/batch', content_type='application/json',
+            data=json.dumps({'operations': operations}))
+        self.assertEqual(response.status_code, status_code)
+
+        return json.loads(response.data)['results']
+
+    def test_batch(self):
+        results = self.batch([
+            {'op': 'add', 'unit_code': 'COMP00000', 'topic_name': 'New topic'},
+            {'op': 'add', 'unit_code': 'COMP00001', 'topic_name': 'New topic'},
+            {'op': 'add', 'unit_code': 'COMP00000', 'topic_name': 'Topic 1.0'},
+            {'op': 'add', 'unit_code': 'COMP00001', 'topic_name': 'Custom',
+                'topic_description': 'Description'},
+            {'op': 'update', 'id': 1, 'alias': 'Alias', 'is_assessed': True,
+                'is_taught': True, 'is_applied': False, 'contexts': [{'id': 4}, {'id': 5}]},
+            # Topic 1.1 isn't used by other units, topic 0.0 is
+            {'op': 'remove', 'unit_topic_id': 5},
+            {'op': 'remove', 'unit_topic_id': 7}])
+
+        self.assertEqual([result['status'] for result in results], ['ok'] * 7)
+        self.assertEqual([result['unit_topic_id'] for result in results[4:]], [1, 5, 7])
+
+        db.session.remove()
+
+        new_topic = Topic.query.filter_by(name='New topic').one()
+        self.assertEqual(sorted(unit_topic.unit.code for unit_topic in new_topic.unit_topics),
+            ['COMP00000', 'COMP00001'])
+        self.assertEqual(db.session.query(UnitTopic).get(results[2]['unit_topic_id']).topic_id, 4)
+        self.assertEqual(CustomTopic.query.filter_by(name='Custom').one().description, 'Description')
+
+        # Contexts of removed topics go with them
+        unit_topic = db.session.query(UnitTopic).get(1)
+        self.assertEqual(unit_topic.alias, 'Alias')
+        self.assertEqual([topic.id for topic in unit_topic.contexts], [4])
+
+        self.assertIsNone(db.session.query(Topic).get(5))
+        self.assertIsNotNone(db.session.query(Topic).get(1))
+        self.assertEqual(db.session.query(topic_category).filter_by(topic_id=5).count(), 0)
+
+    def test_nothing_applied_if_an_operation_fails(self):
+        results = self.batch([
+            {'op': 'add', 'unit_code': 'COMP00000', 'topic_name': 'New topic'},
+            {'op': 'add', 'unit_code': 'COMP99999', 'topic_name': 'New topic'},
+            {'op': 'remove', 'unit_topic_id': 5},
+            {'op': 'remove', 'unit_topic_id': 5},
+            {'op': 'update', 'id': 1},
+            {'op': 'rename'}], 400)
+
+        self.assertEqual([result['status'] for result in results],
+            ['skipped', 'error', 'skipped', 'error', 'error', 'error'])
+        self.assertEqual(results[1]['error'], 'Unknown unit COMP99999')
+
+        db.session.remove()
+        self.assertEqual(Topic.query.filter_by(name='New topic').count(), 0)
+        self.assertIsNotNone(db.session.query(UnitTopic).get(5))
+
+        response = self.client.post('/api/unit_topics/batch', content_type='application/json',
+            data=json.dumps({'operations': 'add'}))
+        self.assertEqual(response.status_code, 400)
+
+    def test_invalid_fields(self):
+        results = self.batch([
+            {'op': 'remove', 'unit_topic_id': [5]},
+            {'op': 'remove', 'unit_topic_id': {'id': 5}},
+            {'op': 'add', 'unit_code': ['COMP00000'], 'topic_name': 'New topic'},
+            {'op': 'update', 'id': 1, 'alias': None, 'is_assessed': True, 'is_taught': True,
+                'is_applied': False, 'contexts': ['4']},
+            {'op': 'update', 'id': 1, 'alias': None, 'is_assessed': True, 'is_taught': True,
+                'is_applied': False, 'contexts': [{'id': [4]}]},
+            {'op': ['add']},
+            {'op': 'remove', 'unit_topic_id': '5'}], 400)
+
+        self.assertEqual([result.get('error') for result in results], ['Invalid unit_topic_id',
+            'Invalid unit_topic_id', 'Invalid unit_code', 'Invalid contexts', 'Invalid contexts',
+            'Unknown operation', None])
+        self.assertEqual(results[-1]['status'], 'skipped')
+
+    def test_ids_given_as_strings(self):
+        results = self.batch([
+            {'op': 'update', 'id': '1', 'alias': None, 'is_assessed': True, 'is_taught': True,
+                'is_applied': False, 'contexts': [{'id': '4'}]},
+            {'op': 'remove', 'unit_topic_id': '5'}])
+
+        self.assertEqual([result['unit_topic_id'] for result in results], [1, 5])
+
+        db.session.remove()
+        self.assertEqual([topic.id for topic in db.session.query(UnitTopic).get(1).contexts], [4])
+        self.assertIsNone(db.session.query(UnitTopic).get(5))
+
+    def test_remove_deletes_orphan_topics(self):
+        for unit_topic_id in [4, 7]:
+            self.client.post('/api/unit_topics/remove', content_type='application/json',
+                data=json.dumps({'unit_topic_id': unit_topic_id}))
+
+        db.session.remove()
+        self.assertIsNone(db.session.query(Topic).get(4))
+        self.assertEqual(db.session.query(topic_category).filter_by(topic_id=4).count(), 0)
+        self.assertIsNotNone(db.session.query(Topic).get(1))
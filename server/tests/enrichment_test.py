@@ -0,0 +1,97 @@
+import os
+import tempfile
+import unittest
+
+from . import setup_database
+from .mediawiki_stub import MediaWikiStub
+from ..app import app
+from ..models import *
+from ..enrichment import CategoryEnricher
+from ..wikipedia import wikipedia
+
+class CategoryEnricherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.wiki = MediaWikiStub({
+            'Graph theory': ['Category:Graph theory', 'Category:Discrete mathematics'],
+            'Sorting algorithm': ['Category:Sorting algorithms']}).start()
+
+        app.config['WIKIPEDIA_API_URL'] = self.wiki.url
+        app.config['ENRICHMENT_WORKERS'] = 2
+        app.config['ENRICHMENT_ATTEMPTS'] = 2
+        app.config['ENRICHMENT_RETRY_DELAY'] = 0
+        wikipedia.init_app(app)
+
+        # Workers use their own connections, which wouldn't see an in-memory
+        # database
+        fd, self.db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+        setup_database('sqlite:///' + self.db_path)
+
+        self.enricher = CategoryEnricher()
+        self.enricher.init_app(app)
+
+    def tearDown(self):
+        self.wiki.stop()
+        db.session.remove()
+        self.ctx.pop()
+        os.remove(self.db_path)
+
+    def add_topic(self, name):
+        topic = Topic(name)
+        db.session.add(topic)
+        db.session.commit()
+        return topic.id
+
+    def categories_of(self, topic_id):
+        db.session.expire_all()
+        return sorted(c.name for c in db.session.query(Topic).get(topic_id).categories)
+
+    def test_categories_attached(self):
+        graph_id = self.add_topic('Graph theory')
+        missing_id = self.add_topic('No such article')
+
+        self.enricher.enqueue(graph_id, 'Graph theory')
+        self.enricher.enqueue(missing_id, 'No such article')
+        self.enricher.join()
+
+        self.assertEqual(self.categories_of(graph_id),
+            ['Category:Discrete mathematics', 'Category:Graph theory'])
+        self.assertEqual(self.categories_of(missing_id), [])
+        self.assertEqual(self.enricher.status(graph_id)['state'], 'done')
+        self.assertEqual(self.enricher.stats()['done'], 2)
+
+    def test_retries(self):
+        self.wiki.flaky = set(['Sorting algorithm'])
+        topic_id = self.add_topic('Sorting algorithm')
+
+        self.enricher.enqueue(topic_id, 'Sorting algorithm')
+        self.enricher.join()
+
+        self.assertEqual(self.enricher.status(topic_id)['attempts'], 2)
+        self.assertEqual(self.categories_of(topic_id), ['Category:Sorting algorithms'])
+
+    def test_gives_up(self):
+        app.config['ENRICHMENT_ATTEMPTS'] = 1
+        self.enricher.init_app(app)
+
+        self.wiki.flaky = set(['Sorting algorithm'])
+        topic_id = self.add_topic('Sorting algorithm')
+
+        self.enricher.enqueue(topic_id, 'Sorting algorithm')
+        self.enricher.join()
+
+        self.assertEqual(self.enricher.status(topic_id)['state'], 'failed')
+        self.assertEqual(self.categories_of(topic_id), [])
+
+    def test_removed_topic_skipped(self):
+        self.enricher.enqueue(12345, 'Graph theory')
+        self.enricher.join()
+
+        self.assertEqual(self.enricher.status(12345)['state'], 'skipped')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+from . import setup_database, count_queries
+from ..app import app
+from ..models import *
+from .. import graph_data
+
+def populate(num_units):
+    """ Adds units sharing topics, with three topics and one category per unit """
+    start = db.session.query(Unit).count()
+
+    for i in range(start, start + num_units):
+        unit = Unit('COMP%05d' % i, 'Unit %d' % i)
+        category = Category('Category:Category %d' % i)
+
+        topics = [Topic('Topic %d.%d' % (i, j)) for j in range(3)]
+        for topic in topics:
+            topic.categories = [category]
+
+        db.session.add(unit)
+        db.session.add_all(topics)
+        db.session.flush()
+
+        for topic in topics:
+            db.session.add(UnitTopic(unit.id, topic.id))
+
+        # Share a topic with the first unit
+        if i > 0:
+            db.session.add(UnitTopic(unit.id, 1))
+
+    db.session.commit()
+
+class GraphDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+        setup_database()
+
+    def tearDown(self):
+        db.session.remove()
+        self.ctx.pop()
+
+    def load_all_scopes(self):
+        return [graph_data.whole_graph(),
+            graph_data.unit_neighbourhood('COMP00000'),
+            graph_data.topic_neighbourhood(1),
+            graph_data.category_neighbourhood(1)]
+
+    def test_query_count_is_constant(self):
+        populate(2)
+        with count_queries() as small:
+            small_data = self.load_all_scopes()
+
+        populate(50)
+        with count_queries() as large:
+            large_data = self.load_all_scopes()
+
+        self.assertEqual(len(small), len(large))
+        self.assertGreater(len(large_data[0].edges), len(small_data[0].edges))
+
+    def test_unit_neighbourhood(self):
+        populate(3)
+        data = graph_data.unit_neighbourhood('COMP00000')
+
+        self.assertEqual(data.central.code, 'COMP00000')
+        self.assertEqual(set(data.topics), set([1, 2, 3]))
+        # Other units share topic 1
+        self.assertEqual(len(data.units), 3)
+        self.assertEqual(data.topic_categories[1], [1])
+
+    def test_topic_neighbourhood(self):
+        populate(3)
+        data = graph_data.topic_neighbourhood(1)
+
+        self.assertEqual(data.central.name, 'Topic 0.0')
+        self.assertEqual(len(data.units), 3)
+        # All topics of all three units
+        self.assertEqual(len(data.topics), 9)
+        self.assertEqual(len(data.categories), 3)
+
+    def test_category_neighbourhood(self):
+        populate(3)
+        data = graph_data.category_neighbourhood(2)
+
+        self.assertEqual(set(data.topics), set([4, 5, 6]))
+        self.assertEqual(data.units.keys(), [2])
+
+if __name__ == '__main__':
+    unittest.main()
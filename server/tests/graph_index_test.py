@@ -0,0 +1,143 @@
+import unittest
+from . import setup_database
+from .graph_data_test import populate
+from ..app import app
+from ..models import *
+from sqlalchemy.orm.exc import NoResultFound
+from .. import graph_data
+from ..graph_index import graph_index
+
+def as_tuple(data):
+    return (data.central, data.units.items(), data.topics.items(),
+        data.categories.items(), data.edges, data.topic_categories)
+
+class GraphIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+        setup_database()
+        populate(4)
+
+        graph_index.enabled = True
+        graph_index.build()
+
+    def tearDown(self):
+        graph_index.enabled = False
+        graph_index.clear()
+        db.session.remove()
+        self.ctx.pop()
+
+    def assertMatchesDatabase(self):
+        for scope, arg in [('whole_graph', None), ('unit_neighbourhood', 'COMP00000'),
+                ('unit_neighbourhood', 'COMP00002'), ('topic_neighbourhood', 1),
+                ('topic_neighbourhood', 5), ('category_neighbourhood', 1),
+                ('units_overlap', (['COMP00001', 'COMP00002'],)),
+                ('units_overlap', (['COMP00000', 'COMP00001', 'COMP00003'], 2))]:
+            args = () if arg is None else arg if isinstance(arg, tuple) else (arg,)
+            self.assertEqual(as_tuple(getattr(graph_index, scope)(*args)),
+                as_tuple(getattr(graph_data, scope)(*args)), scope)
+
+        self.assertEqual(graph_index.fingerprint(), graph_index.database_fingerprint())
+
+    def test_build(self):
+        self.assertMatchesDatabase()
+
+    def test_updated_on_commit(self):
+        topic = Topic('New topic')
+        topic.categories = [db.session.query(Category).get(2)]
+        db.session.add(topic)
+        db.session.flush()
+        db.session.add(UnitTopic(1, topic.id))
+
+        db.session.delete(db.session.query(UnitTopic).get(2))
+        db.session.query(Topic).get(3).categories = []
+
+        # Not applied until committed
+        db.session.flush()
+        self.assertNotIn(topic.id, graph_index.topics)
+
+        db.session.commit()
+        self.assertMatchesDatabase()
+
+    def test_bulk_deleted_orphan_topics_are_removed(self):
+        from ..api import delete_orphan_topics
+
+        db.session.delete(db.session.query(UnitTopic).get(4))
+        db.session.flush()
+        self.assertEqual(delete_orphan_topics([1, 4]), [4])
+
+        db.session.commit()
+        self.assertMatchesDatabase()
+
+    def test_shortest_path(self):
+        path = graph_index.unit_path('COMP00001', 'COMP00002')
+        self.assertEqual([(kind, row.id) for kind, row in path],
+            [('unit', 2), ('topic', 1), ('unit', 3)])
+
+        self.assertEqual(len(graph_index.unit_path('COMP00001', 'COMP00001')), 1)
+
+        # Through a category, unless paths may only go through topics
+        db.session.add(Unit('COMP99999', 'Unit 99'))
+        topic = Topic('Own topic')
+        topic.categories = [db.session.query(Category).get(3)]
+        db.session.add(topic)
+        db.session.flush()
+        db.session.add(UnitTopic(5, topic.id))
+        db.session.commit()
+
+        path = graph_index.unit_path('COMP99999', 'COMP00000')
+        self.assertEqual([kind for kind, _ in path],
+            ['unit', 'topic', 'category', 'topic', 'unit', 'topic', 'unit'])
+        self.assertIsNone(graph_index.unit_path('COMP99999', 'COMP00000', topics_only=True))
+
+        self.assertRaises(NoResultFound, graph_index.unit_path, 'COMP00000', 'COMP12345')
+
+    def test_shortest_path_is_shortest(self):
+        # Compared with a search from one end, on a chain of units linked by
+        # one topic each, and shortcuts
+        populate(6)
+        for unit_id in range(1, 10):
+            topic = Topic('Link %d' % unit_id)
+            db.session.add(topic)
+            db.session.flush()
+            db.session.add_all([UnitTopic(unit_id, topic.id), UnitTopic(unit_id + 1, topic.id)])
+        db.session.commit()
+
+        def one_sided(source, target):
+            distances = {source: 0}
+            frontier = [source]
+            while frontier:
+                node = frontier.pop(0)
+                for neighbour in graph_index._neighbours(node, False):
+                    if neighbour not in distances:
+                        distances[neighbour] = distances[node] + 1
+                        frontier.append(neighbour)
+            return distances.get(target)
+
+        for source in range(1, 11):
+            for target in range(1, 11):
+                path = graph_index.shortest_path(('unit', source), ('unit', target))
+                self.assertEqual(len(path) - 1, one_sided(('unit', source), ('unit', target)))
+
+                for node, next_node in zip(path, path[1:]):
+                    self.assertIn(next_node, graph_index._neighbours(node, False))
+
+    def test_rollback_discards_changes(self):
+        db.session.add(Unit('COMP99999', 'Rolled back'))
+        db.session.flush()
+        db.session.rollback()
+
+        self.assertNotIn('COMP99999', graph_index.unit_codes)
+
+    def test_check_rebuilds_after_bulk_changes(self):
+        db.session.query(UnitTopic).filter(UnitTopic.unit_id == 2).\
+            delete(synchronize_session=False)
+        db.session.commit()
+
+        self.assertFalse(graph_index.check())
+        self.assertTrue(graph_index.check())
+        self.assertMatchesDatabase()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import unittest
+from . import setup_database
+from ..app import app
+from ..models import *
+
+import add_initial_data
+
+def record(row, concept, unit_code='COMP10001', taught='y', context=None):
+    values = [concept, None, unit_code, taught, 'n', 'n', context]
+
+    record = dict(zip([field for _, field in add_initial_data.HEADERS], values))
+    record['Row'] = row
+    record['Checksum'] = add_initial_data.row_checksum(values)
+
+    return record
+
+class IncrementalImportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+        setup_database()
+
+        db.session.add(Unit('COMP10001', 'Unit 1'))
+        db.session.add(Unit('COMP10002', 'Unit 2'))
+        db.session.commit()
+
+        self.records = [record(2, 'UOM:Topic_A'), record(3, 'UOM:Topic_B'),
+            record(4, 'UOM:Topic_C', context='UOM:Topic_A')]
+
+    def tearDown(self):
+        db.session.remove()
+        self.ctx.pop()
+
+    def sync(self, records, checksum='1'):
+        errors = []
+        changes = add_initial_data.sync_workbook('units.xlsx', checksum, records, errors)
+        db.session.commit()
+
+        self.assertEqual(errors, [])
+
+        return sorted((c.type, c.unit_code, c.topic_name) for c in changes)
+
+    def unit_topics(self):
+        return sorted((ut.unit.code, ut.topic.name, ut.is_taught,
+            [t.name for t in ut.contexts]) for ut in UnitTopic.query)
+
+    def test_first_sync_adds_rows(self):
+        self.assertEqual(self.sync(self.records), [('added', 'COMP10001', 'Topic A'),
+            ('added', 'COMP10001', 'Topic B'), ('added', 'COMP10001', 'Topic C')])
+        self.assertEqual(self.unit_topics(), [
+            ('COMP10001', 'Topic A', True, []),
+            ('COMP10001', 'Topic B', True, []),
+            ('COMP10001', 'Topic C', True, ['Topic A'])])
+
+    def test_unchanged_rows_are_kept(self):
+        self.sync(self.records)
+
+        unit_topic = UnitTopic.query.first()
+        unit_topic.alias = 'Edited in the app'
+        db.session.commit()
+
+        self.assertEqual(self.sync(list(reversed(self.records)), '2'), [])
+        self.assertEqual(UnitTopic.query.get(unit_topic.id).alias, 'Edited in the app')
+
+    def test_changes(self):
+        self.sync(self.records)
+        topic_a_id = UnitTopic.query.first().id
+
+        records = [record(2, 'UOM:Topic_A', taught='n'), record(3, 'UOM:Topic_D'),
+            record(4, 'UOM:Topic_C', context='UOM:Topic_A')]
+
+        self.assertEqual(self.sync(records, '2'), [('added', 'COMP10001', 'Topic D'),
+            ('removed', 'COMP10001', 'Topic B'), ('updated', 'COMP10001', 'Topic A')])
+        self.assertEqual(self.unit_topics(), [
+            ('COMP10001', 'Topic A', False, []),
+            ('COMP10001', 'Topic C', True, ['Topic A']),
+            ('COMP10001', 'Topic D', True, [])])
+
+        # Updated in place, and the orphaned topic is removed
+        self.assertEqual(UnitTopic.query.first().id, topic_a_id)
+        self.assertIsNone(Topic.query.filter_by(name='Topic B').first())
+
+        self.assertEqual(len(ImportedRow.query.all()), 3)
+
+    def test_existing_unit_topics_are_adopted(self):
+        topic = CustomTopic('Topic A')
+        db.session.add(topic)
+        db.session.flush()
+        db.session.add(UnitTopic(Unit.query.filter_by(code='COMP10001').one().id, topic.id))
+        db.session.commit()
+
+        self.assertEqual(self.sync(self.records[:1]), [('updated', 'COMP10001', 'Topic A')])
+        self.assertEqual(len(UnitTopic.query.all()), 1)
+
+    def test_removed_workbook(self):
+        self.sync(self.records)
+
+        self.assertEqual([c[0] for c in self.sync([], None)], ['removed'] * 3)
+        self.assertEqual(UnitTopic.query.all(), [])
@@ -0,0 +1,110 @@
+import json
+import threading
+import urlparse
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+class MediaWikiHandler(BaseHTTPRequestHandler):
+    """ Answers action=query requests the way the MediaWiki API does, for the
+    pages of the server it belongs to """
+
+    def do_GET(self):
+        params = dict((k, v[0].decode('utf-8')) for k, v in
+            urlparse.parse_qs(urlparse.urlparse(self.path).query).iteritems())
+
+        status, response = self.server.respond(params)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(response))
+
+    def log_message(self, *args):
+        pass
+
+class MediaWikiStub(HTTPServer):
+    """ Local MediaWiki API, serving given pages and their categories.
+
+    `flaky` titles fail with 503 the first time they are requested. At most
+    `category_limit` categories are returned per response, the rest have to
+    be continued. All requests are recorded in `requests`. """
+
+    def __init__(self, pages):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), MediaWikiHandler)
+
+        self.pages = pages # title -> categories
+        self.flaky = set()
+        self.category_limit = None
+        self.requests = []
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/w/api.php' % self.server_port
+
+    def start(self):
+        threading.Thread(target=self.serve_forever).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    @staticmethod
+    def normalize(title):
+        title = title.replace('_', ' ').strip()
+        return title[:1].upper() + title[1:]
+
+    def respond(self, params):
+        self.requests.append(params)
+
+        titles = params['titles'].split('|')
+
+        failing = self.flaky.intersection(titles)
+        if failing:
+            self.flaky.difference_update(failing)
+            return 503, {'error': 'Service unavailable'}
+
+        query = {'pageids': [], 'pages': {}}
+        response = {'query': query}
+
+        # Categories of all requested pages, as one list to be paged through
+        offset = int(params.get('clcontinue', 0))
+        limit = self.category_limit
+        category_index = 0
+
+        normalized = [{'from': t, 'to': self.normalize(t)}
+            for t in titles if t != self.normalize(t)]
+        if normalized:
+            query['normalized'] = normalized
+
+        pageids = dict((title, i + 1) for i, title in enumerate(sorted(self.pages)))
+
+        for i, title in enumerate(titles):
+            title = self.normalize(title)
+
+            if title in self.pages:
+                pageid = str(pageids[title])
+                page = {'pageid': int(pageid), 'ns': 0, 'title': title}
+
+                if params.get('prop') == 'categories':
+                    categories = []
+
+                    for category in self.pages[title]:
+                        if category_index >= offset and \
+                                (limit is None or category_index < offset + limit):
+                            categories.append({'ns': 14, 'title': category})
+                        category_index += 1
+
+                    if categories:
+                        page['categories'] = categories
+            else:
+                pageid = str(-1 - i)
+                page = {'ns': 0, 'title': title, 'missing': ''}
+
+            if pageid not in query['pages']:
+                query['pageids'].append(pageid)
+                query['pages'][pageid] = page
+
+        if limit is not None and category_index > offset + limit:
+            response['continue'] = {'clcontinue': str(offset + limit), 'continue': '||'}
+
+        return 200, response
@@ -0,0 +1,49 @@
+import shutil
+import tempfile
+import unittest
+from ..render_cache import MemoryBackend, FileBackend
+
+class MemoryBackendTest(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        backend = MemoryBackend(max_entries=2)
+        backend.set('a', 'A', ['unit_1'])
+        backend.set('b', 'B', ['unit_2'])
+        backend.get('a')
+        backend.set('c', 'C', ['unit_3'])
+
+        self.assertEqual(backend.get('a'), 'A')
+        self.assertIsNone(backend.get('b'))
+        self.assertEqual(backend.get('c'), 'C')
+
+    def test_invalidate_by_tag(self):
+        backend = MemoryBackend()
+        backend.set('a', 'A', ['unit_1', 'topic_1'])
+        backend.set('b', 'B', ['unit_2', 'topic_2'])
+
+        self.assertEqual(backend.invalidate(['topic_1']), 1)
+        self.assertIsNone(backend.get('a'))
+        self.assertEqual(backend.get('b'), 'B')
+
+class FileBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_invalidate_by_tag(self):
+        backend = FileBackend(self.path)
+        backend.set('a', '<svg/>', ['unit_1', 'category_3'])
+        backend.set('b', '<svg></svg>', ['unit_2'])
+
+        # Entries are visible to other instances, e.g. in other workers
+        self.assertEqual(FileBackend(self.path).get('a'), '<svg/>')
+
+        self.assertEqual(backend.invalidate(['category_3']), 1)
+        self.assertIsNone(backend.get('a'))
+        self.assertEqual(backend.get('b'), '<svg></svg>')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import time
+import threading
+import unittest
+from ..render_pool import RenderPool, RenderError, RenderPoolFull, RenderTimeout, \
+    RenderCancelled
+
+class RenderPoolTest(unittest.TestCase):
+
+    def test_run(self):
+        pool = RenderPool(workers=1)
+
+        self.assertEqual(pool.run(['cat'], u'graph { a -- b }'), 'graph { a -- b }')
+        self.assertRaises(RenderError, pool.run, ['false'], '')
+
+    def test_timeout(self):
+        pool = RenderPool(workers=1, timeout=0.2)
+
+        start = time.time()
+        self.assertRaises(RenderTimeout, pool.run, ['sleep', '10'], '')
+        self.assertLess(time.time() - start, 2)
+
+        # The slot is free again
+        self.assertEqual(pool.run(['cat'], 'a'), 'a')
+
+    def test_cancelled(self):
+        pool = RenderPool(workers=1)
+        cancelled = []
+
+        timer = threading.Timer(0.1, cancelled.append, [True])
+        timer.start()
+
+        start = time.time()
+        self.assertRaises(RenderCancelled, pool.run, ['sleep', '10'], '',
+            lambda: bool(cancelled))
+        self.assertLess(time.time() - start, 2)
+
+    def test_queue_limit(self):
+        pool = RenderPool(workers=1, queue_size=1, timeout=5)
+        results = []
+
+        def render():
+            results.append(pool.run(['sh', '-c', 'sleep 0.3; cat'], 'x'))
+
+        threads = [threading.Thread(target=render) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.05)
+
+        # One render runs, one waits, so there is no room for another
+        self.assertRaises(RenderPoolFull, pool.run, ['cat'], 'y')
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, ['x', 'x'])
@@ -0,0 +1,59 @@
+import itertools
+import unittest
+from . import setup_database, test_client
+from .graph_data_test import populate
+from ..app import app
+from ..models import *
+from ..schemas import serializers, UnitSchemaWithCount
+
+class SerializerRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+        setup_database()
+        populate(3)
+
+        topic = CustomTopic('Custom topic')
+        topic.description = 'Described'
+        db.session.add(topic)
+        db.session.flush()
+
+        for i, unit_topic in enumerate(UnitTopic.query.order_by(UnitTopic.id)):
+            unit_topic.alias = 'Alias %d' % i if i % 2 else None
+            unit_topic.is_taught = bool(i % 3)
+            unit_topic.contexts = [topic, unit_topic.topic] if i % 2 else []
+
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        self.ctx.pop()
+
+    def test_schemas_are_memoized(self):
+        schema = serializers.schema(UnitTopic, ['unit', 'topic'])
+
+        self.assertIs(serializers.schema(UnitTopic, ('topic', 'unit')), schema)
+        self.assertIsNot(serializers.schema(UnitTopic, ['unit']), schema)
+
+    def test_fast_path_matches_schema_dump(self):
+        from ..api import dump_unit_topics
+
+        query = db.session.query(UnitTopic).join(Unit).join(Topic).order_by(Topic.name)
+
+        for n in range(4):
+            for embed in itertools.combinations(['unit', 'topic', 'contexts'], n):
+                schema = serializers.schema(UnitTopic, embed)(many=True)
+
+                self.assertEqual(dump_unit_topics(query, embed),
+                    schema.dump(query.all()).data, embed)
+
+    def test_units(self):
+        unit = Unit.query.first()
+        unit.num_topics = 3
+
+        dumper = serializers.row_dumper(UnitSchemaWithCount,
+            ['id', 'code', 'name', 'num_topics'])
+
+        self.assertEqual(dumper.dump((unit.id, unit.code, unit.name, 3)),
+            UnitSchemaWithCount().dump(unit).data)
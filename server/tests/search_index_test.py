@@ -0,0 +1,202 @@
+import json
+import unittest
+from . import setup_database, test_client
+from .graph_data_test import populate
+from ..app import app
+from ..models import *
+from .. import data_version
+from .. import search_index as search_index_module
+from ..search_index import search_index, POPULAR_PREFIX
+
+def names(results):
+    return [result['name'] for result in results]
+
+class SearchIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+        setup_database()
+        populate(4)
+
+        search_index.enabled = True
+        search_index.build()
+
+    def tearDown(self):
+        search_index_module.POPULAR_PREFIX = POPULAR_PREFIX
+        search_index.enabled = False
+        search_index.clear()
+        db.session.remove()
+        self.ctx.pop()
+
+    def search(self, query, limit=10):
+        return names(search_index.search(query, limit))
+
+    def test_prefixes_of_every_word_match(self):
+        # Words in any order, the name starting with the query first
+        self.assertEqual(self.search('topic 2.1'), ['Topic 2.1', 'Topic 1.2'])
+        self.assertEqual(self.search('TOP 3'), ['Topic 3.0', 'Topic 3.1', 'Topic 3.2'])
+        self.assertEqual(self.search('topic 9'), [])
+        self.assertEqual(self.search('  '), [])
+
+    def test_ranking(self):
+        # Topic 0.0 is used by every unit
+        self.assertEqual(self.search('topic', 2), ['Topic 0.0', 'Topic 0.1'])
+
+        db.session.add(Topic('Algorithms'))
+        db.session.add(Topic('Graph algorithms'))
+        db.session.add(Topic('Algorithmic game theory'))
+        db.session.commit()
+
+        # Whole names first, then names starting with the query
+        self.assertEqual(self.search('algorithm'),
+            ['Algorithmic game theory', 'Algorithms', 'Graph algorithms'])
+        self.assertEqual(self.search('algorithms'), ['Algorithms', 'Graph algorithms'])
+
+    def test_popular_prefixes(self):
+        queries = ['t', 'to', 'topic', 'topic 1', 't 1', 'c', 'category', '1', '3.', 'x']
+        expected = dict((query, self.search(query, 1000)) for query in queries)
+
+        search_index_module.POPULAR_PREFIX = 4
+        search_index.build()
+
+        self.assertIn('t', search_index.popular)
+        self.assertIn('topic', search_index.popular)
+
+        # Ranked in advance, the same as when ranked for the query
+        for query in queries:
+            self.assertEqual(self.search(query, 1000), expected[query])
+            self.assertEqual(self.search(query, 3), expected[query][:3])
+
+        topic = Topic('To')
+        db.session.add(topic)
+        db.session.commit()
+
+        self.assertEqual(self.search('to', 2), ['To', 'Topic 0.0'])
+
+        db.session.delete(topic)
+        db.session.commit()
+
+        self.assertEqual(self.search('to', 2), ['Topic 0.0', 'Topic 0.1'])
+
+    def test_aliases_keywords_descriptions_and_categories_match(self):
+        unit_topic = db.session.query(UnitTopic).filter_by(topic_id=2).one()
+        unit_topic.alias = 'Recursion'
+
+        topic = CustomTopic('Custom')
+        topic.description = 'Lambda calculus'
+        topic.keywords = [Keyword(name='functional')]
+        topic.categories = [Category('Category:Programming paradigms')]
+        db.session.add(topic)
+        db.session.commit()
+
+        self.assertEqual(self.search('recur'), ['Topic 0.1'])
+        self.assertEqual(self.search('lambda'), ['Custom'])
+        self.assertEqual(self.search('func'), ['Custom'])
+        self.assertEqual(self.search('paradigm'), ['Custom'])
+        self.assertEqual(search_index.search('custom')[0]['type'], 'custom_topic')
+
+        topic.keywords = []
+        topic.categories[0].name = 'Category:Programming languages'
+        db.session.commit()
+
+        self.assertEqual(self.search('func'), [])
+        self.assertEqual(self.search('paradigm'), [])
+        self.assertEqual(self.search('languages'), ['Custom'])
+
+    def test_updated_on_commit(self):
+        topic = db.session.query(Topic).get(5)
+        topic.name = 'Compilers'
+        db.session.flush()
+
+        # Not applied until committed
+        self.assertEqual(self.search('compilers'), [])
+
+        db.session.commit()
+        self.assertEqual(self.search('compilers'), ['Compilers'])
+        self.assertNotIn('Topic 1.1', self.search('topic'))
+
+        db.session.delete(topic)
+        db.session.commit()
+        self.assertEqual(self.search('compilers'), [])
+
+    def test_rollback_discards_changes(self):
+        db.session.add(Topic('Rolled back'))
+        db.session.flush()
+        db.session.rollback()
+
+        self.assertEqual(self.search('rolled'), [])
+
+    def test_rebuilt_after_changes_of_other_processes(self):
+        search_index.check_interval = 0
+
+        db.session.execute(Topic.__table__.update().where(Topic.id == 1).
+            values(name='Bulk renamed'))
+        db.session.commit()
+
+        # Bulk statements don't bump the version by themselves
+        search_index.check_if_due()
+        self.assertEqual(self.search('bulk'), [])
+
+        data_version.bump()
+        db.session.commit()
+
+        search_index.check_if_due()
+        self.assertEqual(self.search('bulk'), ['Bulk renamed'])
+
+class SearchEndpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+        setup_database()
+        populate(2)
+        self.client = test_client()
+
+        search_index.enabled = True
+
+    def tearDown(self):
+        search_index.enabled = False
+        search_index.clear()
+        db.session.remove()
+        self.ctx.pop()
+
+    def search(self, query, status_code=200):
+        response = self.client.get('/api/search?' + query)
+        self.assertEqual(response.status_code, status_code)
+
+        return response.status_code == 200 and json.loads(response.data)['results']
+
+    def test_search(self):
+        results = self.search('q=topic&limit=1')
+        self.assertEqual(results, [{'id': 1, 'name': 'Topic 0.0', 'type': 'topic',
+            'num_units': 2, 'score': results[0]['score']}])
+
+        self.search('q=topic&limit=0', 400)
+
+    def test_follows_added_and_removed_topics(self):
+        self.search('q=topic')
+
+        for name in ['Recursion', 'Recursive descent']:
+            response = self.client.post('/api/unit_topics/add', content_type='application/json',
+                data=json.dumps({'unit_code': 'COMP00001', 'topic_name': name,
+                    'topic_description': 'Custom'}))
+            self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(names(self.search('q=recurs')), ['Recursion', 'Recursive descent'])
+
+        unit_topic_id, = db.session.query(UnitTopic.id).join(Topic).\
+            filter(Topic.name == 'Recursion').one()
+        db.session.remove()
+
+        self.client.post('/api/unit_topics/remove', content_type='application/json',
+            data=json.dumps({'unit_topic_id': unit_topic_id}))
+
+        self.assertEqual(names(self.search('q=recurs')), ['Recursive descent'])
+
+    def test_disabled(self):
+        search_index.enabled = False
+        self.search('q=topic', 404)
+
+if __name__ == '__main__':
+    unittest.main()
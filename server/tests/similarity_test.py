@@ -0,0 +1,130 @@
+import json
+import random
+import unittest
+from . import setup_database, test_client
+from .graph_data_test import populate
+from ..app import app
+from ..models import *
+from ..similarity import unit_similarity, numpy
+
+def brute_force(weights, category_weight):
+    """ Similarity of every pair of units with a topic """
+    features = {}
+
+    for unit_id, topic_id, is_taught, is_assessed, is_applied in db.session.query(
+            UnitTopic.unit_id, UnitTopic.topic_id, UnitTopic.is_taught,
+            UnitTopic.is_assessed, UnitTopic.is_applied):
+        weight = 1.0 + sum(weights.get(flag, 0) for flag, value in zip(
+            ('is_taught', 'is_assessed', 'is_applied'), (is_taught, is_assessed, is_applied)) if value)
+
+        row = features.setdefault(unit_id, {})
+        row[('topic', topic_id)] = row.get(('topic', topic_id), 0) + weight
+
+        for category_id, in db.session.query(topic_category.c.category_id).\
+                filter(topic_category.c.topic_id == topic_id):
+            key = ('category', category_id)
+            row[key] = row.get(key, 0) + weight * category_weight
+
+    def similarity(a, b):
+        dot = sum(value * b.get(key, 0) for key, value in a.iteritems())
+        norm = lambda row: sum(value ** 2 for value in row.itervalues()) ** 0.5
+        return round(dot / (norm(a) * norm(b)), 9)
+
+    return dict(((unit_id, other_id), similarity(row, other_row))
+        for unit_id, row in features.iteritems()
+        for other_id, other_row in features.iteritems() if other_id != unit_id)
+
+@unittest.skipIf(numpy is None, 'NumPy and SciPy are not installed')
+class UnitSimilarityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+        setup_database()
+        populate(12)
+
+        unit_similarity.enabled = True
+        unit_similarity.top_k = 3
+        unit_similarity.weights = {'is_assessed': 1, 'is_applied': 0.5}
+        unit_similarity.category_weight = 0.5
+        unit_similarity.build()
+
+    def tearDown(self):
+        unit_similarity.enabled = False
+        unit_similarity.top_k = 20
+        unit_similarity.weights = {}
+        unit_similarity.category_weight = 0
+        unit_similarity.clear()
+        db.session.remove()
+        self.ctx.pop()
+
+    def assertMatchesBruteForce(self):
+        expected = brute_force(unit_similarity.weights, unit_similarity.category_weight)
+
+        for unit_id, in db.session.query(Unit.id):
+            actual = unit_similarity.similar(unit_id, 10)
+
+            # Any of the units tied for the last places may be listed
+            self.assertEqual([round(score, 9) for _, score, _ in actual],
+                sorted((score for (a, _), score in expected.iteritems()
+                    if a == unit_id and score > 0), reverse=True)[:unit_similarity.top_k])
+
+            for other_id, score, _ in actual:
+                self.assertEqual(round(score, 9), expected[unit_id, other_id])
+
+    def test_build(self):
+        self.assertMatchesBruteForce()
+
+        # The first unit shares a topic with every other one
+        other_id, score, num_shared = unit_similarity.similar(1)[0]
+        self.assertEqual(num_shared, 1)
+
+    def test_updated_on_commit(self):
+        rand = random.Random(0)
+        topic_ids = [topic_id for topic_id, in db.session.query(Topic.id)]
+
+        for _ in range(30):
+            unit_topics = db.session.query(UnitTopic).all()
+            action = rand.random()
+
+            if action < 0.4:
+                db.session.add(UnitTopic(rand.randint(1, 12), rand.choice(topic_ids)))
+            elif action < 0.7:
+                unit_topic = rand.choice(unit_topics)
+                unit_topic.is_assessed = rand.random() < 0.5
+                unit_topic.is_applied = rand.random() < 0.5
+            else:
+                db.session.delete(rand.choice(unit_topics))
+
+            db.session.commit()
+
+            self.assertFalse(unit_similarity.is_stale)
+            self.assertMatchesBruteForce()
+
+    def test_category_changes_rebuild(self):
+        topic = db.session.query(Topic).get(2)
+        topic.categories.append(db.session.query(Category).get(5))
+        db.session.commit()
+
+        self.assertTrue(unit_similarity.is_stale)
+        unit_similarity.check_if_due()
+        self.assertMatchesBruteForce()
+
+    def test_endpoint(self):
+        client = test_client()
+
+        response = client.get('/api/unit/COMP00001/similar?limit=2')
+        similar = json.loads(response.data)['similar_units']
+
+        self.assertEqual(len(similar), 2)
+        self.assertEqual(similar[0]['unit']['code'], 'COMP00000')
+        self.assertEqual(similar[0]['shared_topics'], 1)
+
+        self.assertEqual(client.get('/api/unit/COMP99999/similar').status_code, 404)
+        self.assertEqual(client.get('/api/unit/COMP00001/similar?limit=0').status_code, 400)
+
+        unit_similarity.enabled = False
+        self.assertEqual(client.get('/api/unit/COMP00001/similar').status_code, 404)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import unittest
+from lxml import etree
+from ..graph import postprocess_svg
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+def read(name):
+    with open(os.path.join(DATA_DIR, name), 'rb') as f:
+        return f.read()
+
+def lxml_postprocess(svg):
+    """ Previous implementation of render_svg's post-processing """
+    svgobj = etree.fromstring(svg.decode('utf-8').encode('utf-8'),
+        parser=etree.XMLParser(encoding='utf-8'))
+
+    svgobj.attrib['width'] = "100%"
+    svgobj.attrib['height'] = "100%"
+
+    for n in svgobj.xpath('//n:text', namespaces={'n': "http://www.w3.org/2000/svg"}):
+        n.attrib['text-rendering'] = 'geometricPrecision'
+
+    return etree.tostring(svgobj, pretty_print=True)
+
+def rendered(svg):
+    """ Elements with their text and attributes. text-rendering only affects
+    text, so it is given for <text> elements only, as inherited from their
+    ancestors """
+    elements = []
+
+    def walk(element, inherited):
+        attributes = dict(element.attrib)
+        inherited = attributes.pop('text-rendering', inherited)
+
+        if element.tag == '{http://www.w3.org/2000/svg}text':
+            attributes['text-rendering'] = inherited
+
+        elements.append((element.tag, (element.text or '').strip(), attributes))
+
+        for child in element:
+            if isinstance(child.tag, basestring):
+                walk(child, inherited)
+
+    walk(etree.fromstring(svg), 'auto')
+    return elements
+
+class PostprocessSvgTest(unittest.TestCase):
+
+    def test_golden(self):
+        graphviz_svg = read('graph.svg')
+
+        self.assertEqual(postprocess_svg(graphviz_svg), read('graph.expected.svg'))
+        self.assertEqual(postprocess_svg(graphviz_svg, minify=True), read('graph.min.svg'))
+
+    def test_same_as_lxml(self):
+        graphviz_svg = read('graph.svg')
+        expected = rendered(lxml_postprocess(graphviz_svg))
+
+        self.assertEqual(rendered(postprocess_svg(graphviz_svg)), expected)
+        self.assertEqual(rendered(postprocess_svg(graphviz_svg, minify=True)), expected)
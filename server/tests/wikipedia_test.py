@@ -0,0 +1,88 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from .mediawiki_stub import MediaWikiStub
+from ..wikipedia import WikipediaClient, SQLiteCache, BATCH_SIZE
+
+class WikipediaClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.wiki = MediaWikiStub({'Graph theory': ['Category:Graph theory']}).start()
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.wiki.stop()
+        shutil.rmtree(self.path)
+
+    def client(self, **kwargs):
+        cache = SQLiteCache(os.path.join(self.path, 'cache.db'))
+        return WikipediaClient(self.wiki.url, cache, **kwargs)
+
+    def test_cached_between_clients(self):
+        client = self.client()
+        self.assertEqual(client.normalize_title('graph_theory'), 'Graph theory')
+        self.assertEqual(client.categories('Graph theory'),
+            [{'ns': 14, 'title': 'Category:Graph theory'}])
+
+        # E.g. the next import run
+        client = self.client()
+        self.assertEqual(client.normalize_title('graph_theory'), 'Graph theory')
+        self.assertEqual(client.categories('Graph theory'),
+            [{'ns': 14, 'title': 'Category:Graph theory'}])
+
+        self.assertEqual(len(self.wiki.requests), 2)
+        self.assertEqual(client.stats(), {'hits': 2, 'misses': 0})
+
+    def test_missing_pages_cached(self):
+        client = self.client()
+        self.assertIsNone(client.normalize_title('No such page'))
+        self.assertIsNone(client.normalize_title('No such page'))
+
+        self.assertEqual(len(self.wiki.requests), 1)
+        self.assertEqual(client.stats(), {'hits': 1, 'misses': 1})
+
+    def test_expired_entries_fetched_again(self):
+        client = self.client(ttl=-1, negative_ttl=-1)
+        client.normalize_title('Graph theory')
+        client.normalize_title('No such page')
+        client.normalize_title('Graph theory')
+        client.normalize_title('No such page')
+
+        self.assertEqual(len(self.wiki.requests), 4)
+
+    def test_batched_normalization(self):
+        client = self.client()
+        titles = ['graph_theory', 'Graph theory', 'No such page'] + \
+            ['Missing %d' % i for i in range(BATCH_SIZE)]
+
+        normalized = client.normalize_titles(titles)
+
+        self.assertEqual(normalized['graph_theory'], 'Graph theory')
+        self.assertEqual(normalized['Graph theory'], 'Graph theory')
+        self.assertIsNone(normalized['No such page'])
+        self.assertEqual(len(self.wiki.requests), 2)
+
+        # Same results as looking up one by one, from cache
+        self.assertEqual(client.normalize_title('graph_theory'), 'Graph theory')
+        self.assertIsNone(client.normalize_title('Missing 3'))
+        self.assertEqual(len(self.wiki.requests), 2)
+
+    def test_batched_categories_continued(self):
+        self.wiki.pages['Sorting'] = ['Category:Sorting algorithms', 'Category:Algorithms']
+        self.wiki.pages['Tree'] = ['Category:Trees', 'Category:Graph theory']
+        self.wiki.category_limit = 2
+
+        categories = self.client().categories_batch(['Graph theory', 'Sorting', 'Tree', 'Nope'])
+
+        self.assertEqual([c['title'] for c in categories['Sorting']],
+            ['Category:Sorting algorithms', 'Category:Algorithms'])
+        self.assertEqual([c['title'] for c in categories['Tree']],
+            ['Category:Trees', 'Category:Graph theory'])
+        self.assertEqual(len(categories['Graph theory']), 1)
+        self.assertIsNone(categories['Nope'])
+        self.assertEqual(len(self.wiki.requests), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,255 @@
+import json
+import time
+import sqlite3
+import threading
+
+import requests
+
+from instrumentation import metrics
+
+WIKIPEDIA_API_URL = 'http://en.wikipedia.org/w/api.php'
+
+# Maximum number of titles the API accepts in one request
+BATCH_SIZE = 50
+
+class MemoryCache(object):
+    """ Per-process cache, used when no cache file is configured """
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, kind, title):
+        with self.lock:
+            entry = self.entries.get((kind, title))
+
+        if entry is None or entry[1] < time.time():
+            return False, None
+
+        return True, entry[0]
+
+    def set(self, kind, title, value, ttl):
+        with self.lock:
+            self.entries[(kind, title)] = (value, time.time() + ttl)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class SQLiteCache(object):
+    """ Cache stored in a SQLite file, shared between processes and runs """
+
+    def __init__(self, path):
+        self.path = path
+
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS wikipedia_cache ('
+                    'kind TEXT, title TEXT, value TEXT, expires REAL, '
+                    'PRIMARY KEY (kind, title))')
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # A connection per operation keeps the cache usable from any thread
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, kind, title):
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT value, expires FROM wikipedia_cache '
+                'WHERE kind = ? AND title = ?', (kind, title)).fetchone()
+        finally:
+            conn.close()
+
+        if row is None or row[1] < time.time():
+            return False, None
+
+        return True, json.loads(row[0])
+
+    def set(self, kind, title, value, ttl):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO wikipedia_cache VALUES (?, ?, ?, ?)',
+                    (kind, title, json.dumps(value), time.time() + ttl))
+        finally:
+            conn.close()
+
+    def clear(self):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('DELETE FROM wikipedia_cache')
+        finally:
+            conn.close()
+
+class WikipediaClient(object):
+    """ MediaWiki API lookups, cached by title and type of lookup.
+
+    Lookups of missing pages are cached as well, for a shorter time
+    (`negative_ttl`), so that typos in spreadsheets are not looked up again
+    on every import. """
+
+    def __init__(self, api_url=WIKIPEDIA_API_URL, cache=None,
+            ttl=7 * 24 * 3600, negative_ttl=24 * 3600):
+        self.api_url = api_url
+        self.cache = cache if cache is not None else MemoryCache()
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        self.api_url = app.config.get('WIKIPEDIA_API_URL', WIKIPEDIA_API_URL)
+        self.ttl = app.config.get('WIKIPEDIA_CACHE_TTL', self.ttl)
+        self.negative_ttl = app.config.get('WIKIPEDIA_NEGATIVE_TTL', self.negative_ttl)
+
+        cache_path = app.config.get('WIKIPEDIA_CACHE_PATH')
+        self.cache = SQLiteCache(cache_path) if cache_path else MemoryCache()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def query(self, **params):
+        params.update({'action': 'query', 'format': 'json', 'indexpageids': True})
+
+        with metrics.timer('wikipedia'):
+            r = requests.get(self.api_url, params=params)
+            r.raise_for_status()
+
+        return r.json()
+
+    @staticmethod
+    def single_page(responce):
+        """ The only page of a response, or None if it doesn't exist """
+        pageid = responce['query']['pageids'][0]
+
+        if pageid == '-1':
+            return None
+
+        return responce['query']['pages'][pageid]
+
+    def _cached(self, kind, title, lookup):
+        is_cached, value = self.cache.get(kind, title)
+
+        if is_cached:
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        value = lookup(title)
+        self.cache.set(kind, title, value, self.ttl if value is not None else self.negative_ttl)
+
+        return value
+
+    def _lookup_title(self, title):
+        page = self.single_page(self.query(titles=title))
+        return page['title'] if page else None
+
+    def _lookup_categories(self, title):
+        page = self.single_page(self.query(titles=title, prop='categories',
+            clshow='!hidden', cllimit='max'))
+
+        if page is None:
+            return None
+
+        return page.get('categories', [])
+
+    def _cached_batch(self, kind, titles, lookup):
+        """ Like `_cached`, for many titles, looking up the missing ones in
+        batches of at most BATCH_SIZE """
+        results = {}
+        missing = []
+
+        for title in set(titles):
+            is_cached, value = self.cache.get(kind, title)
+
+            if is_cached:
+                self.hits += 1
+                results[title] = value
+            else:
+                self.misses += 1
+                missing.append(title)
+
+        for i in range(0, len(missing), BATCH_SIZE):
+            batch = missing[i:i + BATCH_SIZE]
+
+            for title, value in lookup(batch).iteritems():
+                self.cache.set(kind, title, value,
+                    self.ttl if value is not None else self.negative_ttl)
+                results[title] = value
+
+        return results
+
+    def query_pages(self, titles, **params):
+        """ Pages for the given titles, following continuations. Returns a
+        dict of title -> page, or None for missing pages """
+        params['titles'] = '|'.join(titles)
+        params['continue'] = ''
+
+        pages = {}
+        normalized = {}
+
+        while True:
+            responce = self.query(**params)
+            query = responce['query']
+
+            for n in query.get('normalized', ()):
+                normalized[n['from']] = n['to']
+
+            for pageid in query['pageids']:
+                page = query['pages'][pageid]
+                merged = pages.setdefault(page['title'], page)
+
+                # Continued responses repeat the page with the next part of
+                # its categories
+                if merged is not page:
+                    merged.setdefault('categories', []).extend(page.get('categories', ()))
+
+            if 'continue' not in responce:
+                break
+
+            params.update(responce['continue'])
+
+        # Redirects are deliberately not followed, same as for single titles
+        results = {}
+        for title in titles:
+            page = pages.get(normalized.get(title, title))
+
+            if page is None or 'missing' in page or 'invalid' in page:
+                results[title] = None
+            else:
+                results[title] = page
+
+        return results
+
+    def _lookup_titles(self, titles):
+        return dict((title, page['title'] if page else None)
+            for title, page in self.query_pages(titles).iteritems())
+
+    def _lookup_categories_batch(self, titles):
+        pages = self.query_pages(titles, prop='categories', clshow='!hidden', cllimit='max')
+
+        return dict((title, page.get('categories', []) if page else None)
+            for title, page in pages.iteritems())
+
+    def normalize_titles(self, titles):
+        """ Like `normalize_title`, for many titles. Returns a dict """
+        return self._cached_batch('title', titles, self._lookup_titles)
+
+    def categories_batch(self, titles):
+        """ Like `categories`, for many titles. Returns a dict """
+        return self._cached_batch('categories', titles, self._lookup_categories_batch)
+
+    def normalize_title(self, title):
+        """ Canonical form of a title, or None if there is no such page """
+        return self._cached('title', title, self._lookup_title)
+
+    def categories(self, title):
+        """ Non-hidden categories of a page, or None if there is no such page """
+        return self._cached('categories', title, self._lookup_categories)
+
+wikipedia = WikipediaClient()
@@ -0,0 +1,121 @@
+#!/usr/bin/python
+""" Renders the graphs of all units, topics and categories, and the whole
+graph, into the render cache, so that their first viewers don't wait for
+their layout. Graphs whose units, topics, categories and style haven't
+changed since they were cached are not rendered again.
+
+Meant to be run after add_initial_data.py, or from cron. """
+
+from __future__ import print_function
+
+import sys
+import math
+import time
+import urllib
+import argparse
+import multiprocessing
+
+from server.app import app
+from server.init_app import init_app
+from server.models import *
+
+def graph_paths():
+    """ URL paths of all graphs, as requested by the client """
+    paths = ['/api/graph']
+
+    paths.extend('/api/graph/unit/' + urllib.quote(code.encode('utf-8'), safe='')
+        for code, in db.session.query(Unit.code).order_by(Unit.code))
+    paths.extend('/api/graph/topic/%d' % topic_id
+        for topic_id, in db.session.query(Topic.id).order_by(Topic.id))
+    paths.extend('/api/graph/category/%d' % category_id
+        for category_id, in db.session.query(Category.id).order_by(Category.id))
+
+    return paths
+
+def init_worker():
+    # Connections opened before forking can't be shared with the parent
+    db.get_engine(app).dispose()
+
+def warm(path):
+    """ Requests the graph. Returns the path, status, whether the graph was
+    rendered rather than found in the cache, and how long it took """
+    start = time.time()
+
+    with app.test_request_context(path):
+        response = app.full_dispatch_request()
+
+    return (path, response.status_code, response.headers.get('X-Graph-Cache') == 'miss',
+        time.time() - start)
+
+def percentile(values, p):
+    """ Nearest-rank percentile of sorted values """
+    if not values:
+        return 0.0
+
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+def warm_graphs(paths, jobs, progress=True):
+    """ Requests the graphs in `jobs` processes. Returns the number of graphs
+    found in the cache, latencies of rendered ones and failed paths """
+    num_cached = 0
+    latencies = []
+    failed = []
+
+    pool = multiprocessing.Pool(jobs, init_worker) if jobs > 1 else None
+    results = pool.imap_unordered(warm, paths) if pool else (warm(p) for p in paths)
+
+    try:
+        for i, (path, status, rendered, latency) in enumerate(results):
+            if status != 200:
+                failed.append((path, status))
+            elif rendered:
+                latencies.append(latency)
+            else:
+                num_cached += 1
+
+            if progress:
+                print('\r%d/%d graphs' % (i + 1, len(paths)), end='', file=sys.stderr)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    if progress:
+        print(file=sys.stderr)
+
+    return num_cached, sorted(latencies), failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Render all graphs into the render cache')
+    parser.add_argument('config', help='Server config file (e.g. server.cfg)')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+        help='Number of processes rendering graphs (number of CPUs by default)')
+    parser.add_argument('-q', '--quiet', action='store_true', help="Don't report progress")
+    args = parser.parse_args()
+
+    init_app(app, args.config)
+
+    # Graphs rendered into a memory cache would be gone when the script exits
+    if app.config.get('GRAPH_CACHE') != 'file':
+        sys.exit("GRAPH_CACHE has to be 'file' for graphs to be kept")
+
+    with app.app_context():
+        paths = graph_paths()
+
+    start = time.time()
+    num_cached, latencies, failed = warm_graphs(paths, args.jobs, not args.quiet)
+    total = time.time() - start
+
+    print('%d graphs in %.1f s: %d rendered, %d unchanged, %d failed' % (len(paths), total,
+        len(latencies), num_cached, len(failed)))
+
+    if latencies:
+        print('Render time: p50 %.3f s, p90 %.3f s, p99 %.3f s, max %.3f s' % (
+            percentile(latencies, 50), percentile(latencies, 90),
+            percentile(latencies, 99), latencies[-1]))
+
+    for path, status in failed:
+        print('%s: %d' % (path, status), file=sys.stderr)
+
+    if failed:
+        sys.exit(1)